@@ -1,49 +1,96 @@
 #!/usr/bin/python3
 
 # Press the green button in the gutter to run the script.
-import json
+import argparse
+import asyncio
+import sys
 
-from search.exception import SearchIndexException
-from search.index_node import IndexNode
-from search.main import main
+from search import metrics
+from search.server import serve
+from search.shard import ShardedShell
+from search.shell import Shell, WAL_PATH
 
 if __name__ == '__main__':
-    # Load the JSON file, if it exists
-    try:
-        with open("./index.json", "r") as in_file:
-            index = IndexNode.parse(json.loads(in_file.read()))
-            print("Loaded index.json successfully")
-    except SearchIndexException as ex:
-        # We weren't able to load the file, so just create a new index
-        print("WARNING - Unable to load index file! Defaulting to empty index...")
-        index = IndexNode()
-
-    done = False
-    while not done:
-        cmd = input("> ")
-        if cmd == "save":
-            # Save the JSON file
-            with open("./index.json", "w") as out_file:
-                out_file.write(json.dumps(index.json()))
-            print("JSON file saved")
-        elif cmd == "load":
-            # Reload the JSON file
-            try:
-                with open("./index.json", "r") as in_file:
-                    index = IndexNode.parse(json.loads(in_file.read()))
-                    print("Loaded index.json successfully")
-            except SearchIndexException as ex:
-                # We weren't able to load the file, so just create a new index
-                print("WARNING - Unable to load index file! Defaulting to empty index...")
-                index = IndexNode()
-        elif cmd == "exit":
-            # Exit
-            print("Bye!")
-            done = True
-        elif cmd.startswith("clear"):
-            index = IndexNode()
-            print("Index cleared")
-        else:
-            args = cmd.split(' ')
-            print(main(args, index))
+    parser = argparse.ArgumentParser(description="Search engine command loop")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--batch", action="store_true",
+                      help="read commands from stdin without prompting (default when stdin isn't a terminal)")
+    mode.add_argument("--interactive", action="store_true",
+                      help="prompt for commands (default when stdin is a terminal)")
+    mode.add_argument("--listen", metavar="[HOST:]PORT",
+                      help="serve the command protocol over TCP instead of reading stdin")
+    mode.add_argument("--unix", metavar="PATH",
+                      help="serve the command protocol on a Unix socket instead of reading stdin")
+    parser.add_argument("--bulk-load", metavar="PATH",
+                        help="index a file of index commands in parallel before reading any commands")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes for --bulk-load (default: one per CPU)")
+    parser.add_argument("--wal-sync", type=int, default=1000, metavar="N",
+                        help="fsync the write-ahead log at least every N logged commands (default: 1000)")
+    parser.add_argument("--snapshot-every", type=int, default=100000, metavar="N",
+                        help="write a new index snapshot after N logged commands (default: 100000)")
+    parser.add_argument("--no-wal", action="store_true",
+                        help="don't keep a write-ahead log; save writes a full snapshot instead")
+    parser.add_argument("--segmented", action="store_true",
+                        help="keep the index as immutable segments, merged in the background, so updates stay cheap")
+    parser.add_argument("--shards", type=int, default=0, metavar="N",
+                        help="spread the index over N worker processes, each with its own index files")
+    parser.add_argument("--threads", type=int, default=4, metavar="N",
+                        help="threads running queries concurrently for --listen/--unix (default: 4)")
+    parser.add_argument("--pipeline", type=int, default=64, metavar="N",
+                        help="commands read ahead on each connection for --listen/--unix (default: 64)")
+    parser.add_argument("--metrics", action="store_true",
+                        help="record command and query phase latencies from the start (see the stats command)")
+    parser.add_argument("--metrics-dump", metavar="PATH",
+                        help="append the metrics to PATH as a JSON line every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=float, default=10, metavar="SECONDS",
+                        help="seconds between --metrics-dump lines (default: 10)")
+    options = parser.parse_args()
+    server = options.listen is not None or options.unix is not None
+    if server and options.shards > 0:
+        parser.error("--shards can't be combined with --listen or --unix")
+    if options.shards > 0 and (options.metrics or options.metrics_dump is not None):
+        parser.error("--shards can't be combined with --metrics or --metrics-dump")
+    host, _, port = (options.listen or "").rpartition(":")
+    if options.listen is not None and not port.isdigit():
+        parser.error(f"invalid --listen address: {options.listen}")
+    batch = options.batch or (not options.interactive and not sys.stdin.isatty())
 
+    wal_path = None if options.no_wal else WAL_PATH
+    if options.shards > 0:
+        shell = ShardedShell(options.shards, wal_path=wal_path,
+                             wal_sync_every=options.wal_sync,
+                             snapshot_every=options.snapshot_every,
+                             segmented=options.segmented)
+    else:
+        shell = Shell(wal_path=wal_path,
+                      wal_sync_every=options.wal_sync,
+                      snapshot_every=options.snapshot_every,
+                      segmented=options.segmented)
+    message = shell.load()
+    if options.bulk_load is not None:
+        args = [options.bulk_load] + ([str(options.workers)] if options.workers is not None else [])
+        message += "\n" + shell.bulk_load(args)
+    metrics.use_metrics(options.metrics or options.metrics_dump is not None)
+    dumper = None
+    if options.metrics_dump is not None:
+        dumper = metrics.Dumper(options.metrics_dump, options.metrics_interval, shell.collect_stats)
+        dumper.start()
+    if server:
+        print(message, file=sys.stderr)
+        try:
+            asyncio.run(serve(shell, host=host or None, port=int(port) if port else None, path=options.unix,
+                              threads=options.threads, pipeline_depth=options.pipeline))
+        except KeyboardInterrupt:
+            pass
+    elif batch:
+        # Keep stdout to the command responses, so the output can be piped straight into another program
+        print(message, file=sys.stderr)
+        shell.run_batch(sys.stdin.buffer, sys.stdout.buffer)
+    else:
+        print(message)
+        shell.run_interactive()
+    # Don't leave a snapshot half-written, for the next run to trip over
+    shell.wait()
+    if dumper is not None:
+        dumper.stop()
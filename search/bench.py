@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable
+
+from search import metrics, vector
+from search.cache import PlanCache, QueryCache
+from search.main import main
+from search.planner import QueryPlanner
+from search.segmented_index import SegmentedIndex
+from search.term_index import TermIndex
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak RSS isn't reported
+    resource = None
+
+
+class Corpus:
+    """
+    Synthetic corpus generator: term frequencies follow a Zipfian distribution over a fixed vocabulary, and document
+    lengths are uniform around a mean. Everything is derived from the seed, so runs are reproducible.
+    """
+
+    def __init__(self, vocabulary: int, zipf: float, doc_length: int, seed: int):
+        self.terms = [f"t{rank}" for rank in range(vocabulary)]
+        self.cum_weights = list(itertools.accumulate(1.0 / (rank + 1) ** zipf for rank in range(vocabulary)))
+        self.doc_length = doc_length
+        self.random = random.Random(seed)
+
+    def sample_terms(self, count: int) -> list[str]:
+        return self.random.choices(self.terms, cum_weights=self.cum_weights, k=count)
+
+    def document(self) -> list[str]:
+        length = self.random.randint(max(1, self.doc_length // 2), max(1, self.doc_length * 3 // 2))
+        return self.sample_terms(length)
+
+    def nested_query(self, depth: int) -> str:
+        if depth == 0:
+            return self.sample_terms(1)[0]
+        op = self.random.choice("&|")
+        return f"({self.nested_query(depth - 1)} {op} {self.nested_query(depth - 1)})"
+
+    def prefix_query(self) -> str:
+        # Keep at least two digits after the "t", so the prefix stays under the expansion cap
+        term = self.sample_terms(1)[0]
+        return term[:self.random.randint(min(3, len(term)), len(term))] + "*"
+
+    def related_queries(self, count: int, depth: int) -> list[str]:
+        # A dashboard's worth of queries: the same nested subexpression, each combined with a different term
+        shared = self.nested_query(depth)
+        return [f"({shared} {self.random.choice('&|')} {term})" for term in self.sample_terms(count)]
+
+    def exclusion_query(self) -> str:
+        # A sampled term less one of the most common ones, or one of those less a sampled term
+        term, common = self.sample_terms(1)[0], self.terms[self.random.randrange(10)]
+        return f"{term} & !{common}" if self.random.random() < 0.5 else f"{common} & !{term}"
+
+    def union_query(self, fanout: int) -> str:
+        # Parentheses are mandatory, so a wide union is a left-deep chain
+        terms = self.sample_terms(fanout)
+        query = terms[0]
+        for term in terms[1:]:
+            query = f"({query} | {term})"
+        return query
+
+
+def percentile(sorted_values: list[int], fraction: float) -> int:
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def peak_rss_kb() -> int | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_workload(name: str, commands: list[list[str]], index: TermIndex, **extra) -> dict:
+    """
+    Runs a list of commands through the handlers, timing each one.
+    :param name: The workload name to report.
+    :param commands: The commands, already split into args.
+    :param index: The index to run against.
+    :return: The workload's report.
+    """
+    return run_calls(name, [lambda args=args: main(args, index) for args in commands], **extra)
+
+
+def run_calls(name: str, calls: list[Callable], **extra) -> dict:
+    """
+    Runs a list of calls, timing each one.
+    :param name: The workload name to report.
+    :param calls: The calls to make.
+    :return: The workload's report.
+    """
+    latencies = []
+    clock = time.perf_counter_ns
+    start = clock()
+    for call in calls:
+        before = clock()
+        call()
+        latencies.append(clock() - before)
+    elapsed = (clock() - start) / 1e9
+    latencies.sort()
+    return {
+        "workload": name,
+        "ops": len(calls),
+        "seconds": round(elapsed, 6),
+        "ops_per_sec": round(len(calls) / elapsed, 1) if elapsed > 0 else None,
+        "p50_us": round(percentile(latencies, 0.50) / 1000, 2),
+        "p99_us": round(percentile(latencies, 0.99) / 1000, 2),
+        **extra,
+    }
+
+
+def timed(action: Callable) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = action()
+    return round(time.perf_counter() - start, 6), result
+
+
+def run_corpus(options: dict) -> list[dict]:
+    """
+    Builds one corpus and runs every workload against it. Runs in its own process, so peak RSS is per corpus.
+    :param options: The benchmark settings, including the number of documents.
+    :return: One report per workload.
+    """
+    docs = options["docs"]
+    vector.use_numpy(not options["no_numpy"])
+    metrics.use_metrics(options["metrics"])
+    corpus = Corpus(options["vocabulary"], options["zipf"], options["doc_length"], options["seed"])
+    cache = QueryCache.instantiate()
+    cache.enabled = False
+    plans = PlanCache.instantiate()
+    tmp_dir = tempfile.TemporaryDirectory()
+    index = SegmentedIndex(os.path.join(tmp_dir.name, "segments")) if options["segmented"] else TermIndex()
+    reports = []
+
+    commands = [["index", str(doc_id)] + corpus.document() for doc_id in range(docs)]
+    reports.append(run_workload("index", commands, index))
+    commands = [["index", str(corpus.random.randrange(docs))] + corpus.document() for _ in range(options["updates"])]
+    reports.append(run_workload("update", commands, index))
+    del commands
+
+    queries = {
+        "query_term": [corpus.sample_terms(1)[0] for _ in range(options["queries"])],
+        "query_nested": [corpus.nested_query(options["depth"]) for _ in range(options["queries"])],
+        "query_union": [corpus.union_query(options["fanout"]) for _ in range(options["queries"])],
+        "query_prefix": [corpus.prefix_query() for _ in range(options["queries"])],
+        "query_exclusion": [corpus.exclusion_query() for _ in range(options["queries"])],
+    }
+    for name, expressions in queries.items():
+        reports.append(run_workload(name, [["query"] + expression.split(' ') for expression in expressions], index))
+    # Wide unions formatted for output: whole, streamed a chunk at a time, and only their first page; then only counted,
+    # exactly and from sketches, and only their ten best matches
+    unions = [expression.split(' ') for expression in queries["query_union"]]
+
+    def stream(args: list[str]):
+        for _ in main(["query", "stream=on"] + args, index).chunks():
+            pass
+
+    reports.append(run_calls("union_formatted", [lambda args=args: str(main(["query"] + args, index))
+                                                 for args in unions]))
+    reports.append(run_calls("union_streamed", [lambda args=args: stream(args) for args in unions]))
+    reports.append(run_calls("union_limited", [lambda args=args: str(main(["query", "limit=10"] + args, index))
+                                               for args in unions]))
+    reports.append(run_calls("union_counted", [lambda args=args: str(main(["count"] + args, index))
+                                               for args in unions]))
+    reports.append(run_calls("union_counted_approx", [lambda args=args: str(main(["count", "approx=on"] + args, index))
+                                                      for args in unions]))
+    reports.append(run_calls("union_ranked", [lambda args=args: str(main(["query", "top", "10"] + args, index))
+                                              for args in unions]))
+    reports.append(run_calls("term_ranked", [lambda term=term: str(main(["query", "top", "10", term], index))
+                                             for term in queries["query_term"]]))
+    # The same exclusions as a client had to run them before there was a negation: both sides in full
+    exclusions = [expression.split(" & !") for expression in queries["query_exclusion"]]
+    reports.append(run_calls("exclusion_client", [lambda pair=pair: [str(main(["query", term], index)) for term in pair]
+                                                  for pair in exclusions]))
+    # Batches of related queries, one at a time and then as a single mquery which evaluates shared parts once
+    batches = [corpus.related_queries(options["batch"], options["depth"])
+               for _ in range(max(1, options["queries"] // options["batch"]))]
+    reports.append(run_calls("batch_single", [lambda batch=batch: [str(main(["query"] + query.split(' '), index))
+                                                                   for query in batch] for batch in batches],
+                             batch=options["batch"]))
+    reports.append(run_calls("batch_mquery", [lambda batch=batch: str(main(["mquery"] + " ; ".join(batch).split(' '),
+                                                                           index)) for batch in batches],
+                             batch=options["batch"]))
+    # Parsing and planning alone, from scratch and then from the compiled-plan cache
+    nested = [expression.split(' ') for expression in queries["query_nested"]]
+    reports.append(run_calls("parse", [lambda args=args: QueryPlanner.compile(args) for args in nested]))
+    for args in nested:
+        plans.compile(args)
+    reports.append(run_calls("parse_cached", [lambda args=args: plans.compile(args) for args in nested]))
+    # Repetitive traffic, with the query cache switched on
+    cache.enabled = True
+    mixed = list(itertools.chain.from_iterable(queries.values()))
+    repeated = [corpus.random.choice(mixed[:100]).split(' ') for _ in range(options["queries"])]
+    reports.append(run_workload("query_cached", [["query"] + args for args in repeated], index))
+    cache.enabled = False
+
+    with tmp_dir:
+        json_path = os.path.join(tmp_dir.name, "index.json")
+        seg_path = os.path.join(tmp_dir.name, "index.seg")
+
+        def save_json():
+            with open(json_path, "w") as out_file:
+                out_file.write(json.dumps(index.json()))
+
+        def load_json():
+            with open(json_path, "r") as in_file:
+                return TermIndex.parse(json.loads(in_file.read()))
+
+        json_save, _ = timed(save_json)
+        json_load, _ = timed(load_json)
+        seg_save, _ = timed(lambda: index.save(seg_path))
+        seg_open, opened = timed(lambda: TermIndex.open(seg_path))
+        first_query, _ = timed(lambda: main(["query"] + queries["query_nested"][0].split(' '), opened))
+        reports.append({
+            "workload": "persistence",
+            "json_save_seconds": json_save,
+            "json_load_seconds": json_load,
+            "json_bytes": os.path.getsize(json_path),
+            "segment_save_seconds": seg_save,
+            "segment_open_seconds": seg_open,
+            "segment_first_query_seconds": first_query,
+            "segment_bytes": os.path.getsize(seg_path),
+        })
+        opened.close()
+        terms = opened.segment.term_count
+        index.close()
+
+    peak_rss = peak_rss_kb()
+    for report in reports:
+        report.update(docs=docs, terms=terms, peak_rss_kb=peak_rss)
+    return reports
+
+
+def run(options: dict, sizes: list[int], out_stream) -> list[dict]:
+    """
+    Runs the benchmark for each corpus size, writing one JSON line per workload.
+    :return: Every report.
+    """
+    environment = {"python": sys.version.split()[0], "platform": sys.platform, "label": options.pop("label"),
+                   "numpy": vector.numpy.__version__ if vector.numpy is not None and not options["no_numpy"] else None,
+                   "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    reports = []
+    for docs in sizes:
+        settings = dict(options, docs=docs)
+        with multiprocessing.Pool(1) as pool:
+            corpus_reports = pool.apply(run_corpus, (settings,))
+        for report in corpus_reports:
+            report = {**environment, **settings, **report}
+            out_stream.write(json.dumps(report) + "\n")
+            out_stream.flush()
+            reports.append(report)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search engine benchmark, reporting JSON lines")
+    parser.add_argument("--docs", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="corpus sizes to run (default: 10000 100000 1000000)")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="number of distinct terms")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of term frequencies")
+    parser.add_argument("--doc-length", type=int, default=20, help="mean tokens per document")
+    parser.add_argument("--updates", type=int, default=10000, help="re-index operations")
+    parser.add_argument("--queries", type=int, default=1000, help="queries per query workload")
+    parser.add_argument("--depth", type=int, default=4, help="depth of nested &/| queries")
+    parser.add_argument("--fanout", type=int, default=32, help="terms in each wide union")
+    parser.add_argument("--batch", type=int, default=16, help="queries in each mquery batch")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--segmented", action="store_true", help="benchmark the segmented (LSM-style) index")
+    parser.add_argument("--no-numpy", action="store_true",
+                        help="use the pure-Python set algebra even if NumPy is installed")
+    parser.add_argument("--metrics", action="store_true",
+                        help="keep the metrics probes on, to measure what they cost")
+    parser.add_argument("--label", default="", help="free-form label, e.g. a version, to tag the results with")
+    parser.add_argument("--output", help="append results to this file instead of stdout")
+    arguments = vars(parser.parse_args())
+    corpus_sizes = arguments.pop("docs")
+    output = arguments.pop("output")
+    if output is None:
+        run(arguments, corpus_sizes, sys.stdout)
+    else:
+        with open(output, "a") as output_file:
+            run(arguments, corpus_sizes, output_file)
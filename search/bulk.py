@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+from array import array
+from collections import Counter
+
+from search.postings import MAX_DOC_ID, MAX_FREQUENCY
+from search.term_index import TermIndex
+
+
+class ChunkResult:
+    """
+    Partial index built from one chunk of a bulk-load file: the last version of each document in the chunk, plus
+    the term -> doc IDs postings for those documents, and the term frequencies of the terms which occur more than
+    once in any of them.
+    """
+    __slots__ = ("doc_tokens", "term_doc_ids", "term_frequencies", "indexed", "errors")
+
+    def __init__(self):
+        self.doc_tokens = dict[int, tuple[str, ...]]()
+        self.term_doc_ids = dict[str, array]()
+        self.term_frequencies = dict[str, array]()
+        self.indexed = 0
+        self.errors = 0
+
+
+def split_file(path: str, chunks: int) -> list[tuple[int, int]]:
+    """
+    Splits a file into roughly equal byte ranges, each starting and ending on a line boundary.
+    :param path: The file to split.
+    :param chunks: How many ranges to aim for.
+    :return: A list of (start, end) byte offsets.
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as in_file:
+        for i in range(1, chunks):
+            in_file.seek(max(size * i // chunks, boundaries[-1]))
+            in_file.readline()
+            boundaries.append(min(in_file.tell(), size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def build_chunk(path: str, start: int, end: int) -> ChunkResult:
+    """
+    Builds the partial index for one byte range of a bulk-load file. Runs in a worker process.
+    Lines follow the index command syntax; anything else counts as an error.
+    :param path: The bulk-load file.
+    :param start: The first byte of the range.
+    :param end: The byte after the end of the range.
+    :return: The partial index for the range.
+    """
+    result = ChunkResult()
+    with open(path, "rb") as in_file:
+        in_file.seek(start)
+        data = in_file.read(end - start).decode("utf-8")
+    doc_tokens = result.doc_tokens
+    # The token counts of the documents which repeat a token
+    repeated = dict[int, Counter[str]]()
+    for line in data.split("\n"):
+        args = line.rstrip("\r").split(' ')
+        if len(args) == 1 and args[0] == "":
+            continue
+        if len(args) < 3 or args[0] != "index":
+            result.errors += 1
+            continue
+        try:
+            doc_id = int(args[1])
+        except ValueError:
+            result.errors += 1
+            continue
+        if doc_id < 0 or doc_id > MAX_DOC_ID:
+            result.errors += 1
+            continue
+        # Later lines replace earlier ones for the same doc ID, so only the last version needs indexing
+        counts = Counter(args[2:])
+        doc_tokens[doc_id] = tuple(counts)
+        if len(counts) < len(args) - 2:
+            repeated[doc_id] = counts
+        else:
+            repeated.pop(doc_id, None)
+        result.indexed += 1
+    term_doc_ids = dict[str, list[int]]()
+    term_frequencies = dict[str, list[int]]()
+    for doc_id in sorted(doc_tokens):
+        counts = repeated.get(doc_id)
+        for token in doc_tokens[doc_id]:
+            doc_ids = term_doc_ids.get(token)
+            if doc_ids is None:
+                doc_ids = term_doc_ids[token] = []
+            doc_ids.append(doc_id)
+            frequency = counts[token] if counts is not None else 1
+            frequencies = term_frequencies.get(token)
+            if frequencies is None and frequency != 1:
+                frequencies = term_frequencies[token] = [1] * (len(doc_ids) - 1)
+            if frequencies is not None:
+                frequencies.append(min(frequency, MAX_FREQUENCY))
+    result.term_doc_ids = {token: array('I', doc_ids) for token, doc_ids in term_doc_ids.items()}
+    result.term_frequencies = {token: array('H', tfs) for token, tfs in term_frequencies.items()}
+    return result
+
+
+def _build_chunk(chunk: tuple[str, int, int]) -> ChunkResult:
+    return build_chunk(*chunk)
+
+
+def bulk_load(index: TermIndex, path: str, workers: int = None) -> tuple[int, int]:
+    """
+    Indexes every line of a file of index commands, building partial indexes for chunks of the file in parallel and
+    merging them into the index in file order, so the last line for a doc ID still wins.
+    :param index: The index to load into.
+    :param path: The file of index commands.
+    :param workers: How many worker processes to use; defaults to the number of CPUs.
+    :return: The number of lines indexed, and the number of invalid lines.
+    """
+    workers = workers if workers is not None else os.cpu_count() or 1
+    # A few chunks per worker keeps them all busy, and bounds how much is held in memory before merging
+    chunks = [(path, start, end) for start, end in split_file(path, workers * 4)]
+    indexed = errors = 0
+
+    def merge(result: ChunkResult):
+        nonlocal indexed, errors
+        index.merge(result.doc_tokens, result.term_doc_ids, result.term_frequencies)
+        indexed += result.indexed
+        errors += result.errors
+
+    if workers <= 1:
+        for chunk in chunks:
+            merge(_build_chunk(chunk))
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            for result in pool.imap(_build_chunk, chunks):
+                merge(result)
+    return indexed, errors
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bulk_path = os.path.join(tmp_dir, "bulk.txt")
+        with open(bulk_path, "w") as out_file:
+            for i in range(200):
+                out_file.write(f"index {i % 50} t{i} shared\n")
+            out_file.write("index x broken\nquery shared\nindex 60 twice once twice\n")
+        for worker_count in (1, 2):
+            root = TermIndex()
+            root.add_doc(7, ["old"])
+            assert bulk_load(root, bulk_path, workers=worker_count) == (201, 2)
+            assert len(root) == 51
+            assert root.postings("old") is None
+            assert root.postings("t7") is None
+            assert list(root.get_doc_ids_containing_token("t157")) == [7]
+            assert list(root.get_doc_ids_containing_token("shared")) == list(range(50))
+            assert root.doc_tokens[7] == ("t157", "shared")
+            # Term frequencies come through too, the same as add_doc would count them
+            assert root.postings("twice").frequency(60) == 2 and root.postings("shared").frequency(7) == 1
+            assert root.token_count == 102
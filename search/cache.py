@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+
+from search.planner import CompiledQuery, QueryPlanner
+from search.postings import Postings
+from search.term_index import TermIndex
+
+
+class CacheEntry:
+    __slots__ = ("results", "generations")
+
+    def __init__(self, results: Postings, generations: tuple[tuple[str, int], ...]):
+        self.results = results
+        self.generations = generations
+
+
+class QueryCache:
+    """
+    LRU cache of query results, keyed by the normalized query plan.
+    Each entry remembers the generation of every term it read; if any of those terms has changed since, the entry is
+    dropped on lookup, so indexing a document only invalidates the queries which actually use its tokens.
+    Safe to share between threads running queries concurrently.
+    """
+    _instance = None
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.enabled = True
+        self.entries = OrderedDict[str, CacheEntry]()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def instantiate():
+        if not QueryCache._instance:
+            QueryCache._instance = QueryCache()
+        return QueryCache._instance
+
+    def get(self, key: str, index: TermIndex) -> Postings | None:
+        """
+        Looks up the cached results for a query.
+        :param key: The normalized query plan.
+        :param index: The index the query is running against.
+        :return: The cached results, or None if they aren't cached or are out of date.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            for term, generation in entry.generations:
+                if index.generation(term) != generation:
+                    del self.entries[key]
+                    self.invalidations += 1
+                    self.misses += 1
+                    return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.results
+
+    def put(self, key: str, terms: set[str], index: TermIndex, results: Postings):
+        """
+        Caches the results of a query, evicting the least recently used entry if the cache is full.
+        :param key: The normalized query plan.
+        :param terms: Every term the query reads.
+        :param index: The index the query ran against.
+        :param results: The query results.
+        :return: None
+        """
+        if not self.enabled or self.max_entries <= 0:
+            return
+        generations = tuple((term, index.generation(term)) for term in terms)
+        with self._lock:
+            self.entries[key] = CacheEntry(results, generations)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"enabled": self.enabled, "entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups > 0 else None, "evictions": self.evictions,
+                "invalidations": self.invalidations}
+
+    def __str__(self):
+        return (f"{'on' if self.enabled else 'off'} entries={len(self.entries)} hits={self.hits} "
+                f"misses={self.misses} evictions={self.evictions} invalidations={self.invalidations}")
+
+
+class PlanCache:
+    """
+    LRU cache of compiled queries, keyed by the raw query text, so running the same text again skips parsing and
+    planning altogether. A compiled query doesn't depend on the index, so entries never go stale.
+    Safe to share between threads running queries concurrently.
+    """
+    _instance = None
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict[str, CompiledQuery]()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def instantiate():
+        if not PlanCache._instance:
+            PlanCache._instance = PlanCache()
+        return PlanCache._instance
+
+    def compile(self, args: list[str]) -> CompiledQuery:
+        """
+        Looks up the compiled form of a query, compiling and caching it if it isn't cached yet.
+        :param args: The query, split on spaces.
+        :return: The compiled query.
+        :raises: SearchQueryException if the query is malformed. Malformed queries aren't cached.
+        """
+        text = ' '.join(args)
+        with self._lock:
+            compiled = self.entries.get(text)
+            if compiled is not None:
+                self.entries.move_to_end(text)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = QueryPlanner.compile(args)
+        if self.max_entries > 0:
+            with self._lock:
+                self.entries[text] = compiled
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups > 0 else None}
+
+    def __str__(self):
+        return f"entries={len(self.entries)} hits={self.hits} misses={self.misses}"
+
+
+if __name__ == "__main__":
+    root = TermIndex()
+    root.add_doc(1, ["soup", "salt"])
+    root.add_doc(2, ["cake", "sugar"])
+
+    cache = QueryCache(max_entries=2)
+    assert cache.get("soup", root) is None
+    cache.put("soup", {"soup"}, root, root.postings("soup"))
+    cache.put("cake", {"cake"}, root, root.postings("cake"))
+    assert list(cache.get("soup", root)) == [1]
+
+    # Only the entries reading the re-indexed document's tokens are invalidated
+    root.add_doc(2, ["cake", "flour"])
+    assert cache.get("soup", root) is not None
+    assert cache.get("cake", root) is None
+
+    # Least recently used entries are evicted first
+    cache.put("cake", {"cake"}, root, root.postings("cake"))
+    cache.put("salt", {"salt"}, root, root.postings("salt"))
+    assert cache.get("soup", root) is None
+    assert str(cache) == "on entries=2 hits=2 misses=3 evictions=1 invalidations=1"
+    assert cache.stats()["hit_rate"] == 0.4
+
+    # The same text compiles once; equivalent texts share their results, but not their compiled form
+    plans = PlanCache(max_entries=2)
+    assert plans.compile(["soup", "&", "salt"]) is plans.compile(["soup", "&", "salt"])
+    assert plans.compile(["salt", "&", "soup"]).key == plans.compile(["soup", "&", "salt"]).key
+    plans.compile(["cake"])
+    assert str(plans) == "entries=2 hits=2 misses=3"
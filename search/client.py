@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+
+from search.bench import Corpus, percentile
+
+
+class SearchClient:
+    """
+    Client for the search server's line protocol. Commands can be pipelined: several are sent before their
+    responses are read back, in order.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @staticmethod
+    async def connect(host: str = None, port: int = None, path: str = None) -> SearchClient:
+        """
+        Connects to a server.
+        :param host: The server's TCP address.
+        :param port: The server's TCP port.
+        :param path: The server's Unix socket path, instead of a TCP address.
+        :return: The connected client.
+        """
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path, limit=1 << 24)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=1 << 24)
+        return SearchClient(reader, writer)
+
+    def send(self, line: str):
+        self.writer.write(line.encode("utf-8") + b"\n")
+
+    async def receive(self) -> str:
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("SEARCH_CONNECTION_CLOSED")
+        return line.decode("utf-8").rstrip("\n")
+
+    async def execute(self, line: str) -> str:
+        self.send(line)
+        await self.writer.drain()
+        return await self.receive()
+
+    async def execute_lines(self, lines: list[str], window: int = 64) -> list[str]:
+        """
+        Runs a batch of commands, keeping up to window of them in flight at once.
+        :param lines: The command lines. Blank lines have no response, so they're skipped.
+        :param window: How many commands to send ahead of their responses.
+        :return: The responses, in order.
+        """
+        lines = [line for line in lines if line != ""]
+        responses = []
+        for position, line in enumerate(lines):
+            self.send(line)
+            if position - len(responses) + 1 >= window:
+                await self.writer.drain()
+                responses.append(await self.receive())
+        await self.writer.drain()
+        while len(responses) < len(lines):
+            responses.append(await self.receive())
+        return responses
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def run_connection(options: dict, connection: int) -> list[int]:
+    """
+    Sends one connection's share of a load test: a random mix of index commands and nested queries, pipelined.
+    :param options: The load test settings.
+    :param connection: The connection number, which the random mix is seeded with.
+    :return: The latency of every command, in nanoseconds.
+    """
+    corpus = Corpus(options["vocabulary"], options["zipf"], options["doc_length"], options["seed"] + connection)
+    commands = []
+    for _ in range(options["requests"]):
+        if corpus.random.random() < options["write_ratio"]:
+            commands.append(" ".join(["index", str(corpus.random.randrange(options["docs"]))] + corpus.document()))
+        else:
+            commands.append("query " + corpus.nested_query(options["depth"]))
+    client = await SearchClient.connect(options["host"], options["port"], options["unix"])
+    clock = time.perf_counter_ns
+    sent = deque[int]()
+    latencies = []
+    for command in commands:
+        client.send(command)
+        sent.append(clock())
+        if len(sent) >= options["pipeline"]:
+            await client.writer.drain()
+            await client.receive()
+            latencies.append(clock() - sent.popleft())
+    await client.writer.drain()
+    while len(sent) > 0:
+        await client.receive()
+        latencies.append(clock() - sent.popleft())
+    await client.close()
+    return latencies
+
+
+async def load_test(options: dict) -> dict:
+    """
+    Runs a load test against a running server, from several concurrent connections.
+    :param options: The load test settings.
+    :return: The load test's report.
+    """
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run_connection(options, connection)
+                                     for connection in range(options["connections"])))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for result in results for latency in result)
+    return {
+        **options,
+        "workload": "server",
+        "ops": len(latencies),
+        "seconds": round(elapsed, 6),
+        "ops_per_sec": round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        "p50_us": round(percentile(latencies, 0.50) / 1000, 2),
+        "p99_us": round(percentile(latencies, 0.99) / 1000, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the search server, reporting a JSON line")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7878)
+    parser.add_argument("--unix", metavar="PATH", help="connect to a Unix socket instead of TCP")
+    parser.add_argument("--connections", type=int, default=8, help="concurrent connections")
+    parser.add_argument("--requests", type=int, default=10000, help="commands sent on each connection")
+    parser.add_argument("--pipeline", type=int, default=16, help="commands in flight on each connection")
+    parser.add_argument("--write-ratio", type=float, default=0.1, help="fraction of commands which are index commands")
+    parser.add_argument("--docs", type=int, default=100000, help="doc-ids to index into")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="number of distinct terms")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of term frequencies")
+    parser.add_argument("--doc-length", type=int, default=20, help="mean tokens per document")
+    parser.add_argument("--depth", type=int, default=2, help="depth of nested &/| queries")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="", help="free-form label, e.g. a version, to tag the results with")
+    report = asyncio.run(load_test(vars(parser.parse_args())))
+    sys.stdout.write(json.dumps(report) + "\n")
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import heapq
+from abc import ABCMeta, abstractmethod
+from array import array
+from bisect import bisect_left
+from typing import Iterator
+
+from search.postings import Postings, SortedArrayPostings, make_postings, union_all
+
+
+class Cursor(metaclass=ABCMeta):
+    """
+    Lazy, forward-only iterator over ascending doc IDs, which can skip ahead. current is the doc ID the cursor is on,
+    or None once it's exhausted. Cursors let a query produce its first results without evaluating the whole plan.
+    Stepping through doc IDs one at a time is the quickest way to a short page of results; reading many of them is
+    quicker a block at a time, by doc ID range, which runs the usual posting list operations on each block.
+    """
+    current: int | None = None
+
+    @abstractmethod
+    def advance(self):
+        """
+        Moves to the next doc ID.
+        :return: None
+        """
+        pass
+
+    @abstractmethod
+    def seek(self, target: int):
+        """
+        Moves to the first doc ID at or after target; stays put if the cursor is there already.
+        :param target: The doc ID to skip to.
+        :return: None
+        """
+        pass
+
+    @abstractmethod
+    def take(self, end: int) -> Postings:
+        """
+        Reads every doc ID from the current one up to end, moving to the first doc ID at or after end.
+        :param end: The doc ID to stop before.
+        :return: The doc IDs read.
+        """
+        pass
+
+    def __iter__(self) -> Iterator[int]:
+        while self.current is not None:
+            yield self.current
+            self.advance()
+
+    def blocks(self, size: int) -> Iterator[Postings]:
+        """
+        Reads the doc IDs a block at a time. The range of doc IDs each block covers grows or shrinks as it goes, to
+        keep the blocks at around size doc IDs.
+        :param size: How many doc IDs to aim for in each block.
+        :return: The non-empty blocks, in order.
+        """
+        width = size
+        while self.current is not None:
+            block = self.take(self.current + width)
+            if len(block) < size // 2:
+                width *= 2
+            elif len(block) > size * 2:
+                width = max(1, width // 2)
+            if len(block) > 0:
+                yield block
+
+
+class ArrayCursor(Cursor):
+    """
+    Cursor over a posting list, seeking by binary search over the part not yet read.
+    """
+
+    def __init__(self, postings: Postings):
+        self.ids = postings.ids if isinstance(postings, SortedArrayPostings) else array('I', postings)
+        self.position = 0
+        self.current = self.ids[0] if len(self.ids) > 0 else None
+
+    def _move(self, position: int):
+        self.position = position
+        self.current = self.ids[position] if position < len(self.ids) else None
+
+    def advance(self):
+        self._move(self.position + 1)
+
+    def seek(self, target: int):
+        if self.current is not None and self.current < target:
+            self._move(bisect_left(self.ids, target, self.position + 1))
+
+    def take(self, end: int) -> Postings:
+        if self.current is None or self.current >= end:
+            return make_postings()
+        stop = bisect_left(self.ids, end, self.position + 1)
+        block = SortedArrayPostings.of(self.ids[self.position:stop])
+        self._move(stop)
+        return block
+
+
+class UnionCursor(Cursor):
+    """
+    Cursor over the doc IDs in any of its children: a k-way merge over a heap of their current doc IDs.
+    """
+
+    def __init__(self, children: list[Cursor]):
+        self.children = children
+        self._rebuild()
+
+    def advance(self):
+        # Move every child sitting on the current doc ID, so duplicates come out once
+        current = self.current
+        while self.heap and self.heap[0][0] == current:
+            _, number = self.heap[0]
+            child = self.children[number]
+            child.advance()
+            if child.current is None:
+                heapq.heappop(self.heap)
+            else:
+                heapq.heapreplace(self.heap, (child.current, number))
+        self.current = self.heap[0][0] if self.heap else None
+
+    def _rebuild(self):
+        self.heap = [(child.current, number) for number, child in enumerate(self.children)
+                     if child.current is not None]
+        heapq.heapify(self.heap)
+        self.current = self.heap[0][0] if self.heap else None
+
+    def seek(self, target: int):
+        if self.current is None or self.current >= target:
+            return
+        for child in self.children:
+            child.seek(target)
+        self._rebuild()
+
+    def take(self, end: int) -> Postings:
+        if self.current is None or self.current >= end:
+            return make_postings()
+        block = union_all([child.take(end) for child in self.children])
+        self._rebuild()
+        return block
+
+
+class IntersectionCursor(Cursor):
+    """
+    Cursor over the doc IDs in all of its children, by leapfrogging: each child in turn seeks to the largest doc ID
+    any of them is on, until they all agree. Children should be ordered smallest-first, so the sparsest one leads.
+    """
+
+    def __init__(self, children: list[Cursor]):
+        self.children = children
+        self._realign()
+
+    def _realign(self):
+        # Every child has moved on by itself; start again from the furthest of them
+        self._align(max((child.current for child in self.children), default=None)
+                    if all(child.current is not None for child in self.children) else None)
+
+    def _align(self, target: int | None):
+        while target is not None:
+            for child in self.children:
+                child.seek(target)
+                if child.current is None:
+                    target = None
+                    break
+                if child.current != target:
+                    # Overshot: every child has to catch up with the new target
+                    target = child.current
+                    break
+            else:
+                break
+        self.current = target
+
+    def advance(self):
+        lead = self.children[0]
+        lead.advance()
+        self._align(lead.current)
+
+    def seek(self, target: int):
+        if self.current is not None and self.current < target:
+            self._align(target)
+
+    def take(self, end: int) -> Postings:
+        if self.current is None or self.current >= end:
+            return make_postings()
+        # Every child has to move past end, even once the block is known to be empty
+        block = None
+        for child in self.children:
+            doc_ids = child.take(end)
+            block = doc_ids if block is None else block.intersection(doc_ids)
+        self._realign()
+        return block
+
+
+class EmptyCursor(Cursor):
+    def advance(self):
+        pass
+
+    def seek(self, target: int):
+        pass
+
+    def take(self, end: int) -> Postings:
+        return make_postings()
+
+
+if __name__ == "__main__":
+    import random
+
+    from search.postings import make_postings
+
+    def cursor(doc_ids: list[int]) -> ArrayCursor:
+        return ArrayCursor(make_postings(doc_ids))
+
+    assert list(UnionCursor([cursor([1, 4, 9]), cursor([2, 4, 10]), cursor([])])) == [1, 2, 4, 9, 10]
+    assert list(IntersectionCursor([cursor([4, 9]), cursor([1, 2, 4, 9, 10]), cursor([4, 5, 9])])) == [4, 9]
+    assert list(IntersectionCursor([cursor([1, 2]), cursor([])])) == [] and list(EmptyCursor()) == []
+
+    generator = random.Random(1)
+    for _ in range(200):
+        sets = [set(generator.sample(range(60), generator.randrange(30))) for _ in range(4)]
+        union = UnionCursor([IntersectionCursor([cursor(sorted(sets[0])), cursor(sorted(sets[1]))]),
+                             IntersectionCursor([cursor(sorted(sets[2])), cursor(sorted(sets[3]))])])
+        expected = sorted((sets[0] & sets[1]) | (sets[2] & sets[3]))
+        target = generator.randrange(60)
+        assert list(union) == expected
+        union = UnionCursor([IntersectionCursor([cursor(sorted(sets[0])), cursor(sorted(sets[1]))]),
+                             IntersectionCursor([cursor(sorted(sets[2])), cursor(sorted(sets[3]))])])
+        assert [doc_id for block in union.blocks(generator.randrange(1, 8)) for doc_id in block] == expected
+        nested = IntersectionCursor([cursor(sorted(sets[0])), UnionCursor([cursor(sorted(s)) for s in sets[1:]])])
+        nested.seek(target)
+        assert list(nested) == [doc_id for doc_id in sorted(sets[0] & (sets[1] | sets[2] | sets[3]))
+                                if doc_id >= target]
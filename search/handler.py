@@ -1,7 +1,14 @@
+import time
 from abc import ABCMeta, abstractmethod
+from array import array
+from itertools import islice
+from typing import Iterable, Iterator
 
+from search import metrics
+from search.cursor import Cursor
 from search.exception import SearchException
-from search.index_node import IndexNode
+from search.postings import Postings, SortedArrayPostings, format_doc_ids
+from search.term_index import TermIndex
 
 
 class Response(metaclass=ABCMeta):
@@ -27,17 +34,75 @@ class FailureResponse(Response):
 
 
 class QueryResponse(Response):
-    def __init__(self, doc_ids: list[int]):
+    # How many doc IDs a streamed response formats at a time
+    CHUNK_SIZE = 4096
+
+    def __init__(self, doc_ids: Iterable[int], stream: bool = False):
         self.doc_ids = doc_ids
+        self.stream = stream
+
+    def chunks(self, size: int = CHUNK_SIZE) -> Iterator[str]:
+        """
+        Formats the response a few doc IDs at a time, reading them from doc_ids only as each chunk is needed. When
+        doc_ids is lazy, only one chunk of them is ever held in memory.
+        :param size: How many doc IDs to format per chunk.
+        :return: The pieces of the response, which join up into the same line as str() gives.
+        """
+        yield "query results "
+        separator = ""
+        for block in self._blocks(size):
+            yield separator + format_doc_ids(block)
+            separator = " "
+
+    def _blocks(self, size: int) -> Iterator[Postings]:
+        if isinstance(self.doc_ids, Cursor):
+            # Evaluated a range of doc IDs at a time, rather than one doc ID at a time
+            yield from self.doc_ids.blocks(size)
+            return
+        doc_ids = iter(self.doc_ids)
+        while True:
+            batch = array('I', islice(doc_ids, size))
+            if len(batch) == 0:
+                return
+            yield SortedArrayPostings.of(batch)
 
     def __str__(self):
-        doc_id_str = ' '.join([str(doc_id) for doc_id in self.doc_ids])
+        if self.stream:
+            return "".join(self.chunks())
+        started = time.perf_counter_ns() if metrics.enabled else 0
+        doc_id_str = format_doc_ids(self.doc_ids)
+        if started:
+            metrics.record_phase("format", time.perf_counter_ns() - started)
         return f"query results {doc_id_str}"
 
 
+class CountResponse(Response):
+    def __init__(self, count: int):
+        self.count = count
+
+    def __str__(self):
+        return f"count {self.count}"
+
+
+class MultiResponse(Response):
+    def __init__(self, responses: list[Response]):
+        self.responses = responses
+
+    def __str__(self):
+        return "\n".join(str(response) for response in self.responses)
+
+
+class ExplainResponse(Response):
+    def __init__(self, plan: str):
+        self.plan = plan
+
+    def __str__(self):
+        return f"explain {self.plan}"
+
+
 class Handler(metaclass=ABCMeta):
     @abstractmethod
-    def handle(self, index_root: IndexNode, args: list[str]) -> Response:
+    def handle(self, index_root: TermIndex, args: list[str]) -> Response:
         pass
 
 
@@ -59,5 +124,5 @@ class HandlerFactory:
     def get_handler(self, command: str) -> Handler:
         try:
             return self.handlers[command]
-        except IndexError as error:
+        except KeyError as error:
             raise SearchException(f"COMMAND_NOT_FOUND({command})")
\ No newline at end of file
@@ -1,12 +1,13 @@
 from search.handler import Handler, Response, FailureResponse, IndexResponse
-from search.index_node import IndexNode
+from search.term_index import TermIndex
+from search.postings import MAX_DOC_ID
 
 
 class IndexHandler(Handler):
-    def handle(self, root: IndexNode, args: list[str]) -> Response:
+    def handle(self, root: TermIndex, args: list[str]) -> Response:
         """
-        Handles an index request from the given args list, using the given root node.
-        :param root: The root node for the tree.
+        Handles an index request from the given args list, using the given index.
+        :param root: The index to add the document to.
         :param args: The list of arguments to process.
         :return: A Response which can be serialized.
         """
@@ -18,6 +19,8 @@ class IndexHandler(Handler):
             doc_id = int(args[0])
         except ValueError as e:
             return FailureResponse(f"SEARCH_INDEX_INVALID_DOC_ID({args[0]})")
+        if doc_id < 0 or doc_id > MAX_DOC_ID:
+            return FailureResponse(f"SEARCH_INDEX_INVALID_DOC_ID({args[0]})")
 
         # Split off the rest of the tokens
         tokens = args[1:]
@@ -25,6 +28,8 @@ class IndexHandler(Handler):
         try:
             # Add the document, and return the appropriate response.
             root.add_doc(doc_id, tokens)
+            if root.journal is not None:
+                root.journal.append(' '.join(["index"] + args))
             return IndexResponse(doc_id)
         except Exception as ex:
             return FailureResponse(str(ex))
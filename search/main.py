@@ -3,14 +3,27 @@ from __future__ import annotations
 from search.exception import SearchException
 from search.handler import HandlerFactory
 from search.index_handler import IndexHandler
-from search.index_node import IndexNode
-from search.query_handler import QueryHandler
+from search.term_index import TermIndex
+from search.query_handler import QueryHandler, ExplainHandler, MultiQueryHandler, CountHandler
 
 
-def main(argv, index):
+def register_handlers() -> HandlerFactory:
+    """
+    Registers the command handlers with the HandlerFactory, the first time it's called.
+    :return: The HandlerFactory
+    """
     handler_factory = HandlerFactory.instantiate()
-    handler_factory.register_handler("index", IndexHandler())
-    handler_factory.register_handler("query", QueryHandler())
+    if len(handler_factory.handlers) == 0:
+        handler_factory.register_handler("index", IndexHandler())
+        handler_factory.register_handler("query", QueryHandler())
+        handler_factory.register_handler("mquery", MultiQueryHandler())
+        handler_factory.register_handler("count", CountHandler())
+        handler_factory.register_handler("explain", ExplainHandler())
+    return handler_factory
+
+
+def main(argv, index):
+    handler_factory = register_handlers()
 
     if len(argv) < 2:
         raise SearchException("MISSING_ARGS")
@@ -29,10 +42,35 @@ def main(argv, index):
 
 
 if __name__ == "__main__":
-    root_index = IndexNode()
+    root_index = TermIndex()
     assert str(main(["index", "1", "soup", "tomato", "cream", "salt"], root_index)) == "index ok 1"
     assert str(main(["index", "2", "cake", "sugar", "eggs", "flour", "sugar", "cocoa", "cream", "butter"], root_index)) == "index ok 2"
     assert str(main(["index", "1", "bread", "butter", "salt"], root_index)) == "index ok 1"
     assert str(main(["index", "3", "soup", "fish", "potato", "salt", "pepper"], root_index)) == "index ok 3"
     assert str(main(["query", "(butter", "|", "potato)", "&", "salt"], root_index)) == "query results 1 3"
+    assert str(main(["query", "((butter", "|", "potato)", "&", "salt)", "&", "missing"], root_index)) == "query results "
+    assert str(main(["query", "limit=1", "offset=1", "salt"], root_index)) == "query results 3"
+    assert str(main(["query", "stream=on", "offset=1", "salt", "|", "cake"], root_index)) == "query results 2 3"
+    assert str(main(["mquery", "(butter", "|", "potato)", "&", "salt;", "salt", "&", "(potato", "|", "butter)", ";",
+                     "", ";", "(a"], root_index)) == "query results 1 3\nquery results 1 3\n" \
+           "index error SEARCH_QUERY_TOO_FEW_ARGS([''])\nindex error SEARCH_QUERY_UNCLOSED_PAREN"
+    assert str(main(["query", "limit=x", "salt"], root_index)) == "index error SEARCH_QUERY_INVALID_OPTION(limit=x)"
+    assert str(main(["query", "butter", "&", "!salt"], root_index)) == "query results 2"
+    assert str(main(["query", "-(butter", "|", "cake)"], root_index)) == "query results 3"
+    assert str(main(["query", "butter", "&", "!"], root_index)) == \
+           "index error SEARCH_QUERY_NOT_MISSING_OPERAND(butter & !)"
+    assert str(main(["query", "top", "1", "butter", "|", "cream"], root_index)) == "query results 2"
+    assert str(main(["query", "top", "5", "salt"], root_index)) == "query results 1 3"
+    assert str(main(["query", "score=tfidf", "offset=1", "top", "5", "s*"], root_index)) == "query results 3 2"
+    assert str(main(["query", "top", "2", "sugar", "&", "!butter"], root_index)) == "query results "
+    assert str(main(["query", "top", "salt"], root_index)) == "index error SEARCH_QUERY_UNKNOWN_ERROR"
+    assert str(main(["query", "score=tfidf", "salt"], root_index)) == \
+           "index error SEARCH_QUERY_INVALID_OPTION(score=tfidf)"
+    assert str(main(["count", "(butter", "|", "potato)", "&", "salt"], root_index)) == "count 2"
+    assert str(main(["count", "approx=on", "s*", "|", "cake"], root_index)) == "count 3"
+    assert str(main(["count", "salt"], root_index)) == "count 2"
+    assert str(main(["count", "missing"], root_index)) == "count 0"
+    assert str(main(["count", "limit=1", "salt"], root_index)) == "index error SEARCH_QUERY_INVALID_OPTION(limit=1)"
+    assert str(main(["explain", "(butter", "|", "potato)", "&", "salt"], root_index)) == \
+           "explain AND est=2 cost=5 (salt est=2, OR est=3 cost=3 (butter est=2, potato est=1))"
 
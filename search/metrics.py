@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import heapq
+import json
+import threading
+import time
+from collections import Counter
+from typing import Callable
+
+from search.term_index import TermIndex
+
+# Every probe checks this first, so with metrics off they cost a single global lookup
+enabled = False
+
+
+def use_metrics(enable: bool):
+    """
+    Switches the probes on or off. What they've recorded so far is kept.
+    :param enable: Whether to record metrics.
+    :return: None
+    """
+    global enabled
+    enabled = enable
+
+
+class Histogram:
+    """
+    Histogram of durations in nanoseconds, over logarithmic buckets: four per power of two, so every value is
+    reported to within a quarter of itself. Recording is a few integer operations.
+    """
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * 260
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def _bucket(value: int) -> int:
+        bits = value.bit_length()
+        if bits <= 3:
+            return value
+        # The power of two, then the two bits after the leading one
+        return (bits << 2) | ((value >> (bits - 3)) & 3)
+
+    @staticmethod
+    def _upper_bound(bucket: int) -> int:
+        if bucket < 16:
+            return bucket
+        bits = bucket >> 2
+        return (((4 | (bucket & 3)) + 1) << (bits - 3)) - 1
+
+    def record(self, value: int):
+        self.buckets[self._bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction: float) -> int:
+        """
+        Finds the value below which the given fraction of the recorded values fall.
+        :param fraction: The fraction, between 0 and 1.
+        :return: The upper bound of the bucket holding that value.
+        """
+        rank = max(1, round(fraction * self.count))
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(self._upper_bound(bucket), self.max)
+        return self.max
+
+    def json(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count / 1000, 2) if self.count > 0 else 0,
+            "p50_us": round(self.percentile(0.50) / 1000, 2),
+            "p90_us": round(self.percentile(0.90) / 1000, 2),
+            "p99_us": round(self.percentile(0.99) / 1000, 2),
+            "max_us": round(self.max / 1000, 2),
+        }
+
+
+# Latencies of whole commands, and of the phases of a query, by name
+commands = dict[str, Histogram]()
+phases = dict[str, Histogram]()
+_lock = threading.Lock()
+
+
+def _record(histograms: dict[str, Histogram], name: str, nanoseconds: int):
+    with _lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.record(nanoseconds)
+
+
+def record_command(name: str, nanoseconds: int):
+    _record(commands, name, nanoseconds)
+
+
+def record_phase(name: str, nanoseconds: int):
+    _record(phases, name, nanoseconds)
+
+
+def reset():
+    with _lock:
+        commands.clear()
+        phases.clear()
+
+
+def snapshot() -> dict:
+    """
+    Summarizes the latencies recorded so far.
+    :return: A JSON-serializable dict
+    """
+    with _lock:
+        return {
+            "enabled": enabled,
+            "commands": {name: histogram.json() for name, histogram in sorted(commands.items())},
+            "phases": {name: histogram.json() for name, histogram in sorted(phases.items())},
+        }
+
+
+def index_stats(index: TermIndex, top: int = 10) -> dict:
+    """
+    Describes the shape of an index: its structures, how long its posting lists are, and its largest terms.
+    Reads the length of every term's postings, so it's only worked out on demand, never by the probes.
+    :param index: The index to describe.
+    :param top: How many of the largest terms to list.
+    :return: A JSON-serializable dict
+    """
+    terms = 0
+    doc_ids = 0
+    # Number of terms by the bit length of their postings' length, so 1, 2-3, 4-7, ...
+    distribution = Counter[int]()
+    largest = list[tuple[int, str]]()
+    for term, length in index.posting_lengths():
+        terms += 1
+        doc_ids += length
+        distribution[length.bit_length()] += 1
+        if len(largest) < top:
+            heapq.heappush(largest, (length, term))
+        elif length > largest[0][0]:
+            heapq.heapreplace(largest, (length, term))
+    return {
+        **index.stats(),
+        "terms": terms,
+        "postings": doc_ids,
+        "posting_lengths": {f"{1 << (bits - 1)}-{(1 << bits) - 1}": count
+                            for bits, count in sorted(distribution.items())},
+        "largest_terms": [[term, length] for length, term in sorted(largest, reverse=True)],
+    }
+
+
+class Dumper(threading.Thread):
+    """
+    Background thread which appends a JSON line of metrics to a file at a fixed interval, and once more when stopped.
+    """
+
+    def __init__(self, path: str, interval: float, collect: Callable[[], dict] = snapshot):
+        super().__init__(name="metrics-dump", daemon=True)
+        self.path = path
+        self.interval = interval
+        self.collect = collect
+        self.stopped = threading.Event()
+
+    def dump(self):
+        line = json.dumps({"time": round(time.time(), 3), **self.collect()})
+        with open(self.path, "a") as out_file:
+            out_file.write(line + "\n")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.dump()
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    histogram = Histogram()
+    for value in range(1, 1001):
+        histogram.record(value * 1000)
+    assert histogram.count == 1000 and histogram.max == 1000000
+    for fraction, exact in [(0.5, 500000), (0.9, 900000), (0.99, 990000), (1.0, 1000000)]:
+        assert exact <= histogram.percentile(fraction) <= exact * 1.25
+    assert Histogram._upper_bound(Histogram._bucket(7)) == 7
+    assert all(value <= Histogram._upper_bound(Histogram._bucket(value)) < value * 1.25 + 1
+               for value in [8, 9, 100, 12345, 2 ** 40 + 1])
+    assert Histogram().json()["p99_us"] == 0
+
+    # Switched off by default; names are only created as they're recorded
+    assert not enabled and snapshot()["commands"] == {}
+    record_command("query", 2000)
+    record_phase("parse", 500)
+    assert snapshot()["commands"]["query"]["count"] == 1 and snapshot()["phases"]["parse"]["max_us"] == 0.5
+    reset()
+    assert snapshot()["phases"] == {}
+
+    root = TermIndex()
+    root.add_doc(1, ["soup", "salt"])
+    root.add_doc(2, ["cake", "salt", "sugar"])
+    root.add_doc(3, ["salt", "sugar"])
+    shape = index_stats(root, top=2)
+    assert shape["terms"] == 4 and shape["postings"] == 7 and shape["docs"] == 3
+    assert shape["posting_lengths"] == {"1-1": 2, "2-3": 2}
+    assert shape["largest_terms"] == [["salt", 3], ["sugar", 2]]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dumper = Dumper(os.path.join(tmp_dir, "metrics.jsonl"), 0.01)
+        dumper.start()
+        time.sleep(0.05)
+        dumper.stop()
+        with open(dumper.path) as in_file:
+            lines = [json.loads(line) for line in in_file]
+        assert len(lines) >= 2 and lines[-1]["commands"] == {}
@@ -0,0 +1,560 @@
+from __future__ import annotations
+
+from search.cursor import ArrayCursor, Cursor, EmptyCursor, IntersectionCursor, UnionCursor
+from search.exception import SearchQueryException
+from search.postings import Postings, make_postings, union_all
+from search.query import QueryToken
+from search.sketch import HyperLogLog
+from search.term_index import TermIndex
+
+# How many doc IDs an exact count reads at a time
+COUNT_BLOCK_SIZE = 65536
+
+# Below this cost a plan is counted exactly even when an approximate count is asked for, since reading its
+# posting lists is about as quick as merging their sketches
+APPROX_MIN_COST = 65536
+
+
+def _join(op: str, child_keys: list[str]) -> str:
+    # Operands can be reordered and repeated, except for the first child of an ANDNOT, which the rest are taken from
+    if op == 'ANDNOT':
+        return f"{op}({child_keys[0]},{','.join(sorted(set(child_keys[1:])))})"
+    return f"{op}({','.join(sorted(set(child_keys)))})"
+
+
+class PlanNode:
+    """
+    Node in a query plan: a TERM, a PREFIX standing for every term which starts with it, an AND/OR of children, or a
+    negation. A negated operand of a conjunction becomes part of an ANDNOT, whose first child is what's left once
+    the rest are taken away from it; only negations with nothing to be taken away from are a NOT of their child,
+    the complement of it within every live document.
+    Unlike the QueryToken tree, chains of the same operation are flattened into a single node with any number of
+    children, since & and | are associative, and each node carries its estimated result size and cost.
+    """
+    __slots__ = ("op", "term", "children", "estimate", "cost")
+
+    def __init__(self, op: str, term: str = None, children: list[PlanNode] = None):
+        self.op = op
+        self.term = term
+        self.children = children if children is not None else []
+        self.estimate = 0
+        self.cost = 0
+
+    def __str__(self):
+        if self.op == 'TERM':
+            return f"{self.term} est={self.estimate}"
+        if self.op == 'PREFIX':
+            return f"{self.term}* est={self.estimate}"
+        children = ', '.join(str(child) for child in self.children)
+        return f"{self.op} est={self.estimate} cost={self.cost} ({children})"
+
+    def key(self) -> str:
+        """
+        Builds a normalized form of this plan, which is the same for any ordering or repetition of operands.
+        :return: The normalized plan, as a string.
+        """
+        if self.op == 'TERM':
+            return self.term
+        if self.op == 'PREFIX':
+            return f"{self.term}*"
+        return _join(self.op, [child.key() for child in self.children])
+
+    def terms(self) -> set[str]:
+        """
+        Collects every term this plan reads. Prefixes aren't expanded, see has_prefix().
+        :return: The set of terms.
+        """
+        if self.op == 'TERM':
+            return {self.term}
+        if self.op == 'PREFIX':
+            return set()
+        return set().union(*(child.terms() for child in self.children))
+
+    def has_prefix(self) -> bool:
+        """
+        Checks whether this plan reads any prefix, whose set of terms can change without any of its terms changing.
+        :return: True if any node of the plan is a PREFIX.
+        """
+        return self.op == 'PREFIX' or any(child.has_prefix() for child in self.children)
+
+
+class CompiledQuery:
+    """
+    A query compiled from its text: the unoptimized plan, with everything the result cache needs worked out up
+    front. Compiled queries are never changed afterwards, so they can be shared by queries running side by side.
+    """
+    __slots__ = ("plan", "key", "terms", "has_prefix", "has_complement")
+
+    def __init__(self, plan: PlanNode):
+        self.plan = plan
+        self.terms = set[str]()
+        self.has_prefix = False
+        self.has_complement = False
+        self.key = self._walk(plan)
+
+    @property
+    def cacheable(self) -> bool:
+        """
+        Whether the query's results can go in the result cache: they can't be checked for staleness if a new term
+        could start matching one of its prefixes, or if they include documents none of its terms are in.
+        """
+        return not self.has_prefix and not self.has_complement
+
+    def _walk(self, node: PlanNode) -> str:
+        # Works out key(), terms(), has_prefix() and whether there's a NOT in a single pass over the plan
+        if node.op == 'TERM':
+            self.terms.add(node.term)
+            return node.term
+        if node.op == 'PREFIX':
+            self.has_prefix = True
+            return f"{node.term}*"
+        if node.op == 'NOT':
+            self.has_complement = True
+        return _join(node.op, [self._walk(child) for child in node.children])
+
+
+class SharedPlans:
+    """
+    Optimized plans merged into a DAG: every distinct subexpression, by its normalized key, is a single node, shared
+    by every plan (and every part of a plan) which has it. Executing the plans with one results dict then evaluates
+    each subexpression only once.
+    """
+    __slots__ = ("nodes",)
+
+    def __init__(self):
+        self.nodes = dict[str, PlanNode]()
+
+    def add(self, plan: PlanNode) -> PlanNode:
+        """
+        Merges a plan into the DAG. Its nodes are reused in place, so it must be a plan of its own, fresh from
+        QueryPlanner.optimize().
+        :param plan: The root of the optimized plan.
+        :return: The root of the plan within the DAG.
+        """
+        return self._intern(plan)[1]
+
+    def _intern(self, node: PlanNode) -> tuple[str, PlanNode]:
+        if node.op == 'TERM' or node.op == 'PREFIX':
+            key = node.key()
+        else:
+            children = [self._intern(child) for child in node.children]
+            key = _join(node.op, [child_key for child_key, _ in children])
+        shared = self.nodes.get(key)
+        if shared is None:
+            if node.op != 'TERM' and node.op != 'PREFIX':
+                node.children = [child for _, child in children]
+            shared = self.nodes[key] = node
+        return key, shared
+
+
+class QueryPlanner:
+    """
+    Turns a parsed query into a plan, and evaluates it against the index.
+    Conjunctions are evaluated smallest-first and stop as soon as the running intersection is empty; unknown terms
+    are treated as empty posting lists, which lets those short-circuits kick in. Negated operands of a conjunction
+    are subtracted from the rest of it, at a cost in proportion to the smaller side, rather than complemented.
+    """
+
+    OPERATIONS = {'&': 'AND', '|': 'OR'}
+
+    @staticmethod
+    def build(query: QueryToken) -> PlanNode:
+        """
+        Converts a QueryToken tree into an unoptimized plan, flattening nested chains of the same operation.
+        :param query: The root of the query tree.
+        :return: The root of the plan.
+        """
+        if query.token_type == 'LITERAL':
+            return PlanNode('TERM', term=query.token)
+        if query.token_type == 'PREFIX':
+            return PlanNode('PREFIX', term=query.token[:-1])
+        if query.token_type == 'NOT':
+            if query.right_child is None:
+                raise SearchQueryException(f"SEARCH_QUERY_NOT_MISSING_OPERAND({query})")
+            return QueryPlanner._negate(QueryPlanner.build(query.right_child))
+        if query.token_type != 'BINOP':
+            raise SearchQueryException(f"SEARCH_QUERY_EVALUATE_FAILED({query})")
+        if query.left_child is None:
+            raise SearchQueryException(f"SEARCH_QUERY_BINOP_INVALID_LVALUE({query})")
+        if query.right_child is None:
+            raise SearchQueryException(f"SEARCH_QUERY_BINOP_INVALID_RVALUE({query})")
+        node = PlanNode(QueryPlanner.OPERATIONS[query.token])
+        for child in (query.left_child, query.right_child):
+            child_node = QueryPlanner.build(child)
+            if child_node.op == node.op:
+                node.children.extend(child_node.children)
+            else:
+                node.children.append(child_node)
+        return QueryPlanner._conjoin(node.children) if node.op == 'AND' else node
+
+    @staticmethod
+    def _negate(node: PlanNode) -> PlanNode:
+        if node.op == 'NOT':
+            return node.children[0]
+        return PlanNode('NOT', children=[node])
+
+    @staticmethod
+    def _conjoin(children: list[PlanNode]) -> PlanNode:
+        # Splits a conjunction into what's included and what's excluded: a & !b & !(c | d) is a, less b, c and d.
+        # Nested ANDNOTs are unpicked the same way, so they all end up in the one node
+        included = list[PlanNode]()
+        excluded = list[PlanNode]()
+        for child in children:
+            if child.op == 'NOT':
+                negated = child.children[0]
+                excluded.extend(negated.children if negated.op == 'OR' else [negated])
+            elif child.op == 'ANDNOT':
+                first = child.children[0]
+                included.extend(first.children if first.op == 'AND' else [first])
+                excluded.extend(child.children[1:])
+            else:
+                included.append(child)
+        if len(excluded) == 0:
+            return PlanNode('AND', children=included)
+        if len(included) == 0:
+            # Nothing to take them away from: !a & !b is !(a | b)
+            return PlanNode('NOT', children=[excluded[0] if len(excluded) == 1 else PlanNode('OR', children=excluded)])
+        first = included[0] if len(included) == 1 else PlanNode('AND', children=included)
+        return PlanNode('ANDNOT', children=[first] + excluded)
+
+    @staticmethod
+    def compile(args: list[str]) -> CompiledQuery:
+        """
+        Parses a query and builds its unoptimized plan.
+        :param args: The query, split on spaces.
+        :return: The compiled query.
+        :raises: SearchQueryException if the query is malformed.
+        """
+        return CompiledQuery(QueryPlanner.build(QueryToken.parse(args)))
+
+    @staticmethod
+    def optimize(plan: PlanNode, index: TermIndex) -> PlanNode:
+        """
+        Fills in the estimated result size and cost of each node, and orders conjunctions smallest-first. Estimates
+        are never below the actual result size, so a node estimated at 0 is known to be empty and needn't be run.
+        :param plan: The root of the unoptimized plan, which is left as it is.
+        :param index: The index the plan will run against.
+        :return: The root of a new, optimized plan.
+        """
+        node = PlanNode(plan.op, term=plan.term)
+        if node.op == 'TERM':
+            postings = index.postings(node.term)
+            node.estimate = len(postings) if postings is not None else 0
+            node.cost = node.estimate
+            return node
+        if node.op == 'PREFIX':
+            # Also checks the prefix isn't too broad, before any other part of the plan runs
+            postings = index.prefix_postings(node.term)
+            node.estimate = len(postings) if postings is not None else 0
+            node.cost = node.estimate
+            return node
+        node.children = [QueryPlanner.optimize(child, index) for child in plan.children]
+        node.cost = sum(child.cost for child in node.children)
+        if node.op == 'AND':
+            node.children.sort(key=lambda child: (child.estimate, child.cost))
+            node.estimate = node.children[0].estimate
+        elif node.op == 'ANDNOT':
+            node.children[1:] = sorted(node.children[1:], key=lambda child: (child.estimate, child.cost))
+            node.estimate = node.children[0].estimate
+        elif node.op == 'NOT':
+            # Reads through every live document. Only a term's or prefix's estimate is exact: taking any other
+            # child's away could leave less than the actual complement, which may be all of the index
+            child = node.children[0]
+            exact = child.op in ('TERM', 'PREFIX')
+            node.estimate = len(index) - child.estimate if exact else len(index)
+            node.cost += len(index)
+        else:
+            node.estimate = min(sum(child.estimate for child in node.children), len(index))
+        return node
+
+    @staticmethod
+    def execute(node: PlanNode, index: TermIndex, results: dict[int, Postings] = None) -> Postings:
+        """
+        Evaluates an optimized plan.
+        :param node: The root of the plan.
+        :param index: The index to run against.
+        :param results: If given, the results of the nodes evaluated so far, by node identity; nodes found in it
+        aren't evaluated again. Used with SharedPlans, whose nodes can be reached many times over.
+        :return: The matching doc IDs.
+        """
+        if results is None:
+            return QueryPlanner._evaluate(node, index, None)
+        doc_ids = results.get(id(node))
+        if doc_ids is None:
+            doc_ids = results[id(node)] = QueryPlanner._evaluate(node, index, results)
+        return doc_ids
+
+    @staticmethod
+    def _evaluate(node: PlanNode, index: TermIndex, results: dict[int, Postings] | None) -> Postings:
+        if node.op == 'TERM':
+            postings = index.postings(node.term)
+            return postings if postings is not None else make_postings()
+        if node.op == 'PREFIX':
+            postings = index.prefix_postings(node.term)
+            return postings if postings is not None else make_postings()
+        if node.op == 'AND':
+            result = None
+            for child in node.children:
+                if child.estimate == 0:
+                    return make_postings()
+                doc_ids = QueryPlanner.execute(child, index, results)
+                result = doc_ids if result is None else result.intersection(doc_ids)
+                if len(result) == 0:
+                    break
+            return result
+        if node.op == 'OR':
+            return union_all([QueryPlanner.execute(child, index, results)
+                              for child in node.children if child.estimate > 0])
+        if node.op == 'ANDNOT':
+            result = QueryPlanner.execute(node.children[0], index, results)
+            for child in node.children[1:]:
+                if len(result) == 0:
+                    break
+                if child.estimate == 0:
+                    continue
+                if child.op == 'TERM' or child.op == 'PREFIX':
+                    # Already a posting list, whose difference costs in proportion to the smaller side
+                    removed = QueryPlanner.execute(child, index, results)
+                else:
+                    removed = QueryPlanner._within(child, result, index)
+                result = result.difference(removed)
+            return result
+        if node.op == 'NOT':
+            return index.live_docs().difference(QueryPlanner.execute(node.children[0], index, results))
+        raise SearchQueryException(f"SEARCH_QUERY_EVALUATE_FAILED({node.op})")
+
+    @staticmethod
+    def _within(node: PlanNode, doc_ids: Postings, index: TermIndex) -> Postings:
+        # Evaluates a plan only as far as it matches the given doc IDs, so a subexpression which is taken away from
+        # them costs in proportion to them, however much of the index it would match by itself
+        if len(doc_ids) == 0 or node.estimate == 0:
+            return make_postings()
+        if node.op == 'TERM' or node.op == 'PREFIX':
+            return doc_ids.intersection(QueryPlanner.execute(node, index))
+        if node.op == 'AND':
+            for child in node.children:
+                doc_ids = QueryPlanner._within(child, doc_ids, index)
+                if len(doc_ids) == 0:
+                    break
+            return doc_ids
+        if node.op == 'OR':
+            return union_all([QueryPlanner._within(child, doc_ids, index) for child in node.children])
+        if node.op == 'ANDNOT':
+            doc_ids = QueryPlanner._within(node.children[0], doc_ids, index)
+            for child in node.children[1:]:
+                doc_ids = doc_ids.difference(QueryPlanner._within(child, doc_ids, index))
+            return doc_ids
+        if node.op == 'NOT':
+            return doc_ids.difference(QueryPlanner._within(node.children[0], doc_ids, index))
+        raise SearchQueryException(f"SEARCH_QUERY_EVALUATE_FAILED({node.op})")
+
+    @staticmethod
+    def cursor(node: PlanNode, index: TermIndex) -> Cursor:
+        """
+        Evaluates an optimized plan lazily: as a tree of cursors which merge unions and leapfrog through
+        conjunctions, finding each doc ID only when it's read.
+        :param node: The root of the plan.
+        :param index: The index to run against.
+        :return: A cursor over the matching doc IDs, in ascending order.
+        """
+        if node.op == 'TERM':
+            postings = index.postings(node.term)
+            return ArrayCursor(postings) if postings is not None else EmptyCursor()
+        if node.op == 'PREFIX':
+            postings = index.prefix_postings(node.term)
+            return ArrayCursor(postings) if postings is not None else EmptyCursor()
+        if node.op == 'AND':
+            if any(child.estimate == 0 for child in node.children):
+                return EmptyCursor()
+            # The children are already smallest-first, so the sparsest one leads the leapfrog
+            return IntersectionCursor([QueryPlanner.cursor(child, index) for child in node.children])
+        if node.op == 'OR':
+            return UnionCursor([QueryPlanner.cursor(child, index) for child in node.children if child.estimate > 0])
+        if node.op == 'ANDNOT' or node.op == 'NOT':
+            # Differences are evaluated whole, and read through like any other posting list
+            doc_ids = QueryPlanner.execute(node, index)
+            return ArrayCursor(doc_ids) if len(doc_ids) > 0 else EmptyCursor()
+        raise SearchQueryException(f"SEARCH_QUERY_EVALUATE_FAILED({node.op})")
+
+    @staticmethod
+    def count(node: PlanNode, index: TermIndex) -> int:
+        """
+        Counts the doc IDs an optimized plan matches. Terms and prefixes are counted by their postings' lengths,
+        which optimizing the plan already looked up; conjunctions and unions are read through cursors a block at a
+        time, so the full result is never built.
+        :param node: The root of the plan.
+        :param index: The index to run against.
+        :return: The number of matching doc IDs.
+        """
+        if node.op in ('TERM', 'PREFIX'):
+            return node.estimate
+        return sum(len(block) for block in QueryPlanner.cursor(node, index).blocks(COUNT_BLOCK_SIZE))
+
+    @staticmethod
+    def approximate_count(node: PlanNode, index: TermIndex, min_cost: int = APPROX_MIN_COST) -> int:
+        """
+        Estimates the number of doc IDs an optimized plan matches from HyperLogLog sketches, to within a few percent.
+        Conjunctions can't be estimated from sketches without large errors, so they're counted exactly, as are
+        cheap plans and lone terms and prefixes, whose counts are known already.
+        :param node: The root of the plan.
+        :param index: The index to run against.
+        :param min_cost: The cost below which the plan is counted exactly.
+        :return: The estimated number of matching doc IDs.
+        """
+        if node.op != 'OR' or node.cost < min_cost:
+            return QueryPlanner.count(node, index)
+        # No union is larger than the sum of its parts, or the index
+        return min(QueryPlanner.sketch(node, index).estimate(), node.estimate)
+
+    @staticmethod
+    def sketch(node: PlanNode, index: TermIndex) -> HyperLogLog:
+        """
+        Builds a HyperLogLog sketch of the doc IDs an optimized plan matches. Unions merge their children's sketches;
+        terms use the ones the index keeps, and anything else is evaluated and sketched.
+        :param node: The root of the plan.
+        :param index: The index to run against.
+        :return: The sketch.
+        """
+        if node.estimate == 0:
+            return HyperLogLog()
+        if node.op == 'TERM':
+            return index.sketch(node.term)
+        if node.op == 'OR':
+            return HyperLogLog.union([QueryPlanner.sketch(child, index) for child in node.children])
+        return HyperLogLog.of(QueryPlanner.execute(node, index))
+
+    @staticmethod
+    def plan(query: QueryToken, index: TermIndex) -> PlanNode:
+        return QueryPlanner.optimize(QueryPlanner.build(query), index)
+
+
+if __name__ == "__main__":
+    import random
+
+    root = TermIndex()
+    root.add_doc(1, ["bread", "butter", "salt"])
+    root.add_doc(2, ["cake", "sugar", "eggs", "flour", "sugar", "cocoa", "cream", "butter"])
+    root.add_doc(3, ["soup", "fish", "potato", "salt", "pepper"])
+
+    query_plan = QueryPlanner.plan(QueryToken.parse(["((butter", "|", "potato)", "&", "salt)", "&", "bread"]), root)
+    assert query_plan.op == 'AND'
+    assert [child.op for child in query_plan.children] == ['TERM', 'TERM', 'OR']
+    assert [child.term for child in query_plan.children[:2]] == ["bread", "salt"]
+    assert str(query_plan) == "AND est=1 cost=6 (bread est=1, salt est=2, OR est=3 cost=3 (butter est=2, potato est=1))"
+    assert list(QueryPlanner.execute(query_plan, root)) == [1]
+    assert list(QueryPlanner.cursor(query_plan, root)) == [1]
+    assert query_plan.key() == "AND(OR(butter,potato),bread,salt)"
+    assert QueryPlanner.build(QueryToken.parse(["bread", "&", "((potato", "|", "butter)", "&", "salt)"])).key() == \
+           query_plan.key()
+    assert query_plan.terms() == {"bread", "butter", "potato", "salt"}
+
+    # Unknown terms are empty, and short-circuit the conjunction
+    query_plan = QueryPlanner.plan(QueryToken.parse(["(salt", "&", "missing)", "|", "cake"]), root)
+    assert list(QueryPlanner.execute(query_plan, root)) == [2]
+    assert list(QueryPlanner.cursor(query_plan, root)) == [2]
+    assert list(QueryPlanner.execute(QueryPlanner.plan(QueryToken.parse(["missing"]), root), root)) == []
+
+    # Prefixes expand to every term starting with them
+    query_plan = QueryPlanner.plan(QueryToken.parse(["s*", "&", "(b*|fish)"]), root)
+    assert str(query_plan) == "AND est=3 cost=6 (s* est=3, OR est=3 cost=3 (b* est=2, fish est=1))"
+    assert list(QueryPlanner.execute(query_plan, root)) == [1, 2, 3]
+    assert list(QueryPlanner.cursor(query_plan, root)) == [1, 2, 3]
+    assert query_plan.key() == "AND(OR(b*,fish),s*)" and query_plan.terms() == {"fish"} and query_plan.has_prefix()
+    assert list(QueryPlanner.execute(QueryPlanner.plan(QueryToken.parse(["x*"]), root), root)) == []
+
+    # Compiled queries are left untouched by optimizing them
+    compiled = QueryPlanner.compile(["(salt", "&", "bread)", "|", "x*"])
+    assert compiled.key == "OR(AND(bread,salt),x*)" and compiled.terms == {"bread", "salt"} and compiled.has_prefix
+    query_plan = QueryPlanner.optimize(compiled.plan, root)
+    assert [child.term for child in query_plan.children[0].children] == ["bread", "salt"]
+    assert [child.term for child in compiled.plan.children[0].children] == ["salt", "bread"]
+    assert compiled.plan.estimate == 0
+
+    # Identical subexpressions across plans, and within one, become a single node which is only evaluated once
+    shared = SharedPlans()
+    plans = [shared.add(QueryPlanner.optimize(QueryPlanner.compile(args).plan, root))
+             for args in [["(salt", "&", "bread)", "|", "cake"], ["(bread", "&", "salt)", "|", "fish"],
+                          ["(salt", "&", "bread)", "&", "(cake", "|", "(salt", "&", "bread))"]]]
+    assert plans[0].children[0] is plans[1].children[0] and plans[2].children[2] is plans[0]
+    assert len(shared.nodes) == 8
+    results = dict[int, Postings]()
+    assert [list(QueryPlanner.execute(plan, root, results)) for plan in plans] == [[1, 2], [1, 3], [1]]
+    assert len(results) == 8
+
+    # A negated operand of a conjunction is taken away from the rest of it; other negations complement their operand
+    for args, expected, key in [
+        (["salt", "&", "!bread"], [3], "ANDNOT(salt,bread)"),
+        (["-salt"], [2], "NOT(salt)"),
+        (["!salt", "&", "-fish"], [2], "NOT(OR(fish,salt))"),
+        (["(s*", "&", "!(fish", "&", "potato))", "|", "cake"], [1, 2], "OR(ANDNOT(s*,AND(fish,potato)),cake)"),
+        (["butter", "&", "!(salt", "&", "-bread)"], [1, 2], "ANDNOT(butter,ANDNOT(salt,bread))"),
+        (["(butter", "&", "!bread)", "&", "(salt", "&", "!(cake", "|", "fish))"], [],
+         "ANDNOT(AND(butter,salt),bread,cake,fish)"),
+        (["butter", "&", "!(fish", "|", "!bread)"], [1], "ANDNOT(butter,NOT(bread),fish)"),
+        (["!!salt", "&", "!!!missing"], [1, 3], "ANDNOT(salt,missing)"),
+        (["missing", "&", "!salt"], [], "ANDNOT(missing,salt)"),
+    ]:
+        compiled = QueryPlanner.compile(args)
+        assert compiled.key == key, compiled.key
+        query_plan = QueryPlanner.optimize(compiled.plan, root)
+        assert list(QueryPlanner.execute(query_plan, root)) == expected
+        assert list(QueryPlanner.cursor(query_plan, root)) == expected
+        assert QueryPlanner.count(query_plan, root) == len(expected)
+    # Complements change whenever a document is added, so only differences can go in the result cache
+    assert QueryPlanner.compile(["salt", "&", "!bread"]).cacheable
+    assert not QueryPlanner.compile(["salt", "|", "!bread"]).cacheable
+    assert str(QueryPlanner.plan(QueryToken.parse(["salt", "&", "!(bread", "|", "fish)"]), root)) == \
+           "ANDNOT est=2 cost=4 (salt est=2, bread est=1, fish est=1)"
+    assert str(QueryPlanner.plan(QueryToken.parse(["!salt"]), root)) == "NOT est=1 cost=5 (salt est=2)"
+
+    # Counting gives the lengths of the results, without building them
+    for args in [["butter"], ["s*"], ["salt", "&", "butter"], ["(salt", "|", "sugar)", "&", "b*"], ["x*", "|", "nope"]]:
+        query_plan = QueryPlanner.plan(QueryToken.parse(args), root)
+        expected = len(QueryPlanner.execute(query_plan, root))
+        assert QueryPlanner.count(query_plan, root) == expected
+        assert QueryPlanner.approximate_count(query_plan, root, min_cost=0) == expected
+
+    big = TermIndex()
+    for doc_id in range(1, 20001):
+        big.add_doc(doc_id, ["all"] + [f"mod{divisor}" for divisor in (2, 3, 5) if doc_id % divisor == 0])
+    query_plan = QueryPlanner.plan(QueryToken.parse(["(mod2", "|", "mod3)", "|", "mod5"]), big)
+    assert QueryPlanner.count(query_plan, big) == 14666
+    assert abs(QueryPlanner.approximate_count(query_plan, big, min_cost=0) - 14666) < 1500
+    # Sketches are kept up to date as documents come and go
+    for doc_id in range(20001, 30001):
+        big.add_doc(doc_id, ["mod2"])
+    for doc_id in range(1, 1001):
+        big.remove_doc(doc_id)
+    query_plan = QueryPlanner.plan(QueryToken.parse(["(mod2", "|", "mod3)", "|", "mod5"]), big)
+    assert QueryPlanner.count(query_plan, big) == 23932
+    assert abs(QueryPlanner.approximate_count(query_plan, big, min_cost=0) - 23932) < 2400
+
+    # A negation's estimate can't come from taking away a child's estimate, which may be too high: a union's is the
+    # sum of its parts. Estimating too low would skip nodes which do match
+    small = TermIndex()
+    for doc_id, tokens in [(1, ["b", "c"]), (2, ["b"]), (3, ["c"]), (4, ["x"])]:
+        small.add_doc(doc_id, tokens)
+    query_plan = QueryPlanner.plan(QueryToken.parse(["c", "|", "-(b", "|", "c)"]), small)
+    assert list(QueryPlanner.execute(query_plan, small)) == [1, 3, 4]
+    assert list(QueryPlanner.cursor(query_plan, small)) == [1, 3, 4] and QueryPlanner.count(query_plan, small) == 3
+
+    # Against the query tree evaluated as it is, with nested negations
+    generator = random.Random(1)
+
+    def random_query(depth: int) -> str:
+        if depth == 0 or generator.random() < 0.3:
+            return generator.choice(["b", "c", "x", "y", "missing", "b*"])
+        if generator.random() < 0.3:
+            return f"!({random_query(depth - 1)})"
+        return f"({random_query(depth - 1)} {generator.choice('&|')} {random_query(depth - 1)})"
+
+    small = TermIndex()
+    for doc_id in range(1, 61):
+        small.add_doc(doc_id, generator.sample(["b", "c", "x", "y", "z"], generator.randrange(1, 4)))
+    for _ in range(300):
+        args = random_query(4).split(' ')
+        expected = list(QueryToken.parse(args).evaluate(small))
+        query_plan = QueryPlanner.plan(QueryToken.parse(args), small)
+        assert list(QueryPlanner.execute(query_plan, small)) == expected, args
+        assert list(QueryPlanner.cursor(query_plan, small)) == expected, args
+        assert QueryPlanner.count(query_plan, small) == len(expected), args
@@ -0,0 +1,381 @@
+from __future__ import annotations
+
+from abc import ABCMeta, abstractmethod
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+from typing import Iterable, Iterator
+
+from search import vector
+
+# Doc IDs are stored as unsigned 32-bit integers.
+MAX_DOC_ID = 2 ** 32 - 1
+
+# Term frequencies are stored as unsigned 16-bit integers, and larger ones are capped.
+MAX_FREQUENCY = 2 ** 16 - 1
+
+
+class Postings(metaclass=ABCMeta):
+    """
+    A set of doc IDs for a single token, kept in ascending order, along with how many times the token occurs in
+    each document (its term frequency). Results of set operations are plain sets, whose frequencies are all 1.
+    Implementations must support fast membership tests and native union/intersection against the same type, so we
+    don't have to build Python sets every time a query is evaluated.
+    """
+
+    @abstractmethod
+    def add(self, doc_id: int, frequency: int = 1) -> bool:
+        pass
+
+    @abstractmethod
+    def remove(self, doc_id: int) -> bool:
+        pass
+
+    @abstractmethod
+    def union(self, other: Postings) -> Postings:
+        pass
+
+    @abstractmethod
+    def intersection(self, other: Postings) -> Postings:
+        pass
+
+    @abstractmethod
+    def difference(self, other: Postings) -> Postings:
+        pass
+
+    @abstractmethod
+    def frequency(self, doc_id: int) -> int:
+        pass
+
+    @abstractmethod
+    def __contains__(self, doc_id: int) -> bool:
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def __iter__(self) -> Iterator[int]:
+        pass
+
+    def __or__(self, other: Postings) -> Postings:
+        return self.union(other)
+
+    def __and__(self, other: Postings) -> Postings:
+        return self.intersection(other)
+
+    def __sub__(self, other: Postings) -> Postings:
+        return self.difference(other)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({list(self)})"
+
+
+class SortedArrayPostings(Postings):
+    """
+    Postings stored as a sorted array('I') of doc IDs: 4 bytes per doc ID, with O(log n) membership via bisection.
+    Doc IDs usually arrive in ascending order, so adding is normally an append. Term frequencies are a parallel
+    array('H'), tfs, which is only allocated once a doc ID is added with a frequency other than 1.
+    """
+
+    def __init__(self, doc_ids: Iterable[int] = None, presorted: bool = False):
+        if doc_ids is None:
+            self.ids = array('I')
+        elif presorted:
+            self.ids = array('I', doc_ids)
+        else:
+            self.ids = array('I', sorted(set(doc_ids)))
+        self.tfs = None
+        # An upper bound on the term frequencies, worked out when it's first asked for
+        self.max_tf = 1
+
+    def add(self, doc_id: int, frequency: int = 1) -> bool:
+        ids = self.ids
+        if frequency != 1 and self.tfs is None:
+            self.tfs = array('H', [1]) * len(ids)
+        tfs = self.tfs
+        if self.max_tf is not None:
+            self.max_tf = max(self.max_tf, min(frequency, MAX_FREQUENCY))
+        if len(ids) == 0 or ids[-1] < doc_id:
+            ids.append(doc_id)
+            if tfs is not None:
+                tfs.append(min(frequency, MAX_FREQUENCY))
+            return True
+        pos = bisect_left(ids, doc_id)
+        if ids[pos] == doc_id:
+            return False
+        ids.insert(pos, doc_id)
+        if tfs is not None:
+            tfs.insert(pos, min(frequency, MAX_FREQUENCY))
+        return True
+
+    def remove(self, doc_id: int) -> bool:
+        ids = self.ids
+        pos = bisect_left(ids, doc_id)
+        if pos < len(ids) and ids[pos] == doc_id:
+            del ids[pos]
+            if self.tfs is not None:
+                del self.tfs[pos]
+            return True
+        return False
+
+    def frequency(self, doc_id: int) -> int:
+        """
+        Looks up the term frequency of a doc ID.
+        :param doc_id: The doc ID.
+        :return: Its frequency, or 0 if it isn't in the posting list.
+        """
+        ids = self.ids
+        pos = bisect_left(ids, doc_id)
+        if pos == len(ids) or ids[pos] != doc_id:
+            return 0
+        return self.tfs[pos] if self.tfs is not None else 1
+
+    def max_frequency(self) -> int:
+        """
+        Finds an upper bound on the term frequencies, for ranking. Removing doc IDs leaves the bound as it was, so it
+        isn't always the actual maximum.
+        :return: The bound.
+        """
+        if self.max_tf is None:
+            self.max_tf = max(self.tfs, default=1)
+        return self.max_tf
+
+    def union(self, other: Postings) -> Postings:
+        if not isinstance(other, SortedArrayPostings):
+            other = SortedArrayPostings(other)
+        if len(other.ids) == 0:
+            return SortedArrayPostings(self.ids, presorted=True)
+        if len(self.ids) == 0:
+            return SortedArrayPostings(other.ids, presorted=True)
+        if vector.enabled and len(self.ids) + len(other.ids) >= vector.MIN_LENGTH:
+            return SortedArrayPostings.of(vector.union([self.ids, other.ids]))
+        # Sorting two concatenated runs is a linear merge, then adjacent duplicates are dropped.
+        return SortedArrayPostings((doc_id for doc_id, _ in groupby(sorted(self.ids + other.ids))), presorted=True)
+
+    def intersection(self, other: Postings) -> Postings:
+        if not isinstance(other, SortedArrayPostings):
+            other = SortedArrayPostings(other)
+        small, big = (self.ids, other.ids) if len(self.ids) <= len(other.ids) else (other.ids, self.ids)
+        result = SortedArrayPostings()
+        out = result.ids
+        n_small, n_big = len(small), len(big)
+        if n_small == 0:
+            return result
+        if vector.enabled and n_small >= vector.MIN_LENGTH:
+            return SortedArrayPostings.of(vector.intersection(small, big))
+        if n_small * 16 < n_big:
+            # Very skewed sizes: gallop through the big list for each doc ID of the small one.
+            lo = 0
+            for doc_id in small:
+                bound = 1
+                while lo + bound < n_big and big[lo + bound] < doc_id:
+                    bound <<= 1
+                lo = bisect_left(big, doc_id, lo, min(lo + bound + 1, n_big))
+                if lo == n_big:
+                    break
+                if big[lo] == doc_id:
+                    out.append(doc_id)
+            return result
+        # Similar sizes: linear sorted merge.
+        i = j = 0
+        while i < n_small and j < n_big:
+            a, b = small[i], big[j]
+            if a < b:
+                i += 1
+            elif b < a:
+                j += 1
+            else:
+                out.append(a)
+                i += 1
+                j += 1
+        return result
+
+    def difference(self, other: Postings) -> Postings:
+        if not isinstance(other, SortedArrayPostings):
+            other = SortedArrayPostings(other)
+        ids, removed = self.ids, other.ids
+        n_ids, n_removed = len(ids), len(removed)
+        if n_ids == 0 or n_removed == 0:
+            return SortedArrayPostings(ids, presorted=True)
+        if vector.enabled and min(n_ids, n_removed) >= vector.MIN_LENGTH:
+            return SortedArrayPostings.of(vector.difference(ids, removed))
+        result = SortedArrayPostings()
+        out = result.ids
+        if n_removed * 16 < n_ids:
+            # Only a few to remove: find each of them, and copy the runs in between them whole
+            start = 0
+            for doc_id in removed:
+                pos = bisect_left(ids, doc_id, start)
+                if pos == n_ids:
+                    break
+                if ids[pos] == doc_id:
+                    out.extend(ids[start:pos])
+                    start = pos + 1
+            out.extend(ids[start:])
+            return result
+        if n_ids * 16 < n_removed:
+            # Only a few to keep: gallop through the removed list for each of them, as intersection() does
+            lo = 0
+            for doc_id in ids:
+                bound = 1
+                while lo + bound < n_removed and removed[lo + bound] < doc_id:
+                    bound <<= 1
+                lo = bisect_left(removed, doc_id, lo, min(lo + bound + 1, n_removed))
+                if lo == n_removed or removed[lo] != doc_id:
+                    out.append(doc_id)
+            return result
+        # Similar sizes: linear sorted merge.
+        i = j = 0
+        while i < n_ids and j < n_removed:
+            a, b = ids[i], removed[j]
+            if a < b:
+                out.append(a)
+                i += 1
+            elif b < a:
+                j += 1
+            else:
+                i += 1
+                j += 1
+        out.extend(ids[i:])
+        return result
+
+    @staticmethod
+    def of(ids: array, tfs: array = None) -> SortedArrayPostings:
+        """
+        Wraps an array of unique, ascending doc IDs, without copying it.
+        :param ids: The array('I') to wrap.
+        :param tfs: The array('H') of their term frequencies, if they aren't all 1.
+        :return: The new Postings
+        """
+        postings = SortedArrayPostings()
+        postings.ids = ids
+        postings.tfs = tfs
+        postings.max_tf = 1 if tfs is None else None
+        return postings
+
+    def __contains__(self, doc_id: int) -> bool:
+        ids = self.ids
+        pos = bisect_left(ids, doc_id)
+        return pos < len(ids) and ids[pos] == doc_id
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+
+# The posting list type used for new index entries; swap it out with use_postings_type().
+_postings_type: type = SortedArrayPostings
+
+
+def use_postings_type(postings_type: type):
+    """
+    Selects the Postings implementation used for newly created posting lists.
+    :param postings_type: A subclass of Postings.
+    :return: None
+    """
+    global _postings_type
+    if not issubclass(postings_type, Postings):
+        raise TypeError(f"{postings_type} is not a Postings type")
+    _postings_type = postings_type
+
+
+def make_postings(doc_ids: Iterable[int] = None, presorted: bool = False) -> Postings:
+    """
+    Creates a new posting list of the currently selected type.
+    :param doc_ids: Optional doc IDs to fill it with, in any order.
+    :param presorted: Whether doc_ids are already unique and in ascending order.
+    :return: The new Postings
+    """
+    return _postings_type(doc_ids, presorted=presorted)
+
+
+def union_all(postings: list[Postings], disjoint: bool = False) -> Postings:
+    """
+    Unions any number of posting lists in one pass, rather than one pair at a time.
+    :param postings: The posting lists to union.
+    :param disjoint: Whether the posting lists are known not to share any doc IDs, so duplicates needn't be removed.
+    Disjoint unions keep the term frequencies, since no doc ID can have two.
+    :return: The new Postings
+    """
+    postings = [doc_ids for doc_ids in postings if len(doc_ids) > 0]
+    if len(postings) == 0:
+        return make_postings()
+    if len(postings) == 1:
+        return postings[0]
+    if all(isinstance(doc_ids, SortedArrayPostings) for doc_ids in postings):
+        if disjoint and any(doc_ids.tfs is not None for doc_ids in postings):
+            return _union_frequencies(postings)
+        if vector.enabled and sum(len(doc_ids) for doc_ids in postings) >= vector.MIN_LENGTH:
+            return SortedArrayPostings.of(vector.union([doc_ids.ids for doc_ids in postings], disjoint))
+        merged = array('I')
+        for doc_ids in postings:
+            merged.extend(doc_ids.ids)
+        if disjoint:
+            return SortedArrayPostings(sorted(merged), presorted=True)
+        return SortedArrayPostings((doc_id for doc_id, _ in groupby(sorted(merged))), presorted=True)
+    result = postings[0]
+    for doc_ids in postings[1:]:
+        result = result.union(doc_ids)
+    return result
+
+
+def _union_frequencies(postings: list[SortedArrayPostings]) -> SortedArrayPostings:
+    ids = [doc_ids.ids for doc_ids in postings]
+    tfs = [doc_ids.tfs if doc_ids.tfs is not None else array('H', [1]) * len(doc_ids) for doc_ids in postings]
+    if vector.enabled and sum(len(doc_ids) for doc_ids in ids) >= vector.MIN_LENGTH:
+        return SortedArrayPostings.of(*vector.union_frequencies(ids, tfs))
+    pairs = sorted(zip((doc_id for doc_ids in ids for doc_id in doc_ids), (tf for part in tfs for tf in part)))
+    return SortedArrayPostings.of(array('I', (doc_id for doc_id, _ in pairs)), array('H', (tf for _, tf in pairs)))
+
+
+def format_doc_ids(doc_ids: Iterable[int]) -> str:
+    """
+    Formats doc IDs for a response: in decimal, separated by spaces.
+    :param doc_ids: The doc IDs.
+    :return: The formatted doc IDs.
+    """
+    if isinstance(doc_ids, SortedArrayPostings) and vector.enabled and len(doc_ids) >= vector.MIN_LENGTH:
+        return vector.format_doc_ids(doc_ids.ids)
+    return ' '.join(map(str, doc_ids))
+
+
+if __name__ == "__main__":
+    a = make_postings([5, 1, 3, 9])
+    b = make_postings([3, 4, 5])
+    assert list(a) == [1, 3, 5, 9]
+    assert 3 in a and 4 not in a
+    assert list(a | b) == [1, 3, 4, 5, 9]
+    assert list(a & b) == [3, 5]
+    assert a.add(7) and not a.add(7)
+    assert a.remove(1) and not a.remove(1)
+    assert list(a) == [3, 5, 7, 9]
+    big = make_postings(range(0, 1000, 2))
+    assert list(big & make_postings([4, 5, 998])) == [4, 998]
+    assert list(make_postings([0, 999]) & big) == [0]
+    assert list(a - b) == [7, 9] and list(b - a) == [4] and list(a - make_postings()) == [3, 5, 7, 9]
+    assert list(big - make_postings([0, 5, 500, 998, 2000]))[:3] == [2, 4, 6]
+    assert len(big - make_postings([0, 998])) == 498
+    assert list(make_postings([3, 4, 5, 999]) - big) == [3, 5, 999]
+    assert list(big - make_postings(range(0, 1000, 4))) == list(range(2, 1000, 4))
+    assert list(union_all([a, b, make_postings([2]), make_postings()])) == [2, 3, 4, 5, 7, 9]
+
+    # Term frequencies follow their doc IDs, and are only stored once one isn't 1
+    assert a.tfs is None and a.frequency(3) == 1 and a.frequency(4) == 0
+    assert a.add(4, frequency=3) and list(a.tfs) == [1, 3, 1, 1, 1]
+    assert a.add(1, frequency=2) and a.remove(5) and list(a.tfs) == [2, 1, 3, 1, 1]
+    assert a.frequency(4) == 3 and a.frequency(9) == 1 and (a | b).tfs is None
+    assert a.max_frequency() == 3 and b.max_frequency() == 1
+    disjoint = union_all([make_postings([6, 10]), a], disjoint=True)
+    assert list(disjoint) == [1, 3, 4, 6, 7, 9, 10] and list(disjoint.tfs) == [2, 1, 3, 1, 1, 1, 1]
+    for enable in [False, True]:
+        vector.use_numpy(enable)
+        halves = [SortedArrayPostings.of(array('I', range(start, 1000, 2)), array('H', range(start, 1000, 2)))
+                  for start in (0, 1)]
+        merged = union_all(halves, disjoint=True)
+        assert list(merged) == list(range(1000)) and list(merged.tfs) == list(range(1000))
+        assert merged.max_frequency() == 999
+    vector.use_numpy(True)
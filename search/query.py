@@ -1,22 +1,50 @@
 from __future__ import annotations
 
+import re
+
 from search.exception import SearchQueryException
-from search.index_node import IndexNode
+from search.term_index import TermIndex
+from search.postings import Postings, make_postings
+
+
+# One match per token, skipping spaces: a symbol, a literal (alphanumeric, as str.isalnum() has it, with a trailing *
+# for a prefix) running up to the next symbol or space, or else whatever runs up to there instead. '-' only negates
+# at the start of an operand, so a-b is still one (invalid) chunk
+_TOKENS = re.compile(r"([()&|!]|(?<![^\s()&|!-])-)|([^\W_]+\*?)(?![^\s()&|])|([^\s()&|]+)")
+_INVALID_CHAR = re.compile(r"[^\w*]|_")
 
 
 class QueryToken:
-    def __init__(self, token: str):
+    """
+    Node of a parsed query: a literal or prefix, a binary operation with both of its operands as children, or a
+    negation (! or -) with its operand as its right child.
+    """
+    __slots__ = ("token", "token_type", "left_child", "right_child")
+
+    # Token types which stand for a set of documents, and so can be an operand
+    OPERANDS = ('LITERAL', 'PREFIX', 'BINOP', 'NOT')
+    OPERATORS = ('&', '|')
+    NEGATIONS = ('!', '-')
+
+    def __init__(self, token: str, token_type: str = None):
         self.token = token
         self.left_child = None
         self.right_child = None
-        if token in ['&', '|']:
+        if token_type is not None:
+            # Already classified by the parser
+            self.token_type = token_type
+        elif token in QueryToken.OPERATORS:
             self.token_type = 'BINOP'
+        elif token in QueryToken.NEGATIONS:
+            self.token_type = 'NOT'
         elif token == '(':
             self.token_type = 'LPAREN'
         elif token == ')':
             self.token_type = 'RPAREN'
         elif token.isalnum():
             self.token_type = 'LITERAL'
+        elif token.endswith('*') and token[:-1].isalnum():
+            self.token_type = 'PREFIX'
         else:
             raise SearchQueryException(f"SEARCH_QUERY_TOKEN_INVALID({token})")
 
@@ -39,113 +67,109 @@ class QueryToken:
     def get_right_child(self):
         return self.right_child
 
-    def evaluate(self, tree: IndexNode) -> list[int]:
+    def evaluate(self, index: TermIndex) -> Postings:
         if self.token_type == 'LITERAL':
-            return tree.get_doc_ids_containing_token(self.token)
+            # Unknown tokens match no documents
+            postings = index.postings(self.token)
+            return postings if postings is not None else make_postings()
+        if self.token_type == 'PREFIX':
+            postings = index.prefix_postings(self.token[:-1])
+            return postings if postings is not None else make_postings()
+        if self.token_type == 'NOT':
+            if self.right_child is None:
+                raise SearchQueryException(f"SEARCH_QUERY_NOT_MISSING_OPERAND({self})")
+            return index.live_docs().difference(self.right_child.evaluate(index))
         if self.token_type == 'BINOP':
             if self.left_child is None:
                 raise SearchQueryException(f"SEARCH_QUERY_BINOP_INVALID_LVALUE({self})")
             if self.right_child is None:
                 raise SearchQueryException(f"SEARCH_QUERY_BINOP_INVALID_RVALUE({self})")
-            lvalue = self.left_child.evaluate(tree)
-            rvalue = self.right_child.evaluate(tree)
+            lvalue = self.left_child.evaluate(index)
+            rvalue = self.right_child.evaluate(index)
             if self.token == '|':
-                return list(set(lvalue) | set(rvalue))
+                return lvalue.union(rvalue)
             if self.token == '&':
-                return list(set(lvalue) & set(rvalue))
+                return lvalue.intersection(rvalue)
         raise SearchQueryException(f"SEARCH_QUERY_EVALUATE_FAILED({self})")
 
     @staticmethod
     def parse(args: list[str]) -> QueryToken:
-        # Tokenize
-        tokens = []
-        for chunk in args:
-            for token in QueryToken.tokenize(chunk):
-                tokens.append(token)
-
-        # Build an AST query
-        return QueryToken.build_tree(tokens)
-
-    @staticmethod
-    def tokenize(chunk) -> list[QueryToken]:
-        tokens = []
-        curr_literal = ""
-        for char in chunk:
-            if char in ["(", ")", "|", "&"]:
-                if len(curr_literal) > 0:
-                    tokens.append(QueryToken(curr_literal))
-                    curr_literal = ""
-                tokens.append(QueryToken(char))
-            elif char.isalnum():
-                curr_literal += char
-            else:
-                raise SearchQueryException(f"SEARCH_QUERY_INVALID_CHUNK({chunk})")
-        # If we hit the end of the chunk and still have some accumulated literal values:
-        if len(curr_literal) > 0:
-            tokens.append(QueryToken(curr_literal))
-        return tokens
-
-    @staticmethod
-    def build_tree(tokens: list[QueryToken]):
-        paren_levels = [[]]
-        for token in tokens:
-            if token.token_type == 'LPAREN':
+        """
+        Parses a query in a single pass: one regex scan splits the whole query into symbols and literals, and the
+        tree is built as they come in, with a list of pending operands and operators per open parenthesis.
+        :param args: The query, split on spaces.
+        :return: The root of the query tree.
+        :raises: SearchQueryException if the query is malformed.
+        """
+        text = ' '.join(args)
+        levels = [[]]
+        clause = levels[0]
+        for symbol, literal, invalid in _TOKENS.findall(text):
+            if literal:
+                QueryToken._push(clause, QueryToken(literal, 'PREFIX' if literal[-1] == '*' else 'LITERAL'))
+            elif symbol == '(':
                 # Jump down to the next level of parentheses
-                paren_levels.append(list[QueryToken]())
-            elif token.token_type == 'BINOP' or token.token_type == 'LITERAL':
-                # Add to the current row
-                paren_levels[len(paren_levels) - 1].append(token)
-            elif token.token_type == 'RPAREN':
-                # End the current row and move it up
-                if len(paren_levels) == 0:
+                clause = []
+                levels.append(clause)
+            elif symbol == ')':
+                if len(levels) == 1:
                     raise SearchQueryException("SEARCH_QUERY_UNEXPECTED_RPAREN")
-                # Get the clause composed of all the tokens we wrote into the current paren level
-                clause = paren_levels.pop()
-                if len(clause) == 0:
-                    # Handle empty parentheses
-                    continue
-                if len(clause) == 1:
-                    # Handle a single-token clause
-                    if clause[0].token_type == 'LITERAL' or clause[0].token_type == 'BINOP':
-                        # Move up as-is
-                        paren_levels[len(paren_levels) - 1].append(clause[0])
-                        continue
-                if len(clause) != 3:
-                    # Handle too many/few tokens inside parentheses (error!)
-                    raise SearchQueryException(f"SEARCH_QUERY_INVALID_CLAUSE({clause})")
-                if clause[1].token_type != "BINOP":
-                    # Handle missing binary operation
-                    raise SearchQueryException(f"SEARCH_QUERY_MISSING_OPERATION({clause})")
-                if clause[0].token_type != "LITERAL" and clause[0].node_type != "BINOP":
-                    # Handle invalid lvalue
-                    raise SearchQueryException(f"SEARCH_QUERY_LVALUE_INVALID({clause})")
-                if clause[2].token_type != "LITERAL" and clause[2].node_type != "BINOP":
-                    # Handle invalid rvalue
-                    raise SearchQueryException(f"SEARCH_QUERY_RVALUE_INVALID({clause})")
-                # We have a valid binary operation, let's add it to the tree
-                op = clause[1]
-                op.left_child = clause[0]
-                op.right_child = clause[2]
-                paren_levels[len(paren_levels) - 1].append(op)
-
-        if len(paren_levels) > 1:
-            # If we still have
+                # End the current level, and move its clause up as a single operand
+                levels.pop()
+                reduced = QueryToken._reduce(clause) if len(clause) > 0 else None
+                clause = levels[-1]
+                if reduced is not None:
+                    QueryToken._push(clause, reduced)
+            elif symbol in QueryToken.NEGATIONS:
+                clause.append(QueryToken('!', 'NOT'))
+            elif symbol:
+                clause.append(QueryToken(symbol, 'BINOP'))
+            elif _INVALID_CHAR.search(invalid):
+                # Report the whole space-separated chunk the character is in
+                chunk = next(chunk for chunk in args if invalid in chunk)
+                raise SearchQueryException(f"SEARCH_QUERY_INVALID_CHUNK({chunk})")
+            else:
+                # Only alphanumerics and *, but with the * out of place
+                raise SearchQueryException(f"SEARCH_QUERY_TOKEN_INVALID({invalid})")
+        if len(levels) > 1:
             raise SearchQueryException("SEARCH_QUERY_UNCLOSED_PAREN")
-
         # Now that we've gotten everything to [ a OP b ] or [ a ], we can make the final tree.
-        final_clause = paren_levels[0]
-        if len(final_clause) == 1:
-            # For [ a ], just return a.
-            return final_clause[0]
-        if len(final_clause) == 3:
-            # For [ a OP b ], return OP(a, b).
-            op = final_clause[1]
-            op.left_child = final_clause[0]
-            op.right_child = final_clause[2]
-            return op
-        # Everything else throws an error.
+        if len(clause) == 1:
+            return QueryToken._reduce(clause)
+        if len(clause) == 3 and clause[1].token_type == 'BINOP':
+            return QueryToken._reduce(clause)
         raise SearchQueryException("SEARCH_QUERY_UNKNOWN_ERROR")
 
+    @staticmethod
+    def _push(clause: list[QueryToken], operand: QueryToken):
+        # A negation takes the operand straight after it, and is then an operand itself, for any negation before it
+        while len(clause) > 0 and clause[-1].token_type == 'NOT' and clause[-1].right_child is None:
+            negation = clause.pop()
+            negation.right_child = operand
+            operand = negation
+        clause.append(operand)
+
+    @staticmethod
+    def _reduce(clause: list[QueryToken]) -> QueryToken:
+        # Turn the tokens of a parenthesized clause, [ a ] or [ a OP b ], into a single operand
+        for token in clause:
+            if token.token_type == 'NOT' and token.right_child is None:
+                raise SearchQueryException(f"SEARCH_QUERY_NOT_MISSING_OPERAND({' '.join(map(str, clause))})")
+        if len(clause) == 1:
+            return clause[0]
+        if len(clause) != 3:
+            raise SearchQueryException(f"SEARCH_QUERY_INVALID_CLAUSE({' '.join(map(str, clause))})")
+        lvalue, op, rvalue = clause
+        if op.token_type != 'BINOP':
+            raise SearchQueryException(f"SEARCH_QUERY_MISSING_OPERATION({' '.join(map(str, clause))})")
+        if lvalue.token_type not in QueryToken.OPERANDS:
+            raise SearchQueryException(f"SEARCH_QUERY_LVALUE_INVALID({' '.join(map(str, clause))})")
+        if rvalue.token_type not in QueryToken.OPERANDS:
+            raise SearchQueryException(f"SEARCH_QUERY_RVALUE_INVALID({' '.join(map(str, clause))})")
+        op.left_child = lvalue
+        op.right_child = rvalue
+        return op
+
 
 if __name__ == "__main__":
     root = QueryToken.parse(["(A", "&", "B)", "|", "C"])
@@ -169,3 +193,41 @@ if __name__ == "__main__":
     assert root.right_child.left_child is None
     assert root.right_child.right_child is None
 
+    root = QueryToken.parse(["sal*", "&", "(fish|pep*)"])
+    assert root.left_child.token_type == 'PREFIX' and root.right_child.right_child.token_type == 'PREFIX'
+    for bad in ["*", "s*a", "sa**"]:
+        try:
+            QueryToken.parse([bad])
+            assert False
+        except SearchQueryException as error:
+            assert str(error) == f"SEARCH_QUERY_TOKEN_INVALID({bad})"
+    for bad, expected in [("a)", "SEARCH_QUERY_UNEXPECTED_RPAREN"), ("(a & b", "SEARCH_QUERY_UNCLOSED_PAREN"),
+                          ("(a b)", "SEARCH_QUERY_INVALID_CLAUSE(a b)"),
+                          ("(a b c)", "SEARCH_QUERY_MISSING_OPERATION(a b c)"),
+                          ("a & b & c", "SEARCH_QUERY_UNKNOWN_ERROR"),
+                          ("(a & b & c) | d", "SEARCH_QUERY_INVALID_CLAUSE(a & b & c)"),
+                          ("a_b", "SEARCH_QUERY_INVALID_CHUNK(a_b)"), ("(x|a-b)", "SEARCH_QUERY_INVALID_CHUNK((x|a-b))")]:
+        try:
+            QueryToken.parse(bad.split(' '))
+            assert False
+        except SearchQueryException as error:
+            assert str(error) == expected
+    # Negations bind tighter than either operator, and can be stacked
+    root = QueryToken.parse(["a", "&", "!b"])
+    assert root.token == "&" and root.right_child.token_type == 'NOT' and root.right_child.right_child.token == "b"
+    root = QueryToken.parse(["-(a", "|", "b*)", "&", "!", "-c"])
+    assert root.left_child.token_type == 'NOT' and root.left_child.right_child.token == "|"
+    assert root.right_child.right_child.token_type == 'NOT' and root.right_child.right_child.right_child.token == "c"
+    assert QueryToken.parse(["--a"]).right_child.right_child.token == "a"
+    for bad, expected in [("!", "SEARCH_QUERY_NOT_MISSING_OPERAND(!)"),
+                          ("(a & -)", "SEARCH_QUERY_NOT_MISSING_OPERAND(a & !)"),
+                          ("! & a", "SEARCH_QUERY_NOT_MISSING_OPERAND(! & a)"),
+                          ("a!", "SEARCH_QUERY_INVALID_CHUNK(a!)"),
+                          ("a -b", "SEARCH_QUERY_UNKNOWN_ERROR")]:
+        try:
+            QueryToken.parse(bad.split(' '))
+            assert False
+        except SearchQueryException as error:
+            assert str(error) == expected, str(error)
+    # Empty parentheses are ignored, and so is extra spacing
+    assert str(QueryToken.parse(["()", "", "(sa*", "|", "b)", "&", "c"])) == "&"
@@ -1,23 +1,227 @@
+from __future__ import annotations
+
+import time
+from array import array
+from itertools import islice
+from typing import Iterable
+
+from search import metrics
+from search.cache import PlanCache, QueryCache
 from search.exception import SearchQueryException
-from search.handler import Handler, Response, FailureResponse, QueryResponse
-from search.index_node import IndexNode
-from search.query import QueryToken
+from search.handler import Handler, Response, FailureResponse, QueryResponse, ExplainResponse, MultiResponse, \
+    CountResponse
+from search.planner import CompiledQuery, PlanNode, QueryPlanner, SharedPlans
+from search.postings import Postings, SortedArrayPostings
+from search.ranking import SCORERS, top
+from search.term_index import TermIndex
+
+
+class QueryOptions:
+    """
+    Options given as key=value arguments ahead of a query's expression. The results are in ascending doc ID order,
+    so limit and offset page through them consistently; stream=on writes them out in chunks as they're found.
+    Following the options with "top <k>" ranks the results instead, and keeps only the k best, best first; score=
+    picks how they're ranked, by bm25 (the default) or tfidf. Counts take approx=on instead, to estimate large unions
+    from sketches.
+    """
+    __slots__ = ("limit", "offset", "stream", "approx", "top", "score")
+
+    def __init__(self, limit: int | None = None, offset: int = 0, stream: bool = False, approx: bool = False,
+                 top: int | None = None, score: str | None = None):
+        self.limit = limit
+        self.offset = offset
+        self.stream = stream
+        self.approx = approx
+        self.top = top
+        self.score = score
+
+    @property
+    def paged(self) -> bool:
+        return self.limit is not None or self.offset > 0
+
+    def page(self, doc_ids: Iterable[int]) -> Iterable[int]:
+        """
+        Skips to the offset and stops at the limit, without reading any further into doc_ids than that.
+        :param doc_ids: The doc IDs, in ascending order or, when ranked, best first.
+        :return: The doc IDs on the page.
+        """
+        stop = self.offset + self.limit if self.limit is not None else None
+        if isinstance(doc_ids, SortedArrayPostings):
+            return SortedArrayPostings.of(doc_ids.ids[self.offset:stop])
+        return islice(doc_ids, self.offset, stop)
+
+    @staticmethod
+    def parse(args: list[str], keys: tuple[str, ...] = ("limit", "offset", "stream")) -> tuple[QueryOptions, list[str]]:
+        """
+        Splits the options off the front of a query's arguments. Tokens can't contain '=', so the first argument
+        without one starts the expression; if the command takes score=, that can be "top" and a number instead, as
+        long as there's an expression after them.
+        :param args: The query's arguments, split on spaces.
+        :param keys: The options the command takes.
+        :return: The options, and the remaining arguments.
+        :raises: SearchQueryException if an option is unknown or has an invalid value.
+        """
+        options = QueryOptions()
+        count = 0
+        for arg in args:
+            key, equals, value = arg.partition('=')
+            if not equals:
+                break
+            if key not in keys:
+                raise SearchQueryException(f"SEARCH_QUERY_INVALID_OPTION({arg})")
+            if key in ("limit", "offset") and value.isascii() and value.isdigit():
+                setattr(options, key, int(value))
+            elif key in ("stream", "approx") and value in ("on", "off"):
+                setattr(options, key, value == "on")
+            elif key == "score" and value in SCORERS:
+                options.score = value
+            else:
+                raise SearchQueryException(f"SEARCH_QUERY_INVALID_OPTION({arg})")
+            count += 1
+        rest = args[count:]
+        if "score" in keys and len(rest) > 2 and rest[0] == "top" and rest[1].isascii() and rest[1].isdigit():
+            options.top = int(rest[1])
+            rest = rest[2:]
+        elif options.score is not None:
+            raise SearchQueryException(f"SEARCH_QUERY_INVALID_OPTION(score={options.score})")
+        return options, rest
 
 
 class QueryHandler(Handler):
-    def handle(self, root: IndexNode, args: list[str]) -> Response:
+    def handle(self, root: TermIndex, args: list[str]) -> Response:
+        try:
+            options, args = QueryOptions.parse(args, keys=("limit", "offset", "stream", "score"))
+            if len(args) < 1:
+                return FailureResponse(f"SEARCH_QUERY_TOO_FEW_ARGS({args})")
+
+            # Compile the query, unless the same text has been compiled before
+            started = time.perf_counter_ns() if metrics.enabled else 0
+            compiled = PlanCache.instantiate().compile(args)
+            if started:
+                parsed = time.perf_counter_ns()
+                metrics.record_phase("parse", parsed - started)
+
+            if options.top is not None:
+                # Ranked results are few, and depend on every document's length, so they aren't cached
+                plan = QueryPlanner.optimize(compiled.plan, root)
+                ranked = top(plan, root, options.top, SCORERS[options.score or "bm25"](root))
+                if options.paged:
+                    ranked = list(options.page(ranked))
+                if started:
+                    metrics.record_phase("evaluate", time.perf_counter_ns() - parsed)
+                return QueryResponse(ranked, stream=options.stream)
+
+            # Reuse the cached results if the query (or an equivalent one) has been run since its tokens changed.
+            # A term can start matching a prefix at any time, and a new document can start matching a negation, so
+            # queries with either can't be checked for staleness; the index keeps the unions of broad prefixes up to
+            # date itself
+            cache = QueryCache.instantiate()
+            results = cache.get(compiled.key, root) if compiled.cacheable else None
+            if results is None:
+                # Plan the query against the index, then run the plan and give out our responses
+                plan = QueryPlanner.optimize(compiled.plan, root)
+                if options.paged or options.stream:
+                    # Only find as many results as are read: up to the end of the page, or a chunk at a time.
+                    # These partial results can't go in the cache
+                    results = QueryPlanner.cursor(plan, root)
+                else:
+                    results = QueryPlanner.execute(plan, root)
+                    if compiled.cacheable:
+                        cache.put(compiled.key, compiled.terms, root, results)
+            if options.paged:
+                results = options.page(results)
+                if not options.stream and not isinstance(results, SortedArrayPostings):
+                    results = SortedArrayPostings.of(array('I', results))
+            if started:
+                metrics.record_phase("evaluate", time.perf_counter_ns() - parsed)
+
+            # Return the response.
+            return QueryResponse(results, stream=options.stream)
+
+        except SearchQueryException as ex:
+            return FailureResponse(str(ex))
+
+
+class MultiQueryHandler(Handler):
+    """
+    Runs several queries, separated by ';', in one go, answering each with its own line. Their plans are merged
+    into a single DAG in which identical subexpressions are one node, so a subexpression shared by several of the
+    queries is only evaluated once.
+    """
+
+    def handle(self, root: TermIndex, args: list[str]) -> Response:
         if len(args) < 1:
             return FailureResponse(f"SEARCH_QUERY_TOO_FEW_ARGS({args})")
 
+        expressions = ' '.join(args).split(';')
+        responses: list[Response | None] = [None] * len(expressions)
+        cache = QueryCache.instantiate()
+        plans = SharedPlans()
+        pending = list[tuple[int, CompiledQuery, PlanNode]]()
+        for number, expression in enumerate(expressions):
+            expression_args = expression.strip().split(' ')
+            if expression_args == [""]:
+                responses[number] = FailureResponse(f"SEARCH_QUERY_TOO_FEW_ARGS({expression_args})")
+                continue
+            try:
+                compiled = PlanCache.instantiate().compile(expression_args)
+                results = cache.get(compiled.key, root) if compiled.cacheable else None
+                if results is not None:
+                    responses[number] = QueryResponse(results)
+                else:
+                    pending.append((number, compiled, plans.add(QueryPlanner.optimize(compiled.plan, root))))
+            except SearchQueryException as ex:
+                responses[number] = FailureResponse(str(ex))
+
+        # Run the merged plans, sharing the results of every node between them
+        results = dict[int, Postings]()
+        for number, compiled, plan in pending:
+            try:
+                doc_ids = QueryPlanner.execute(plan, root, results)
+            except SearchQueryException as ex:
+                responses[number] = FailureResponse(str(ex))
+                continue
+            if compiled.cacheable:
+                cache.put(compiled.key, compiled.terms, root, doc_ids)
+            responses[number] = QueryResponse(doc_ids)
+        return MultiResponse(responses)
+
+
+class CountHandler(Handler):
+    """
+    Counts the documents a query matches, without building the list of them, let alone formatting it. With
+    approx=on, large unions are estimated from HyperLogLog sketches of their terms instead of being read.
+    """
+
+    def handle(self, root: TermIndex, args: list[str]) -> Response:
         try:
-            # Parse the args list into a query
-            query = QueryToken.parse(args)
+            options, args = QueryOptions.parse(args, keys=("approx",))
+            if len(args) < 1:
+                return FailureResponse(f"SEARCH_QUERY_TOO_FEW_ARGS({args})")
 
-            # Apply the query tree to the index and give out our responses
-            results = query.evaluate(root)
+            compiled = PlanCache.instantiate().compile(args)
+            # The query's results may be cached already, from an earlier query
+            results = QueryCache.instantiate().get(compiled.key, root) if compiled.cacheable else None
+            if results is not None:
+                return CountResponse(len(results))
+            plan = QueryPlanner.optimize(compiled.plan, root)
+            if options.approx:
+                return CountResponse(QueryPlanner.approximate_count(plan, root))
+            return CountResponse(QueryPlanner.count(plan, root))
 
-            # Return the response.
-            return QueryResponse(results)
+        except SearchQueryException as ex:
+            return FailureResponse(str(ex))
+
+
+class ExplainHandler(Handler):
+    def handle(self, root: TermIndex, args: list[str]) -> Response:
+        if len(args) < 1:
+            return FailureResponse(f"SEARCH_QUERY_TOO_FEW_ARGS({args})")
+
+        try:
+            # Compile and plan the query, without running it
+            plan = QueryPlanner.optimize(PlanCache.instantiate().compile(args).plan, root)
+            return ExplainResponse(str(plan))
 
         except SearchQueryException as ex:
             return FailureResponse(str(ex))
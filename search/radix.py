@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+from typing import Iterator
+
+
+class RadixNode:
+    """
+    Node in a compressed radix tree of terms, used for prefix lookups over the term dictionary.
+    Each edge holds a whole run of characters instead of a single one, so a vocabulary only needs roughly one node
+    per term, and __slots__ keeps each node down to a few fields. Every node counts the terms at or below it, so
+    the number of terms with a given prefix is known without walking them.
+    """
+    __slots__ = ("label", "children", "terminal", "count")
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.children = None
+        self.terminal = False
+        self.count = 0
+
+    def insert(self, term: str) -> bool:
+        """
+        Adds a term to the tree, splitting edges as necessary.
+        :param term: The term to add.
+        :return: True if the term was not already in the tree.
+        """
+        if self.find_exact(term) is not None:
+            return False
+        node, rest = self, term
+        node.count += 1
+        while rest:
+            child = node.children.get(rest[0]) if node.children else None
+            if child is None:
+                leaf = RadixNode(rest)
+                leaf.terminal = True
+                leaf.count = 1
+                if node.children is None:
+                    node.children = dict[str, RadixNode]()
+                node.children[rest[0]] = leaf
+                return True
+            label = child.label
+            common = _common_prefix_length(label, rest)
+            if common < len(label):
+                # Split the edge at the point where the term diverges
+                split = RadixNode(label[:common])
+                split.count = child.count
+                child.label = label[common:]
+                split.children = {child.label[0]: child}
+                node.children[rest[0]] = split
+                child = split
+            node, rest = child, rest[common:]
+            node.count += 1
+        node.terminal = True
+        return True
+
+    def find_exact(self, term: str) -> RadixNode | None:
+        """
+        Finds the node of a term in the tree.
+        :param term: The term to look up.
+        :return: The term's node, or None if the term isn't in the tree.
+        """
+        node, rest = self, term
+        while rest:
+            child = node.children.get(rest[0]) if node.children else None
+            if child is None or not rest.startswith(child.label):
+                return None
+            node, rest = child, rest[len(child.label):]
+        return node if node.terminal else None
+
+    def remove(self, term: str) -> bool:
+        """
+        Removes a term from the tree, merging edges left with a single child.
+        :param term: The term to remove.
+        :return: True if the term was in the tree.
+        """
+        path = []
+        node, rest = self, term
+        while rest:
+            child = node.children.get(rest[0]) if node.children else None
+            if child is None or not rest.startswith(child.label):
+                return False
+            path.append(node)
+            node, rest = child, rest[len(child.label):]
+        if not node.terminal:
+            return False
+        node.terminal = False
+        node.count -= 1
+        for ancestor in path:
+            ancestor.count -= 1
+        # Prune or compress the nodes we've left behind, from the bottom up
+        while path and not node.terminal:
+            parent = path.pop()
+            if node.children:
+                if len(node.children) == 1:
+                    (only_child,) = node.children.values()
+                    only_child.label = node.label + only_child.label
+                    parent.children[only_child.label[0]] = only_child
+                break
+            del parent.children[node.label[0]]
+            if not parent.children:
+                parent.children = None
+            node = parent
+        return True
+
+    def find(self, prefix: str) -> tuple[RadixNode, str] | None:
+        """
+        Finds the highest node whose path starts with the given prefix.
+        :param prefix: The prefix to look up.
+        :return: The node and the full path leading to it, or None if no term has this prefix.
+        """
+        node, rest, path = self, prefix, ""
+        while rest:
+            child = node.children.get(rest[0]) if node.children else None
+            if child is None:
+                return None
+            label = child.label
+            if rest.startswith(label):
+                rest = rest[len(label):]
+            elif label.startswith(rest):
+                rest = ""
+            else:
+                return None
+            node, path = child, path + label
+        return node, path
+
+    def iter_terms(self, path: str = "") -> Iterator[str]:
+        """
+        Iterates over all terms at or below this node, in sorted order.
+        :param path: The full path leading to this node.
+        :return: An iterator of terms.
+        """
+        stack = [(self, path)]
+        while stack:
+            node, path = stack.pop()
+            if node.terminal:
+                yield path
+            if node.children:
+                for char in sorted(node.children, reverse=True):
+                    child = node.children[char]
+                    stack.append((child, path + child.label))
+
+    def node_count(self) -> int:
+        """
+        Counts the nodes at or below this node.
+        :return: The number of nodes.
+        """
+        count = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            count += 1
+            if node.children:
+                stack.extend(node.children.values())
+        return count
+
+    def count_prefix(self, prefix: str) -> int:
+        """
+        Counts the terms starting with the given prefix.
+        :param prefix: The prefix to look up.
+        :return: The number of terms.
+        """
+        found = self.find(prefix)
+        return found[0].count if found is not None else 0
+
+    def iter_prefix(self, prefix: str) -> Iterator[str]:
+        """
+        Iterates over all terms starting with the given prefix, in sorted order.
+        :param prefix: The prefix to look up.
+        :return: An iterator of terms.
+        """
+        found = self.find(prefix)
+        if found is None:
+            return iter(())
+        node, path = found
+        return node.iter_terms(path)
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+if __name__ == "__main__":
+    root = RadixNode()
+    for word in ["soup", "sour", "so", "salt", "sugar", "cream"]:
+        assert root.insert(word)
+    assert not root.insert("so")
+    assert list(root.iter_prefix("so")) == ["so", "soup", "sour"]
+    assert list(root.iter_prefix("s")) == ["salt", "so", "soup", "sour", "sugar"]
+    assert list(root.iter_prefix("sou")) == ["soup", "sour"]
+    assert list(root.iter_prefix("x")) == []
+    assert root.remove("so") and not root.remove("so")
+    assert not root.remove("sou")
+    assert list(root.iter_prefix("so")) == ["soup", "sour"]
+    assert root.count == 5 and root.count_prefix("s") == 4 and root.count_prefix("sou") == 2
+    assert root.count_prefix("x") == 0 and root.count_prefix("") == 5
+    # The root, "cream", "s", "alt", "ugar", "ou", "p" and "r"
+    assert root.node_count() == 8
+    assert root.remove("soup") and root.remove("sour")
+    assert list(root.iter_terms()) == ["cream", "salt", "sugar"]
+    assert root.children["s"].label == "s"
@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import heapq
+import math
+from abc import ABCMeta, abstractmethod
+
+from search.cursor import ArrayCursor
+from search.planner import PlanNode, QueryPlanner
+from search.postings import MAX_FREQUENCY, Postings, SortedArrayPostings
+from search.term_index import TermIndex
+
+
+class Scorer(metaclass=ABCMeta):
+    """
+    Scores how well a document matches each term of a query, from how often the term occurs in it, how many
+    documents the term is in, and the document's length against the average. A document's score is the sum of the
+    scores of the query's terms it contains; the terms it doesn't contain score nothing.
+    """
+
+    def __init__(self, index: TermIndex):
+        self.docs = len(index)
+        self.average_length = index.average_doc_length() or 1.0
+
+    @abstractmethod
+    def weight(self, matches: int) -> float:
+        """
+        Weighs a term by how rare it is.
+        :param matches: The number of documents the term is in.
+        :return: The term's weight, which is always positive.
+        """
+        pass
+
+    @abstractmethod
+    def norm(self, length: int) -> float:
+        """
+        Works out the part of a document's scores which depends on its length, once for all its terms.
+        :param length: The document's length.
+        :return: The length norm.
+        """
+        pass
+
+    @abstractmethod
+    def score(self, weight: float, frequency: int, norm: float) -> float:
+        """
+        Scores one term of one document.
+        :param weight: The term's weight.
+        :param frequency: How many times the term occurs in the document.
+        :param norm: The document's length norm.
+        :return: The score.
+        """
+        pass
+
+    def bound(self, weight: float, max_frequency: int) -> float:
+        """
+        Finds the highest score the term can give any document: scores only grow with the term's frequency, and
+        only shrink with the document's length, which is at least 1.
+        :param weight: The term's weight.
+        :param max_frequency: The term's highest frequency in any document.
+        :return: The upper bound.
+        """
+        return self.score(weight, max_frequency, self.norm(1))
+
+
+class BM25Scorer(Scorer):
+    """
+    Okapi BM25: a term's score saturates as its frequency grows, at a rate set by k1, and b sets how much longer
+    documents are penalized.
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def weight(self, matches: int) -> float:
+        return math.log(1 + (self.docs - matches + 0.5) / (matches + 0.5))
+
+    def norm(self, length: int) -> float:
+        return self.K1 * (1 - self.B + self.B * length / self.average_length)
+
+    def score(self, weight: float, frequency: int, norm: float) -> float:
+        return weight * frequency * (self.K1 + 1) / (frequency + norm)
+
+
+class TfIdfScorer(Scorer):
+    """
+    Classic TF-IDF: a logarithmically damped term frequency, times the term's inverse document frequency, divided by
+    the square root of the document's length.
+    """
+
+    def weight(self, matches: int) -> float:
+        return math.log(1 + self.docs / matches)
+
+    def norm(self, length: int) -> float:
+        return math.sqrt(length)
+
+    def score(self, weight: float, frequency: int, norm: float) -> float:
+        return weight * (1 + math.log(frequency)) / norm
+
+
+SCORERS: dict[str, type[Scorer]] = {"bm25": BM25Scorer, "tfidf": TfIdfScorer}
+
+
+class _ScoredTerm:
+    # A query term being ranked by: its posting list, read through a cursor, and its weight and score bound
+    __slots__ = ("cursor", "tfs", "weight", "bound")
+
+    def __init__(self, postings: Postings, scorer: Scorer, frequencies: bool):
+        self.cursor = ArrayCursor(postings)
+        if not frequencies:
+            self.tfs = None
+            max_frequency = 1
+        elif isinstance(postings, SortedArrayPostings):
+            self.tfs = postings.tfs
+            max_frequency = postings.max_frequency()
+        else:
+            self.tfs = None
+            max_frequency = MAX_FREQUENCY
+        self.weight = scorer.weight(len(postings))
+        self.bound = scorer.bound(self.weight, max_frequency)
+
+    def frequency(self) -> int:
+        # The term's frequency in the doc ID the cursor is on
+        return self.tfs[self.cursor.position] if self.tfs is not None else 1
+
+
+def _scored_leaves(node: PlanNode, leaves: dict[str, PlanNode]):
+    # Collects the terms and prefixes a match can contain, leaving out those it's only required not to contain
+    if node.op in ('TERM', 'PREFIX'):
+        leaves.setdefault(node.key(), node)
+    elif node.op == 'ANDNOT':
+        _scored_leaves(node.children[0], leaves)
+    elif node.op != 'NOT':
+        for child in node.children:
+            _scored_leaves(child, leaves)
+
+
+def _push(heap: list[tuple[float, int]], k: int, score: float, doc_id: int) -> float:
+    # Keeps the k best (score, doc ID) pairs seen, with ties going to the lowest doc ID, and returns the score a doc
+    # ID has to beat to get in from now on
+    entry = (score, -doc_id)
+    if len(heap) < k:
+        heapq.heappush(heap, entry)
+    elif entry > heap[0]:
+        heapq.heapreplace(heap, entry)
+    return heap[0][0] if len(heap) == k else -1.0
+
+
+def top(node: PlanNode, index: TermIndex, k: int, scorer: Scorer) -> list[int]:
+    """
+    Finds the k best matches of an optimized plan, by the sum of their terms' scores, without scoring every match.
+    A prefix scores as a single term which every document it matches contains once.
+    A single term or a disjunction of terms is ranked by MaxScore: with the terms in ascending order of their upper
+    bounds, those whose bounds add up to no more than the k-th best score so far can't get a document into the top k
+    on their own, so only the other terms' cursors are read for candidates, and the rest are only seeked to score
+    them. Any other plan is evaluated first, and its matches scored against the terms a match can contain, stopping
+    early on any match whose score can no longer reach the top k.
+    :param node: The root of the plan.
+    :param index: The index to run against.
+    :param k: How many matches to find.
+    :param scorer: The scorer to rank them by.
+    :return: The doc IDs of the best matches, best first; equal scores are in ascending doc ID order.
+    """
+    if k <= 0 or node.estimate == 0:
+        return []
+    leaves = dict[str, PlanNode]()
+    _scored_leaves(node, leaves)
+    terms = list[_ScoredTerm]()
+    for leaf in leaves.values():
+        postings = index.postings(leaf.term) if leaf.op == 'TERM' else index.prefix_postings(leaf.term)
+        if postings is not None and len(postings) > 0:
+            terms.append(_ScoredTerm(postings, scorer, frequencies=leaf.op == 'TERM'))
+    if node.op in ('TERM', 'PREFIX') or node.op == 'OR' and all(child.op in ('TERM', 'PREFIX')
+                                                             for child in node.children):
+        heap = _max_score(terms, index, k, scorer)
+    else:
+        heap = _rank(QueryPlanner.execute(node, index), terms, index, k, scorer)
+    return [-negated for _, negated in sorted(heap, reverse=True)]
+
+
+def _max_score(terms: list[_ScoredTerm], index: TermIndex, k: int, scorer: Scorer) -> list[tuple[float, int]]:
+    terms.sort(key=lambda term: term.bound)
+    # bounds[i] is the highest score terms[0..i] can give a document together
+    bounds = list[float]()
+    for term in terms:
+        bounds.append(term.bound + (bounds[-1] if bounds else 0.0))
+    heap = list[tuple[float, int]]()
+    threshold = -1.0
+    # terms[:essential] can't get a document into the top k without one of terms[essential:], whose cursors are
+    # merged through a queue of their current doc IDs
+    essential = 0
+    queue = [(term.cursor.current, position) for position, term in enumerate(terms) if term.cursor.current is not None]
+    heapq.heapify(queue)
+    while queue:
+        doc_id = queue[0][0]
+        norm = scorer.norm(index.doc_length(doc_id))
+        score = 0.0
+        while queue and queue[0][0] == doc_id:
+            term = terms[queue[0][1]]
+            score += scorer.score(term.weight, term.frequency(), norm)
+            term.cursor.advance()
+            if term.cursor.current is None:
+                heapq.heappop(queue)
+            else:
+                heapq.heapreplace(queue, (term.cursor.current, queue[0][1]))
+        for position in range(essential - 1, -1, -1):
+            if score + bounds[position] <= threshold:
+                break
+            term = terms[position]
+            term.cursor.seek(doc_id)
+            if term.cursor.current == doc_id:
+                score += scorer.score(term.weight, term.frequency(), norm)
+        if score <= threshold:
+            continue
+        threshold = _push(heap, k, score, doc_id)
+        if essential < len(terms) and bounds[essential] <= threshold:
+            while essential < len(terms) and bounds[essential] <= threshold:
+                essential += 1
+            queue = [entry for entry in queue if entry[1] >= essential]
+            heapq.heapify(queue)
+    return heap
+
+
+def _rank(doc_ids: Postings, terms: list[_ScoredTerm], index: TermIndex, k: int,
+          scorer: Scorer) -> list[tuple[float, int]]:
+    terms.sort(key=lambda term: term.bound, reverse=True)
+    # remaining[i] is the highest score terms[i:] can add to a document
+    remaining = [0.0] * (len(terms) + 1)
+    for position in range(len(terms) - 1, -1, -1):
+        remaining[position] = remaining[position + 1] + terms[position].bound
+    heap = list[tuple[float, int]]()
+    threshold = -1.0
+    for doc_id in doc_ids:
+        if remaining[0] <= threshold:
+            # No match from here on can score higher
+            break
+        norm = scorer.norm(index.doc_length(doc_id))
+        score = 0.0
+        for position, term in enumerate(terms):
+            if score + remaining[position] <= threshold:
+                break
+            term.cursor.seek(doc_id)
+            if term.cursor.current == doc_id:
+                score += scorer.score(term.weight, term.frequency(), norm)
+        else:
+            threshold = _push(heap, k, score, doc_id)
+    return heap
+
+
+if __name__ == "__main__":
+    import random
+
+    from search.query import QueryToken
+
+    def ranked(text: str, index: TermIndex, k: int, scorer: Scorer) -> list[int]:
+        return top(QueryPlanner.plan(QueryToken.parse(text.split(' ')), index), index, k, scorer)
+
+    def exhaustive(text: str, index: TermIndex, k: int, scorer: Scorer) -> list[int]:
+        # Scores every match, for comparison
+        plan = QueryPlanner.plan(QueryToken.parse(text.split(' ')), index)
+        leaves = dict[str, PlanNode]()
+        _scored_leaves(plan, leaves)
+        scores = []
+        for doc_id in QueryPlanner.execute(plan, index):
+            score = 0.0
+            for leaf in leaves.values():
+                postings = index.postings(leaf.term) if leaf.op == 'TERM' else index.prefix_postings(leaf.term)
+                if postings is not None and doc_id in postings:
+                    frequency = postings.frequency(doc_id) if leaf.op == 'TERM' else 1
+                    norm = scorer.norm(index.doc_length(doc_id))
+                    score += scorer.score(scorer.weight(len(postings)), frequency, norm)
+            scores.append((score, -doc_id))
+        return [-negated for _, negated in sorted(scores, reverse=True)[:k]]
+
+    small = TermIndex()
+    small.add_doc(1, ["butter", "flour", "eggs", "milk"])
+    small.add_doc(2, ["butter", "butter", "sugar", "flour"])
+    small.add_doc(3, ["sugar", "salt"])
+    small.add_doc(4, ["salt", "pepper", "oil", "vinegar", "garlic", "lemon"])
+    bm25 = BM25Scorer(small)
+    # Doc 2 has butter twice, and sugar besides
+    assert ranked("butter | sugar", small, 1, bm25) == [2]
+    assert ranked("butter | sugar", small, 10, bm25) == [2, 3, 1]
+    assert ranked("butter & !sugar", small, 10, bm25) == [1]
+    assert ranked("salt", small, 10, bm25) == [3, 4], "the shorter document ranks first"
+    assert ranked("nothing | nowhere", small, 3, bm25) == [] and ranked("salt", small, 0, bm25) == []
+
+    generator = random.Random(1)
+    vocabulary = [f"w{number}" for number in range(200)]
+    large = TermIndex()
+    for doc_id in range(3000):
+        # Zipf-like: low-numbered words are far more common, and often repeated
+        large.add_doc(doc_id, [vocabulary[min(int(generator.paretovariate(0.8)) - 1, 199)]
+                               for _ in range(generator.randrange(1, 30))])
+    for scorer in [BM25Scorer(large), TfIdfScorer(large)]:
+        for text in ["w0", "w0 | w7", "(w0 | w1) | (w3 | w40)", "w1 & (w2 | w9)", "(w0 | w5) & !w1", "w1*",
+                     "w199* | w0"]:
+            for k in [1, 10, 100]:
+                assert ranked(text, large, k, scorer) == exhaustive(text, large, k, scorer), (text, k)
+
+    # Every match of a negation is ranked, even when the union it negates has an estimate too high to subtract
+    negated = TermIndex()
+    for doc_id, tokens in [(1, ["b", "c"]), (2, ["b"]), (3, ["c"]), (4, ["x"])]:
+        negated.add_doc(doc_id, tokens)
+    assert ranked("-(b | c)", negated, 5, BM25Scorer(negated)) == [4]
+    for text in ["!(w0 | w1)", "(w2 | !(w0 | w3)) & !(w1 & w5)", "!(w0 & !(w1 | w2))", "w7 | !((w0 | w1) | w2)"]:
+        expected = list(QueryToken.parse(text.split(' ')).evaluate(large))
+        assert sorted(ranked(text, large, len(large), BM25Scorer(large))) == expected, text
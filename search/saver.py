@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import gc
+import os
+import sys
+import time
+import traceback
+from typing import Callable
+
+
+class BackgroundSave:
+    """
+    Writes a file from a forked child process, so the parent carries on running commands while it's written.
+    The child sees the index exactly as it was when it was forked: the operating system shares the parent's memory
+    with it, and only copies a page once the parent changes it. The write function is expected to write to
+    path + ".tmp" and rename it over path once it's complete, so a crash never leaves a partial file behind.
+    Where fork isn't available (Windows), the file is written straight away instead, before the constructor returns.
+    """
+
+    def __init__(self, name: str, path: str, write: Callable[[], None]):
+        self.name = name
+        self.path = path
+        self.started = time.monotonic()
+        self.finished = None
+        self.ok = None
+        self.pid = None
+        if not hasattr(os, "fork"):
+            self._finish(self._run(write))
+            return
+        # Anything still buffered would otherwise be written out twice, once by each process
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Keep the garbage collector away from every object that exists now, until the save is done. A full
+        # collection writes to each object it visits, which would copy nearly every page of the index
+        gc.freeze()
+        pid = os.fork()
+        if pid == 0:
+            # Commands come first: the child only gets the CPU time they leave over
+            os.nice(19)
+            os._exit(0 if self._run(write) else 1)
+        self.pid = pid
+
+    @staticmethod
+    def _run(write: Callable[[], None]) -> bool:
+        try:
+            write()
+            return True
+        except BaseException:
+            traceback.print_exc()
+            sys.stderr.flush()
+            return False
+
+    def _finish(self, ok: bool):
+        self.ok = ok
+        self.finished = time.monotonic()
+
+    def poll(self, block: bool = False) -> bool:
+        """
+        Checks whether the child has finished, without waiting for it unless block is set.
+        :param block: Whether to wait for the child to finish.
+        :return: True once the save has finished, whether or not it succeeded (see ok).
+        """
+        if self.ok is not None:
+            return True
+        pid, status = os.waitpid(self.pid, 0 if block else os.WNOHANG)
+        if pid == 0:
+            return False
+        gc.unfreeze()
+        self._finish(os.waitstatus_to_exitcode(status) == 0)
+        return True
+
+    def status(self) -> str:
+        """
+        Describes the save's progress: how long it's been running and how much of the file it has written so far.
+        :return: The status, e.g. "snapshot running 1.2s 1048576 bytes".
+        """
+        if not self.poll():
+            try:
+                written = os.path.getsize(f"{self.path}.tmp")
+            except OSError:
+                written = 0
+            return f"{self.name} running {time.monotonic() - self.started:.1f}s {written} bytes"
+        elapsed = f"{self.finished - self.started:.1f}s"
+        if not self.ok:
+            return f"{self.name} failed {elapsed}"
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        return f"{self.name} done {elapsed} {size} bytes"
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    def write_slowly(path: str, content: bytes):
+        with open(f"{path}.tmp", "wb") as out_file:
+            out_file.write(content)
+            out_file.flush()
+            time.sleep(0.2)
+        os.replace(f"{path}.tmp", path)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        target = os.path.join(tmp_dir, "out")
+        # The child writes what it saw when it was forked, whatever the parent does afterwards
+        payload = bytearray(b"before")
+        save = BackgroundSave("test", target, lambda: write_slowly(target, bytes(payload)))
+        payload[:] = b"after!"
+        if save.pid is not None:
+            assert save.status().startswith("test running ")
+        assert save.poll(block=True) and save.ok
+        assert save.status().startswith("test done ") and save.status().endswith(" 6 bytes")
+        with open(target, "rb") as in_file:
+            assert in_file.read() == b"before"
+
+        def fail():
+            raise OSError("disk full")
+
+        sys.stderr = open(os.devnull, "w")
+        save = BackgroundSave("test", target, fail)
+        assert save.poll(block=True) and not save.ok and save.status().startswith("test failed ")
+        sys.stderr = sys.__stderr__
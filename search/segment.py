@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator
+
+from search.exception import SearchIndexException
+from search.postings import Postings, SortedArrayPostings
+
+# On-disk segment layout (all integers little-endian):
+#
+#   header        MAGIC, version, term count, doc count, then the byte offset of each section below
+#   term offsets  uint32[term count + 1], offsets of each term within the term data
+#   term data     UTF-8 terms, concatenated in sorted (bytewise) order
+#   post offsets  uint64[term count + 1], offsets of each posting block within the posting data
+#   post data     one block per term: its doc IDs as packed, ascending uint32
+#   doc IDs       uint32[doc count], ascending
+#   doc offsets   uint32[doc count + 1], offsets of each document's term list within the doc data
+#   doc data      uint32 term ordinals for each document (the forward index)
+#   freq offsets  uint64[term count + 1], offsets of each frequency block within the frequency data
+#   freq data     one block per term: the term frequencies of its doc IDs as uint16, or nothing if they're all 1
+#
+# Version 1 segments end at the doc data, and every term frequency in them is 1.
+MAGIC = b"SRCHSEG\0"
+VERSION = 2
+_PREAMBLE = struct.Struct("<8sI")
+_HEADERS = {1: struct.Struct("<8sIII7Q"), 2: struct.Struct("<8sIII9Q")}
+_HEADER = _HEADERS[VERSION]
+
+
+class SegmentReader:
+    """
+    Read-only view over a segment file, opened with mmap.
+    Opening a segment only reads the header; terms are found by binary search over the sorted term dictionary, and
+    posting lists are only decoded when they're asked for, so a segment of any size is queryable right away.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path, "rb") as in_file:
+                self._mmap = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as ex:
+            raise SearchIndexException(f"SEARCH_SEGMENT_OPEN_FAILED({path})") from ex
+        try:
+            magic, version = _PREAMBLE.unpack_from(self._mmap, 0)
+            if magic != MAGIC:
+                raise SearchIndexException(f"SEARCH_SEGMENT_INVALID({path})")
+            if version not in _HEADERS:
+                raise SearchIndexException(f"SEARCH_SEGMENT_UNSUPPORTED_VERSION({version})")
+            header = _HEADERS[version].unpack_from(self._mmap, 0)
+        except struct.error as ex:
+            raise SearchIndexException(f"SEARCH_SEGMENT_INVALID({path})") from ex
+        _, _, self.term_count, self.doc_count, *offsets = header
+        (term_offsets, self._term_data, post_offsets, self._post_data,
+         doc_ids, doc_offsets, self._doc_data) = offsets[:7]
+        self._term_offsets = self._view(term_offsets, 'I', self.term_count + 1)
+        self._post_offsets = self._view(post_offsets, 'Q', self.term_count + 1)
+        self._doc_ids = self._view(doc_ids, 'I', self.doc_count)
+        self._doc_offsets = self._view(doc_offsets, 'I', self.doc_count + 1)
+        self._freq_offsets = None
+        if version >= 2:
+            freq_offsets, self._freq_data = offsets[7:]
+            self._freq_offsets = self._view(freq_offsets, 'Q', self.term_count + 1)
+        # Every document's distinct terms, added up
+        self.token_count = self._doc_offsets[self.doc_count]
+
+    def _view(self, offset: int, typecode: str, count: int):
+        size = array(typecode).itemsize
+        raw = memoryview(self._mmap)[offset:offset + size * count]
+        if sys.byteorder == "little":
+            return raw.cast(typecode)
+        # Big-endian hosts have to decode a swapped copy instead of viewing the file directly
+        values = array(typecode, raw)
+        values.byteswap()
+        return values
+
+    def close(self):
+        for view in (self._term_offsets, self._post_offsets, self._doc_ids, self._doc_offsets, self._freq_offsets):
+            if isinstance(view, memoryview):
+                view.release()
+        self._mmap.close()
+
+    def _term_bytes(self, ordinal: int) -> bytes:
+        start = self._term_data + self._term_offsets[ordinal]
+        end = self._term_data + self._term_offsets[ordinal + 1]
+        return self._mmap[start:end]
+
+    def term(self, ordinal: int) -> str:
+        return self._term_bytes(ordinal).decode("utf-8")
+
+    def _lower_bound(self, key: bytes) -> int:
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_term(self, term: str) -> int:
+        """
+        Finds the ordinal of a term in the sorted term dictionary.
+        :param term: The term to look up.
+        :return: The term's ordinal, or -1 if it isn't in the segment.
+        """
+        key = term.encode("utf-8")
+        ordinal = self._lower_bound(key)
+        if ordinal < self.term_count and self._term_bytes(ordinal) == key:
+            return ordinal
+        return -1
+
+    def prefix_range(self, prefix: str) -> range:
+        """
+        Finds the ordinals of all terms starting with the given prefix.
+        :param prefix: The prefix to look up.
+        :return: A range of term ordinals.
+        """
+        key = prefix.encode("utf-8")
+        start = self._lower_bound(key)
+        end = start
+        while end < self.term_count and self._term_bytes(end).startswith(key):
+            end += 1
+        return range(start, end)
+
+    def terms(self) -> Iterator[str]:
+        return (self.term(ordinal) for ordinal in range(self.term_count))
+
+    def postings_length(self, ordinal: int) -> int:
+        return (self._post_offsets[ordinal + 1] - self._post_offsets[ordinal]) // 4
+
+    def postings(self, ordinal: int) -> Postings:
+        """
+        Decodes the posting list for a term.
+        :param ordinal: The term's ordinal.
+        :return: A new, mutable Postings with the term's doc IDs.
+        """
+        start = self._post_data + self._post_offsets[ordinal]
+        end = self._post_data + self._post_offsets[ordinal + 1]
+        ids = array('I')
+        ids.frombytes(self._mmap[start:end])
+        if sys.byteorder != "little":
+            ids.byteswap()
+        tfs = None
+        if self._freq_offsets is not None and self._freq_offsets[ordinal + 1] > self._freq_offsets[ordinal]:
+            tfs = array('H')
+            tfs.frombytes(self._mmap[self._freq_data + self._freq_offsets[ordinal]:
+                                     self._freq_data + self._freq_offsets[ordinal + 1]])
+            if sys.byteorder != "little":
+                tfs.byteswap()
+        return SortedArrayPostings.of(ids, tfs)
+
+    def doc_ids(self) -> Iterator[int]:
+        return iter(self._doc_ids)
+
+    def doc_length(self, doc_id: int) -> int:
+        """
+        Counts the terms of a document, without decoding them.
+        :param doc_id: The document ID.
+        :return: The document's number of terms, or 0 if it isn't in the segment.
+        """
+        pos = bisect_left(self._doc_ids, doc_id)
+        if pos == self.doc_count or self._doc_ids[pos] != doc_id:
+            return 0
+        return self._doc_offsets[pos + 1] - self._doc_offsets[pos]
+
+    def doc_terms(self, doc_id: int) -> tuple[str, ...] | None:
+        """
+        Looks up the terms of a document, using the forward index stored in the segment.
+        :param doc_id: The document ID.
+        :return: The document's terms, or None if it isn't in the segment.
+        """
+        pos = bisect_left(self._doc_ids, doc_id)
+        if pos == self.doc_count or self._doc_ids[pos] != doc_id:
+            return None
+        start = self._doc_data + self._doc_offsets[pos] * 4
+        end = self._doc_data + self._doc_offsets[pos + 1] * 4
+        ordinals = array('I')
+        ordinals.frombytes(self._mmap[start:end])
+        if sys.byteorder != "little":
+            ordinals.byteswap()
+        return tuple(sys.intern(self.term(ordinal)) for ordinal in ordinals)
+
+
+def _align(out_file) -> int:
+    # Sections start on 8-byte boundaries, so the offset tables can be viewed in place
+    padding = -out_file.tell() % 8
+    out_file.write(bytes(padding))
+    return out_file.tell()
+
+
+def _write_array(out_file, values: array):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    values.tofile(out_file)
+
+
+def write_segment(path: str, postings: Iterable[tuple[str, Postings]], doc_tokens: Iterable[tuple[int, Iterable[str]]]):
+    """
+    Writes a segment file. The file is written next to the destination and renamed over it once complete.
+    :param path: The destination path.
+    :param postings: (term, postings) pairs for every term, in any order.
+    :param doc_tokens: (doc_id, tokens) pairs for every document, in any order.
+    :return: None
+    """
+    entries = sorted(((term.encode("utf-8"), doc_ids) for term, doc_ids in postings if len(doc_ids) > 0),
+                     key=lambda entry: entry[0])
+    ordinals = {term: ordinal for ordinal, (term, _) in enumerate(entries)}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(bytes(_HEADER.size))
+        offsets = []
+
+        # Term dictionary
+        term_offsets = array('I', [0])
+        for term, _ in entries:
+            term_offsets.append(term_offsets[-1] + len(term))
+        offsets.append(_align(out_file))
+        _write_array(out_file, term_offsets)
+        offsets.append(_align(out_file))
+        for term, _ in entries:
+            out_file.write(term)
+
+        # Posting blocks
+        post_offsets = array('Q', [0])
+        for _, doc_ids in entries:
+            post_offsets.append(post_offsets[-1] + 4 * len(doc_ids))
+        offsets.append(_align(out_file))
+        _write_array(out_file, post_offsets)
+        offsets.append(_align(out_file))
+        for _, doc_ids in entries:
+            _write_array(out_file, doc_ids.ids if isinstance(doc_ids, SortedArrayPostings) else array('I', doc_ids))
+
+        # Forward index
+        docs = sorted(doc_tokens, key=lambda doc: doc[0])
+        doc_ids = array('I', (doc_id for doc_id, _ in docs))
+        doc_offsets = array('I', [0])
+        doc_data = array('I')
+        for _, tokens in docs:
+            doc_data.extend(ordinals[token.encode("utf-8")] for token in tokens)
+            doc_offsets.append(len(doc_data))
+        offsets.append(_align(out_file))
+        _write_array(out_file, doc_ids)
+        offsets.append(_align(out_file))
+        _write_array(out_file, doc_offsets)
+        offsets.append(_align(out_file))
+        _write_array(out_file, doc_data)
+
+        # Term frequencies, for the terms which have any other than 1
+        frequencies = [doc_ids.tfs if isinstance(doc_ids, SortedArrayPostings) and doc_ids.tfs is not None and
+                       doc_ids.tfs.count(1) < len(doc_ids.tfs) else None for _, doc_ids in entries]
+        freq_offsets = array('Q', [0])
+        for tfs in frequencies:
+            freq_offsets.append(freq_offsets[-1] + (2 * len(tfs) if tfs is not None else 0))
+        offsets.append(_align(out_file))
+        _write_array(out_file, freq_offsets)
+        offsets.append(_align(out_file))
+        for tfs in frequencies:
+            if tfs is not None:
+                _write_array(out_file, tfs)
+
+        out_file.seek(0)
+        out_file.write(_HEADER.pack(MAGIC, VERSION, len(entries), len(docs), *offsets))
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,637 @@
+from __future__ import annotations
+
+import itertools
+import json
+import os
+import shutil
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+from search.exception import SearchQueryException
+from search.postings import Postings, SortedArrayPostings, make_postings, union_all
+from search.segment import SegmentReader, write_segment
+from search.sketch import HyperLogLog
+from search.term_index import MAX_PREFIX_TERMS, SKETCH_MIN_DOCS, TermIndex, json_tree, _generations
+
+
+def _without(postings: Postings, deleted: set[int] | frozenset[int]) -> Postings:
+    # Filters deleted documents out of a posting list, along with their term frequencies
+    if not isinstance(postings, SortedArrayPostings) or postings.tfs is None:
+        return make_postings([doc_id for doc_id in postings if doc_id not in deleted], presorted=True)
+    kept = [(doc_id, tf) for doc_id, tf in zip(postings.ids, postings.tfs) if doc_id not in deleted]
+    return SortedArrayPostings.of(array('I', (doc_id for doc_id, _ in kept)), array('H', (tf for _, tf in kept)))
+
+
+class SealedSegment:
+    """
+    An immutable part of a SegmentedIndex: either a TermIndex opened straight from a segment file, or a frozen
+    in-memory TermIndex waiting to be written out. Neither is ever changed again; documents replaced since the
+    segment was sealed are only marked as deleted, and filtered out of its postings as they're read.
+    """
+
+    def __init__(self, index: TermIndex, path: str = None):
+        self.index = index
+        # The segment file, if it belongs to the SegmentedIndex and should be removed along with the segment
+        self.path = path
+        self.deleted = set[int]()
+        # Postings with the deleted documents filtered out, by token
+        self.live = dict[str, Postings]()
+        self.merging = False
+
+    def __len__(self):
+        return len(self.index) - len(self.deleted)
+
+    def get_doc_tokens(self, doc_id: int) -> tuple[str, ...] | None:
+        if doc_id in self.deleted:
+            return None
+        return self.index.get_doc_tokens(doc_id)
+
+    def delete(self, doc_id: int, tokens: Iterable[str]):
+        self.deleted.add(doc_id)
+        for token in tokens:
+            self.live.pop(token, None)
+
+    def has_postings(self, token: str) -> bool:
+        length = self.index.posting_length(token)
+        if length > len(self.deleted):
+            # Not all of them can have been deleted, so there's no need to filter them
+            return True
+        return length > 0 and self.postings(token) is not None
+
+    def postings(self, token: str) -> Postings | None:
+        postings = self.index.postings(token)
+        if postings is None or len(self.deleted) == 0:
+            return postings
+        live = self.live.get(token)
+        if live is None:
+            live = self.live[token] = _without(postings, self.deleted)
+        return live if len(live) > 0 else None
+
+    def iter_postings(self, deleted: frozenset[int]) -> Iterator[tuple[str, Postings]]:
+        """
+        Iterates over every (term, postings) pair, leaving out the given deleted documents.
+        Safe to call from a background thread while queries run against the segment.
+        """
+        reader = self.index.segment
+        if reader is not None:
+            # Read straight from the file, since queries fill in the index's own dict as they go
+            pairs = ((reader.term(ordinal), reader.postings(ordinal)) for ordinal in range(reader.term_count))
+        else:
+            pairs = self.index.iter_postings()
+        for term, postings in pairs:
+            if len(deleted) > 0:
+                postings = _without(postings, deleted)
+            if len(postings) > 0:
+                yield term, postings
+
+    def iter_doc_tokens(self, deleted: frozenset[int]) -> Iterator[tuple[int, tuple[str, ...]]]:
+        """
+        Iterates over every (doc_id, tokens) pair, leaving out the given deleted documents.
+        Safe to call from a background thread while queries run against the segment.
+        """
+        reader = self.index.segment
+        if reader is not None:
+            pairs = ((doc_id, reader.doc_terms(doc_id)) for doc_id in reader.doc_ids())
+        else:
+            pairs = self.index.iter_doc_tokens()
+        for doc_id, tokens in pairs:
+            if doc_id not in deleted:
+                yield doc_id, tokens
+
+    def close(self):
+        self.index.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def _merge_segments(sources: list[tuple[SealedSegment, frozenset[int]]], path: str) -> TermIndex:
+    # Runs on the merge thread: only reads the sources, and the deletions as they were when the merge started
+    term_postings = dict[str, list[Postings]]()
+    doc_tokens = []
+    for segment, deleted in sources:
+        for term, postings in segment.iter_postings(deleted):
+            term_postings.setdefault(term, []).append(postings)
+        doc_tokens.extend(segment.iter_doc_tokens(deleted))
+    # Every document lives in a single segment, so the postings being combined never overlap
+    merged = ((term, union_all(postings, disjoint=True)) for term, postings in term_postings.items())
+    write_segment(path, merged, doc_tokens)
+    return TermIndex.open(path)
+
+
+class SegmentedIndex:
+    """
+    Term index made of immutable segments, LSM-style, with the same interface as TermIndex.
+    New documents go into a small in-memory buffer (a plain TermIndex). Once it holds buffer_docs documents it's
+    frozen as a sealed segment and a fresh buffer takes its place; a background thread then writes it out as a
+    segment file. Replacing a document only marks the old copy as deleted in its segment, so updates cost the same
+    however large the index grows. The background thread also merges segments of similar size, merge_factor at a
+    time, dropping deleted documents as it goes, so queries only ever have to combine a few segments.
+    Finished background work is picked up by the next update, so the segment list is only ever changed by writers,
+    and queries never wait on a merge.
+    """
+
+    def __init__(self, directory: str, base: TermIndex = None, buffer_docs: int = 10000, merge_factor: int = 4,
+                 background: bool = True):
+        """
+        :param directory: Where to keep the segment files. Anything already there is removed.
+        :param base: An index to start from, which becomes the first sealed segment.
+        :param buffer_docs: How many documents the in-memory buffer holds before it's sealed.
+        :param merge_factor: How many segments of similar size are merged at once.
+        :param background: Whether to write and merge segments on a background thread, or straight away.
+        """
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        self.directory = directory
+        self.buffer_docs = max(buffer_docs, 1)
+        self.merge_factor = max(merge_factor, 2)
+        self.buffer = TermIndex()
+        self.segments = list[SealedSegment]()
+        self.doc_count = 0
+        self.token_count = 0
+        self.generations = dict[str, int]()
+        self.base_generation = next(_generations)
+        # The base index's terms, which had postings at the base generation: their generations have to be kept once
+        # their postings are gone, even after the base has been merged into other segments
+        self.base_reader = None
+        self.base_terms = frozenset[str]()
+        # Postings combined across segments, with the generation they were combined at, by token
+        self.combined = dict[str, tuple[int, Postings]]()
+        # Sketches of the combined postings, with the generation they were built at, by token
+        self.sketches = dict[str, tuple[int, HyperLogLog]]()
+        # The doc IDs of every live document, across all the segments
+        self.live = make_postings()
+        # Write-ahead log which index commands are recorded in once they've been applied, if any
+        self.journal = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="merge") if background else None
+        self.job: Future | None = None
+        self.job_path = None
+        self.job_sources = list[tuple[SealedSegment, frozenset[int]]]()
+        self.file_numbers = itertools.count(1)
+        if base is not None and len(base) > 0:
+            self.segments.append(SealedSegment(base))
+            self.doc_count = len(base)
+            self.token_count = base.token_count
+            self.live = make_postings(base.live_docs(), presorted=True)
+            if base.segment is not None:
+                self.base_reader = SegmentReader(base.segment.path)
+            self.base_terms = frozenset(term for term, postings in base.terms.items() if len(postings) > 0)
+            self._schedule()
+
+    def __str__(self):
+        return json.dumps(self.json())
+
+    def __len__(self):
+        return self.doc_count
+
+    def get_doc_ids_containing_token(self, token: str) -> Postings:
+        """
+        Retrieves all doc_ids containing the given token.
+        :param token: The token to look up
+        :return: The set of doc_ids containing the given token
+        :raises: SearchQueryException if we weren't able to find the token in the index!
+        """
+        postings = self.postings(token)
+        if postings is None:
+            raise SearchQueryException(f"SEARCH_QUERY_TOKEN_NOT_FOUND({token})")
+        return postings
+
+    def postings(self, token: str) -> Postings | None:
+        """
+        Retrieves the posting list for the given token across every segment, if there is one.
+        :param token: The token to look up
+        :return: The Postings for the token, or None if it isn't in the index.
+        """
+        generation = self.generation(token)
+        cached = self.combined.get(token)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        found = []
+        postings = self.buffer.postings(token)
+        if postings is not None:
+            found.append(postings)
+        for segment in self.segments:
+            postings = segment.postings(token)
+            if postings is not None:
+                found.append(postings)
+        if len(found) == 0:
+            return None
+        if len(found) == 1:
+            return found[0]
+        # Every document lives in a single segment, so the segments' postings never overlap. Merging segments doesn't
+        # change them either, so the combined postings stay valid until the token's generation changes.
+        postings = union_all(found, disjoint=True)
+        self.combined[token] = (generation, postings)
+        return postings
+
+    def sketch(self, token: str) -> HyperLogLog | None:
+        """
+        Retrieves a HyperLogLog sketch of the given token's postings across every segment. Rather than being updated
+        document by document, a large term's sketch is rebuilt the next time it's asked for after its postings change.
+        :param token: The token to look up
+        :return: The sketch, or None if the token isn't in the index.
+        """
+        generation = self.generation(token)
+        cached = self.sketches.get(token)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        postings = self.postings(token)
+        if postings is None:
+            return None
+        sketch = HyperLogLog.of(postings)
+        if len(postings) >= SKETCH_MIN_DOCS:
+            self.sketches[token] = (generation, sketch)
+        return sketch
+
+    def doc_length(self, doc_id: int) -> int:
+        """
+        Retrieves the length of a document, for ranking: its number of distinct tokens.
+        :param doc_id: The document ID
+        :return: The length, or 0 if the document isn't in the index.
+        """
+        length = self.buffer.doc_length(doc_id)
+        if length == 0:
+            for segment in reversed(self.segments):
+                if doc_id not in segment.deleted:
+                    length = segment.index.doc_length(doc_id)
+                    if length > 0:
+                        break
+        return length
+
+    def average_doc_length(self) -> float:
+        return self.token_count / self.doc_count if self.doc_count > 0 else 0.0
+
+    def live_docs(self) -> Postings:
+        """
+        Retrieves the doc IDs of every document in the index. They're updated in place as documents come and go.
+        :return: The Postings of every live document.
+        """
+        return self.live
+
+    def generation(self, token: str) -> int:
+        """
+        Retrieves the generation number of the given token, which changes every time the token's postings do.
+        Sealing and merging segments don't change any postings, so they leave the generations alone. Tokens which
+        have never had any postings, or no longer do and weren't in the base index, share the base generation.
+        :param token: The token to look up
+        :return: The token's generation
+        """
+        return self.generations.get(token, self.base_generation)
+
+    def get_doc_tokens(self, doc_id: int) -> tuple[str, ...] | None:
+        """
+        Retrieves the tokens of an indexed document.
+        :param doc_id: The document ID
+        :return: The document's unique tokens, or None if it isn't in the index.
+        """
+        tokens = self.buffer.get_doc_tokens(doc_id)
+        if tokens is None:
+            for segment in reversed(self.segments):
+                tokens = segment.get_doc_tokens(doc_id)
+                if tokens is not None:
+                    break
+        return tokens
+
+    def terms_with_prefix(self, prefix: str) -> Iterator[str]:
+        """
+        Iterates over the indexed terms starting with the given prefix.
+        :param prefix: The prefix to look up
+        :return: A sorted iterator of terms.
+        """
+        candidates = set(self.buffer.terms_with_prefix(prefix))
+        for segment in self.segments:
+            candidates.update(segment.index.terms_with_prefix(prefix))
+        return (term for term in sorted(candidates) if self.postings(term) is not None)
+
+    def prefix_postings(self, prefix: str, max_terms: int = MAX_PREFIX_TERMS) -> Postings | None:
+        """
+        Retrieves the union of the posting lists of every term starting with the given prefix. Unlike a TermIndex,
+        no unions are kept between queries: the combined postings of each term are cached already.
+        :param prefix: The prefix to look up
+        :param max_terms: The most terms the prefix may expand to.
+        :return: The Postings of the prefix, or None if no indexed term starts with it.
+        :raises: SearchQueryException if more than max_terms terms start with the prefix.
+        """
+        terms = list(itertools.islice(self.terms_with_prefix(prefix), max_terms + 1))
+        if len(terms) > max_terms:
+            raise SearchQueryException(f"SEARCH_QUERY_PREFIX_TOO_BROAD({prefix}*)")
+        postings = union_all([self.postings(term) for term in terms])
+        return postings if len(postings) > 0 else None
+
+    def iter_postings(self) -> Iterator[tuple[str, Postings]]:
+        """
+        Iterates over every (term, postings) pair in the index, combined across segments.
+        :return: An iterator of (term, postings) pairs
+        """
+        term_postings = dict[str, list[Postings]]()
+        for term, postings in self.buffer.iter_postings():
+            term_postings.setdefault(term, []).append(postings)
+        for segment in self.segments:
+            for term, postings in segment.iter_postings(frozenset(segment.deleted)):
+                term_postings.setdefault(term, []).append(postings)
+        for term, postings in term_postings.items():
+            yield term, union_all(postings, disjoint=True)
+
+    def posting_lengths(self) -> Iterator[tuple[str, int]]:
+        """
+        Iterates over the length of every term's postings, combined across segments.
+        :return: An iterator of (term, number of documents) pairs
+        """
+        for term, postings in self.iter_postings():
+            yield term, len(postings)
+
+    def stats(self) -> dict:
+        """
+        Counts the in-memory structures of the index.
+        :return: A JSON-serializable dict
+        """
+        return {
+            "docs": self.doc_count,
+            "buffer_docs": len(self.buffer),
+            "segments": len(self.segments),
+            "deleted_docs": sum(len(segment.deleted) for segment in self.segments),
+            "radix_nodes": self.buffer.radix.node_count(),
+            "merging": self.job is not None,
+        }
+
+    def iter_doc_tokens(self) -> Iterator[tuple[int, tuple[str, ...]]]:
+        """
+        Iterates over every (doc_id, tokens) pair in the forward index.
+        :return: An iterator of (doc_id, tokens) pairs
+        """
+        yield from self.buffer.iter_doc_tokens()
+        for segment in self.segments:
+            yield from segment.iter_doc_tokens(frozenset(segment.deleted))
+
+    def remove_doc(self, doc_id: int):
+        """
+        Removes a document from the index: from the buffer if it's there, otherwise by marking it deleted in its
+        segment.
+        :param doc_id: The document ID
+        :return: None
+        """
+        self._poll()
+        tokens = self.buffer.get_doc_tokens(doc_id)
+        if tokens is not None:
+            self.buffer.remove_doc(doc_id)
+        else:
+            # A document is only ever live in one place, so the first segment which has it is the only one
+            for segment in reversed(self.segments):
+                tokens = segment.get_doc_tokens(doc_id)
+                if tokens is not None:
+                    segment.delete(doc_id, tokens)
+                    if len(segment) == 0 and not segment.merging:
+                        self.segments.remove(segment)
+                        segment.close()
+                    break
+            else:
+                return
+        self.doc_count -= 1
+        self.token_count -= len(tokens)
+        self.live.remove(doc_id)
+        self._changed(tokens, removed=True)
+
+    def add_doc(self, doc_id: int, tokens: list[str]):
+        """
+        Public method to add a document.
+        :param doc_id: The document ID
+        :param tokens: The list of string tokens.
+        :return: None
+        """
+        self.remove_doc(doc_id)
+        self.buffer.add_doc(doc_id, tokens)
+        tokens = self.buffer.get_doc_tokens(doc_id)
+        self._changed(tokens)
+        self.doc_count += 1
+        self.token_count += len(tokens)
+        self.live.add(doc_id)
+        if len(self.buffer) >= self.buffer_docs:
+            self._seal(self.buffer)
+            self.buffer = TermIndex()
+
+    def merge(self, doc_tokens: dict[int, tuple[str, ...]], term_doc_ids: dict[str, Iterable[int]],
+              term_frequencies: dict[str, Iterable[int]] = None):
+        """
+        Adds a batch of documents at once, from a partial index built elsewhere (see search.bulk), as a new segment.
+        Documents already in the index are replaced, as they would be by add_doc.
+        :param doc_tokens: The forward index of the batch: doc_id -> unique tokens.
+        :param term_doc_ids: The postings of the batch: token -> ascending doc IDs.
+        :param term_frequencies: The term frequencies of the batch, as TermIndex.merge() takes them.
+        :return: None
+        """
+        for doc_id in doc_tokens:
+            self.remove_doc(doc_id)
+        batch = TermIndex()
+        batch.merge(doc_tokens, term_doc_ids, term_frequencies)
+        self._changed(batch.terms)
+        self.doc_count += len(batch)
+        self.token_count += batch.token_count
+        self.live = self.live.union(batch.live_docs())
+        self._seal(batch)
+
+    def _changed(self, tokens: Iterable[str], removed: bool = False):
+        for token in tokens:
+            self.combined.pop(token, None)
+            self.sketches.pop(token, None)
+            if removed and not self._has_postings(token) and not self._in_base(token):
+                # Like a token which was never added, so it can go back to the base generation. A base term can't:
+                # results cached while it still had its postings would look up to date again
+                self.generations.pop(token, None)
+            else:
+                self.generations[token] = next(_generations)
+
+    def _has_postings(self, token: str) -> bool:
+        postings = self.buffer.postings(token)
+        return postings is not None or any(segment.has_postings(token) for segment in self.segments)
+
+    def _in_base(self, token: str) -> bool:
+        return token in self.base_terms or self.base_reader is not None and self.base_reader.find_term(token) >= 0
+
+    def _seal(self, index: TermIndex):
+        if len(index) > 0:
+            self.segments.append(SealedSegment(index))
+            self._schedule()
+
+    def _pick_merge(self) -> list[SealedSegment]:
+        # Frozen in-memory segments are written out first, all together
+        candidates = [segment for segment in self.segments if not segment.merging]
+        frozen = [segment for segment in candidates if segment.index.segment is None]
+        if len(frozen) > 0:
+            return frozen
+        # Then segments which are mostly deleted documents are rewritten on their own
+        for segment in candidates:
+            if len(segment.deleted) * 2 > len(segment.index):
+                return [segment]
+        # Then merge_factor segments of the same size tier, smallest first
+        tiers = dict[int, list[SealedSegment]]()
+        for segment in candidates:
+            tier, size = 0, self.buffer_docs * self.merge_factor
+            while len(segment) >= size:
+                tier, size = tier + 1, size * self.merge_factor
+            tiers.setdefault(tier, []).append(segment)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return sorted(tiers[tier], key=len)[:self.merge_factor]
+        return []
+
+    def _schedule(self):
+        # Start the next piece of background work, if nothing is running
+        while self.job is None:
+            sources = self._pick_merge()
+            if len(sources) == 0:
+                return
+            for segment in sources:
+                segment.merging = True
+            self.job_sources = [(segment, frozenset(segment.deleted)) for segment in sources]
+            path = os.path.join(self.directory, f"{next(self.file_numbers):06d}.seg")
+            if self.executor is not None:
+                self.job = self.executor.submit(_merge_segments, self.job_sources, path)
+                self.job_path = path
+                return
+            self._install(_merge_segments(self.job_sources, path), path)
+
+    def _poll(self, block: bool = False):
+        # Pick up the result of the background work once it's finished, and start the next
+        if self.job is None or (not block and not self.job.done()):
+            return
+        job, self.job = self.job, None
+        try:
+            merged = job.result()
+        except Exception:
+            # Leave the segments as they were; they're picked again the next time something is sealed
+            for segment, _ in self.job_sources:
+                segment.merging = False
+            self.job_sources = []
+            for path in (self.job_path, f"{self.job_path}.tmp"):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+        self._install(merged, self.job_path)
+        self._schedule()
+
+    def _install(self, merged: TermIndex, path: str):
+        segment = SealedSegment(merged, path)
+        for source, deleted in self.job_sources:
+            # Carry over the documents replaced while the merge was running
+            segment.deleted.update(source.deleted - deleted)
+            self.segments.remove(source)
+            source.close()
+        self.job_sources = []
+        if len(segment) > 0:
+            self.segments.append(segment)
+        else:
+            segment.close()
+
+    def wait(self):
+        """
+        Waits for every outstanding write and merge to finish.
+        :return: None
+        """
+        while self.job is not None:
+            self._poll(block=True)
+
+    def close(self):
+        """
+        Waits for background work, then closes and removes every segment file in the directory.
+        :return: None
+        """
+        if self.job is not None:
+            self.job.exception()
+            self.job = None
+        if self.executor is not None:
+            self.executor.shutdown()
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+        if self.base_reader is not None:
+            self.base_reader.close()
+            self.base_reader = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def save(self, path: str):
+        """
+        Writes the whole index out as a single binary segment file.
+        :param path: The path to write to.
+        :return: None
+        """
+        write_segment(path, self.iter_postings(), self.iter_doc_tokens())
+
+    def json(self):
+        """
+        Exports the index in the per-character tree layout of index.json.
+        :return: A JSON-serializable dict
+        """
+        return json_tree(self.iter_postings())
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    for background in (False, True):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index = SegmentedIndex(os.path.join(tmp_dir, "segments"), buffer_docs=2, merge_factor=2,
+                                   background=background)
+            index.add_doc(1, ["soup", "tomato", "cream", "salt"])
+            index.add_doc(2, ["cake", "sugar", "eggs", "flour", "sugar", "cocoa", "cream", "butter"])
+            index.add_doc(1, ["bread", "butter", "salt"])
+            index.add_doc(3, ["soup", "fish", "potato", "salt", "pepper"])
+            assert len(index) == 3
+            assert index.postings("tomato") is None
+            assert list(index.get_doc_ids_containing_token("butter")) == [1, 2]
+            assert list(index.get_doc_ids_containing_token("salt")) == [1, 3]
+            assert list(index.terms_with_prefix("s")) == ["salt", "soup", "sugar"]
+            assert list(index.prefix_postings("s")) == [1, 2, 3] and index.prefix_postings("x") is None
+            assert dict(index.posting_lengths())["salt"] == 2 and index.stats()["docs"] == 3
+            salt_generation = index.generation("salt")
+
+            # Replacing a sealed document marks it deleted, and only changes the generations of its tokens. Those
+            # with no postings left anywhere go back to the base generation, so churn doesn't grow the generations
+            index.add_doc(2, ["cake"])
+            index.add_doc(4, ["salt", "bread"])
+            assert index.generation("sugar") == index.base_generation and "sugar" not in index.generations
+            assert index.generation("salt") != salt_generation
+            index.wait()
+            assert len(index) == 4 and len(index.segments) <= 2
+            assert index.postings("sugar") is None
+            assert list(index.get_doc_ids_containing_token("salt")) == [1, 3, 4]
+            assert dict(index.iter_doc_tokens()) == {1: ("bread", "butter", "salt"), 2: ("cake",),
+                                                     3: ("soup", "fish", "potato", "salt", "pepper"),
+                                                     4: ("salt", "bread")}
+
+            # Batches from a bulk load become segments of their own
+            index.merge({3: ("cake",), 5: ("cake", "salt")}, {"cake": [3, 5], "salt": [5]})
+            index.wait()
+            assert list(index.get_doc_ids_containing_token("cake")) == [2, 3, 5]
+            assert list(index.get_doc_ids_containing_token("salt")) == [1, 4, 5]
+            assert index.postings("fish") is None and len(index) == 5
+            assert index.sketch("salt").estimate() == 3 and index.sketch("fish") is None
+            assert list(index.live_docs()) == [1, 2, 3, 4, 5]
+
+            # Snapshots combine every segment
+            index.save(os.path.join(tmp_dir, "index.seg"))
+            opened = TermIndex.open(os.path.join(tmp_dir, "index.seg"))
+            assert dict(opened.iter_doc_tokens()) == dict(index.iter_doc_tokens())
+            assert TermIndex.parse(index.json()).doc_tokens == TermIndex.parse(opened.json()).doc_tokens
+
+            # ...and can be the base of a new segmented index
+            reopened = SegmentedIndex(os.path.join(tmp_dir, "reopened"), base=opened, background=background)
+            reopened.add_doc(5, ["soup"])
+            assert list(reopened.live_docs()) == [1, 2, 3, 4, 5]
+            assert list(reopened.get_doc_ids_containing_token("soup")) == [5]
+            assert list(reopened.get_doc_ids_containing_token("cake")) == [2, 3]
+            # A base term keeps its generation once its postings are gone, or it would match results cached
+            # while it had them
+            reopened.add_doc(1, ["soup"])
+            reopened.wait()
+            assert reopened.postings("butter") is None and reopened.generation("butter") != reopened.base_generation
+            for doc_id in range(100, 200):
+                reopened.add_doc(doc_id, [f"churn{doc_id}"])
+                reopened.remove_doc(doc_id)
+            reopened.wait()
+            assert not any(token.startswith("churn") for token in reopened.generations)
+            reopened.close()
+            index.close()
+            assert not os.path.exists(os.path.join(tmp_dir, "segments"))
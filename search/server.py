@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from search.shell import Shell
+
+
+class ReadWriteLock:
+    """
+    Readers-writer lock for asyncio tasks: any number of readers can hold it at once, or a single writer.
+    Waiters are served strictly in arrival order, so a stream of queries can't starve an index command (or the other
+    way around), and commands from one connection take the lock in the order they were sent.
+    """
+
+    def __init__(self):
+        self.readers = 0
+        self.writing = False
+        self.waiters = deque[tuple[asyncio.Future, bool]]()
+
+    def _available(self, exclusive: bool) -> bool:
+        return not self.writing and (not exclusive or self.readers == 0)
+
+    def _grant(self, exclusive: bool):
+        if exclusive:
+            self.writing = True
+        else:
+            self.readers += 1
+
+    def _wake(self):
+        while len(self.waiters) > 0 and self._available(self.waiters[0][1]):
+            future, exclusive = self.waiters.popleft()
+            if future.cancelled():
+                continue
+            self._grant(exclusive)
+            future.set_result(None)
+
+    async def acquire(self, exclusive: bool):
+        """
+        Waits for the lock.
+        :param exclusive: True to take it as the writer, False to share it with other readers.
+        :return: None
+        """
+        if len(self.waiters) == 0 and self._available(exclusive):
+            self._grant(exclusive)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((future, exclusive))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # Still waiting, and maybe holding up compatible waiters behind us
+                try:
+                    self.waiters.remove((future, exclusive))
+                except ValueError:
+                    pass
+                self._wake()
+            else:
+                # The lock was granted just as we were cancelled
+                self.release(exclusive)
+            raise
+
+    def release(self, exclusive: bool):
+        if exclusive:
+            self.writing = False
+        else:
+            self.readers -= 1
+        self._wake()
+
+
+class SearchServer:
+    """
+    Serves the command line protocol over TCP or Unix sockets, one command per line and one response per line, with
+    the same responses as the Shell. Connections are persistent, and clients may pipeline commands: each connection
+    reads ahead up to pipeline_depth commands, and the responses are written back in order.
+    Queries run concurrently on a thread pool under a shared lock; every other command takes the lock exclusively,
+    so a query never sees a half-applied index command. A client which doesn't read its responses stops having its
+    commands read, so its pending work and buffered responses stay bounded.
+    """
+
+    # Commands which only read the index, and can run alongside each other
+    READ_COMMANDS = Shell.READ_COMMANDS
+
+    def __init__(self, shell: Shell, threads: int = 4, pipeline_depth: int = 64, max_line: int = 1 << 20):
+        self.shell = shell
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="search")
+        self.pipeline_depth = pipeline_depth
+        self.max_line = max_line
+        self.lock = ReadWriteLock()
+        self.servers = list[asyncio.AbstractServer]()
+
+    async def start(self, host: str = None, port: int = None, path: str = None) -> asyncio.AbstractServer:
+        """
+        Starts listening for connections.
+        :param host: The address to listen on, for TCP. None listens on every interface.
+        :param port: The TCP port.
+        :param path: The Unix socket path, instead of a TCP address.
+        :return: The asyncio server.
+        """
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path, limit=self.max_line)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port, limit=self.max_line)
+        self.servers.append(server)
+        return server
+
+    async def close(self):
+        """
+        Stops listening, then closes the shell's write-ahead log once every running command has finished.
+        :return: None
+        """
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        await self.lock.acquire(True)
+        try:
+            self.shell.exit([])
+        finally:
+            self.lock.release(True)
+        self.executor.shutdown()
+
+    async def _run(self, line: str, exclusive: bool) -> str | None:
+        # The caller holds the lock for us; give it back as soon as the command is done
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.shell.execute, line)
+        finally:
+            self.lock.release(exclusive)
+
+    async def sync(self):
+        """
+        Makes sure every logged index change is on disk, so its response can be sent.
+        :return: None
+        """
+        if self.shell.wal is None or self.shell.wal.unsynced == 0:
+            return
+        await self.lock.acquire(True)
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.shell.sync)
+        finally:
+            self.lock.release(True)
+
+    @staticmethod
+    def _reply(response: str | None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(response)
+        return future
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Each pipeline entry is (response future, whether it changed the index, whether it ends the connection)
+        pipeline = asyncio.Queue[tuple[asyncio.Future, bool, bool]]()
+        slots = asyncio.Semaphore(self.pipeline_depth)
+        responder = asyncio.create_task(self._respond(pipeline, slots, writer))
+        last = (self._reply(None), False, True)
+        try:
+            while True:
+                # Stop reading until the client has taken some of its responses
+                await slots.acquire()
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    last = (self._reply(f"error LINE_TOO_LONG({self.max_line})"), False, True)
+                    break
+                except ConnectionError:
+                    break
+                if not line:
+                    break
+                line = line.decode("utf-8", errors="replace").rstrip("\r\n")
+                if line == "":
+                    slots.release()
+                    continue
+                if line == "exit":
+                    # Only ends this connection; the server keeps running
+                    last = (self._reply("Bye!"), False, True)
+                    break
+                exclusive = line.split(' ', 1)[0] not in self.READ_COMMANDS
+                await self.lock.acquire(exclusive)
+                pipeline.put_nowait((asyncio.ensure_future(self._run(line, exclusive)), exclusive, False))
+        finally:
+            pipeline.put_nowait(last)
+            await responder
+
+    async def _respond(self, pipeline: asyncio.Queue, slots: asyncio.Semaphore, writer: asyncio.StreamWriter):
+        connected = True
+        entry = None
+        finished = False
+        while not finished:
+            if entry is None:
+                entry = await pipeline.get()
+            # Gather every response which is ready, so a pipelined batch is synced and written out together
+            responses = []
+            logged = False
+            while entry is not None:
+                future, exclusive, finished = entry
+                try:
+                    response = await future
+                except Exception as ex:
+                    response = f"error {ex}"
+                if response is not None:
+                    responses.append(response)
+                logged = logged or exclusive
+                slots.release()
+                entry = None
+                if not finished and not pipeline.empty():
+                    entry = pipeline.get_nowait()
+                    if not entry[0].done():
+                        break
+            if not connected or len(responses) == 0:
+                continue
+            try:
+                if logged:
+                    # Only acknowledge index commands once they're safely in the log
+                    await self.sync()
+                writer.write(("\n".join(responses) + "\n").encode("utf-8"))
+                await writer.drain()
+            except ConnectionError:
+                # Keep taking responses off the pipeline, so reading carries on until the connection is closed
+                connected = False
+        if connected:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def serve(shell: Shell, host: str = None, port: int = None, path: str = None, threads: int = 4,
+                pipeline_depth: int = 64):
+    """
+    Runs a SearchServer until it's cancelled (e.g. by Ctrl-C), then shuts it down cleanly.
+    :return: None
+    """
+    server = SearchServer(shell, threads=threads, pipeline_depth=pipeline_depth)
+    await server.start(host, port, path)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    from search.client import SearchClient
+
+    async def check(tmp_dir: str):
+        paths = {"index_path": os.path.join(tmp_dir, "index.seg"), "json_path": None,
+                 "wal_path": os.path.join(tmp_dir, "index.wal")}
+        shell = Shell(**paths)
+        shell.load()
+        server = SearchServer(shell, pipeline_depth=2)
+        socket_path = os.path.join(tmp_dir, "search.sock")
+        await server.start(path=socket_path)
+
+        first = await SearchClient.connect(path=socket_path)
+        second = await SearchClient.connect(path=socket_path)
+        # Pipelined commands are answered in order, each seeing every command sent before it
+        assert await first.execute_lines([
+            "index 1 soup tomato cream salt", "index 2 cake sugar cream butter", "", "query cream",
+            "index 1 bread butter salt", "index 3 soup fish potato salt pepper", "query (butter | potato) & salt",
+            "explain salt", "query (a", "foo bar"]) == [
+            "index ok 1", "index ok 2", "query results 1 2", "index ok 1", "index ok 3", "query results 1 3",
+            "explain salt est=2", "index error SEARCH_QUERY_UNCLOSED_PAREN", "error COMMAND_NOT_FOUND(foo)"]
+        assert await second.execute_lines(["query soup"] * 5) == ["query results 3"] * 5
+        assert await first.execute("exit") == "Bye!"
+        assert await second.execute("query butter") == "query results 1 2"
+        await second.close()
+        await server.close()
+
+        # Acknowledged index commands are in the log
+        shell = Shell(**paths)
+        assert shell.load() == "WARNING - Unable to load index file! Defaulting to empty index... " \
+                               "(replayed 4 logged commands)"
+        shell.exit([])
+
+        # Readers share the lock, writers wait for it, and waiters are served in order
+        lock = ReadWriteLock()
+        order = []
+
+        async def hold(name: str, exclusive: bool):
+            await lock.acquire(exclusive)
+            order.append(name)
+            await asyncio.sleep(0)
+            lock.release(exclusive)
+
+        await lock.acquire(False)
+        tasks = [asyncio.create_task(hold(name, exclusive)) for name, exclusive in
+                 [("r1", False), ("w1", True), ("r2", False), ("r3", False), ("w2", True)]]
+        await asyncio.sleep(0)
+        assert order == ["r1"]
+        lock.release(False)
+        await asyncio.gather(*tasks)
+        assert order == ["r1", "w1", "r2", "r3", "w2"]
+        assert lock.readers == 0 and not lock.writing
+
+    with tempfile.TemporaryDirectory() as tmp_directory:
+        asyncio.run(check(tmp_directory))
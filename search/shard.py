@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+import multiprocessing
+import struct
+import sys
+from array import array
+from collections import deque
+from multiprocessing.connection import Connection
+from typing import Iterator
+
+from search.exception import SearchQueryException
+from search.handler import CountResponse, FailureResponse, MultiResponse, QueryResponse, Response
+from search.main import main
+from search.postings import SortedArrayPostings, make_postings, union_all
+from search.query_handler import QueryOptions
+from search.shell import Shell, INDEX_PATH, WAL_PATH
+
+# Reply tags: doc IDs (packed uint32), a count (uint64), a plain text response, or several replies, each prefixed by
+# its length
+_RESULTS = b"R"
+_COUNT = b"C"
+_TEXT = b"T"
+_MULTI = b"M"
+
+# How many commands may be in flight to one shard before we wait for its replies
+_WINDOW = 16
+
+
+def _encode_doc_ids(doc_ids) -> bytes:
+    ids = doc_ids.ids if isinstance(doc_ids, SortedArrayPostings) else array('I', doc_ids)
+    if sys.byteorder != "little":
+        ids = array('I', ids)
+        ids.byteswap()
+    return _RESULTS + ids.tobytes()
+
+
+def _decode_doc_ids(payload: bytes) -> SortedArrayPostings:
+    ids = array('I')
+    ids.frombytes(payload[1:])
+    if sys.byteorder != "little":
+        ids.byteswap()
+    return SortedArrayPostings.of(ids)
+
+
+def _encode_response(response: Response) -> bytes:
+    if isinstance(response, QueryResponse):
+        return _encode_doc_ids(response.doc_ids)
+    if isinstance(response, CountResponse):
+        return _COUNT + struct.pack("<Q", response.count)
+    if isinstance(response, MultiResponse):
+        replies = [_encode_response(part) for part in response.responses]
+        return _MULTI + b"".join(struct.pack("<I", len(reply)) + reply for reply in replies)
+    return _TEXT + str(response).encode("utf-8")
+
+
+def _decode_replies(payload: bytes) -> list[bytes]:
+    replies = []
+    position = 1
+    while position < len(payload):
+        (length,) = struct.unpack_from("<I", payload, position)
+        position += 4
+        replies.append(payload[position:position + length])
+        position += length
+    return replies
+
+
+def _shard_main(conn: Connection, shell_options: dict):
+    """
+    Worker process for one shard: a Shell over its own index files, answering one command per message.
+    Query results go back as packed doc IDs, counts as numbers, and a batch of queries as one reply per query;
+    everything else goes back as the Shell's text response.
+    """
+    shell = Shell(**shell_options)
+    conn.send_bytes(_TEXT + shell.load().encode("utf-8"))
+    while not shell.done:
+        line = conn.recv_bytes().decode("utf-8")
+        args = line.split(' ')
+        if args[0] in ("query", "mquery", "count") and len(args) > 1:
+            conn.send_bytes(_encode_response(main(args, shell.index)))
+            continue
+        reply = shell.execute(line)
+        shell.sync()
+        conn.send_bytes(_TEXT + (reply or "").encode("utf-8"))
+    conn.close()
+
+
+class ShardedShell(Shell):
+    """
+    Shell which spreads the index over several worker processes, each holding the documents whose doc IDs hash to
+    it, in its own index files.
+    Index commands go to the owning shard only; queries go to every shard, and their (disjoint) results are merged,
+    or their counts added up.
+    Commands are pipelined: a batch is streamed out to the shards and the replies are collected as they come back,
+    so the shards work in parallel.
+    """
+
+    # Commands which every shard runs on its own files, answered with the first shard's response
+    BROADCAST = {"save", "snapshot", "load", "cache", "clear", "exit"}
+
+    def __init__(self, shards: int, index_path: str = INDEX_PATH, wal_path: str | None = WAL_PATH,
+                 wal_sync_every: int = 1000, snapshot_every: int = 100000, segmented: bool = False):
+        super().__init__(index_path=index_path, json_path=None, wal_path=None)
+        self.connections = list[Connection]()
+        self.processes = list[multiprocessing.Process]()
+        for shard in range(shards):
+            shell_options = {
+                "index_path": f"{index_path}.shard{shard}",
+                "json_path": None,
+                "wal_path": f"{wal_path}.shard{shard}" if wal_path is not None else None,
+                "wal_sync_every": wal_sync_every,
+                "snapshot_every": snapshot_every,
+                "segmented": segmented,
+            }
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_main, args=(child_conn, shell_options), daemon=True)
+            process.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(process)
+        self.messages = [conn.recv_bytes()[1:].decode("utf-8") for conn in self.connections]
+
+    def load(self, args: list[str] = None) -> str:
+        if args is None:
+            # Each shard loaded its own files when it started
+            return f"Started {len(self.connections)} shards: {self.messages[0]}"
+        return self.execute("load")
+
+    def bulk_load(self, args: list[str]) -> str:
+        return "bulk-load error SHARDED_COMMAND_UNSUPPORTED(bulk-load)"
+
+    def shard_for(self, doc_id: int) -> int:
+        # Multiplicative hashing, so runs of sequential or strided doc IDs still spread evenly
+        return (doc_id * 2654435761) % 2 ** 32 % len(self.connections)
+
+    def execute(self, line: str) -> str | None:
+        return self.execute_lines([line])[0]
+
+    def respond(self, line: str) -> str | None:
+        # Streaming only applies to the merge, so the response always comes back formatted
+        return self.execute_lines([line])[0]
+
+    def respond_lines(self, lines: list[str]) -> Iterator[str | None]:
+        # The whole batch is pipelined through the shards, and every response comes back formatted
+        return iter(self.execute_lines(lines))
+
+    def execute_lines(self, lines: list[str]) -> list[str | None]:
+        """
+        Runs a batch of commands across the shards, in order, stopping early after an exit.
+        :param lines: The command lines.
+        :return: The responses, as Shell.execute() would give them.
+        """
+        shards = len(self.connections)
+        responses = list[str | None]()
+        replies = dict[int, list[bytes]]()
+        in_flight = [deque() for _ in range(shards)]
+
+        def receive(shard: int):
+            slot = in_flight[shard].popleft()
+            replies[slot].append(self.connections[shard].recv_bytes())
+            if len(replies[slot]) == expected[slot]:
+                responses[slot] = self._merge(replies.pop(slot), pages.pop(slot, None))
+
+        def send(shard: int, slot: int, payload: bytes):
+            while len(in_flight[shard]) >= _WINDOW:
+                receive(shard)
+            self.connections[shard].send_bytes(payload)
+            in_flight[shard].append(slot)
+
+        expected = dict[int, int]()
+        pages = dict[int, QueryOptions]()
+        for line in lines:
+            slot = len(responses)
+            responses.append(None)
+            args = line.split(' ')
+            command = args[0]
+            if len(args) == 1 and command == "":
+                continue
+            if command == "index":
+                try:
+                    targets = [self.shard_for(int(args[1]))]
+                except (IndexError, ValueError):
+                    # Let a shard produce the usual error response
+                    targets = [0]
+            elif command == "query":
+                try:
+                    options, expression = QueryOptions.parse(args[1:], keys=("limit", "offset", "stream", "score"))
+                except SearchQueryException as ex:
+                    responses[slot] = str(FailureResponse(str(ex)))
+                    continue
+                if options.top is not None:
+                    # Ranking needs the document frequencies and lengths of every shard together
+                    responses[slot] = "error SHARDED_COMMAND_UNSUPPORTED(query top)"
+                    continue
+                # Each shard's page has to reach as far as the merged one does; the merge then skips the offset.
+                # Streaming would only apply to the merge, so the shards' results are always sent whole
+                if options.paged:
+                    pages[slot] = options
+                    if options.limit is not None:
+                        expression = [f"limit={options.offset + options.limit}"] + expression
+                line = ' '.join(["query"] + expression)
+                targets = range(shards)
+            elif command in ("mquery", "count") or command in self.BROADCAST:
+                targets = range(shards)
+            elif command in self.commands:
+                responses[slot] = f"error SHARDED_COMMAND_UNSUPPORTED({command})"
+                continue
+            else:
+                targets = [0]
+            expected[slot] = len(targets)
+            replies[slot] = []
+            payload = line.encode("utf-8")
+            for shard in targets:
+                send(shard, slot, payload)
+            if command == "exit":
+                self.done = True
+                break
+        for shard in range(shards):
+            while in_flight[shard]:
+                receive(shard)
+        if self.done:
+            for process in self.processes:
+                process.join()
+        return responses
+
+    @staticmethod
+    def _merge(replies: list[bytes], options: QueryOptions = None) -> str:
+        if all(reply[:1] == _MULTI for reply in replies):
+            # Every shard answers the same batch of queries, so merge them query by query
+            return "\n".join(ShardedShell._merge(list(parts))
+                             for parts in zip(*(_decode_replies(reply) for reply in replies)))
+        if all(reply[:1] == _RESULTS for reply in replies):
+            # Each shard holds different documents, so their results never overlap
+            doc_ids = union_all([_decode_doc_ids(reply) for reply in replies], disjoint=True)
+            return str(QueryResponse(options.page(doc_ids) if options is not None else doc_ids))
+        if all(reply[:1] == _COUNT for reply in replies):
+            # ...so neither do their counts, exact or estimated
+            return str(CountResponse(sum(struct.unpack_from("<Q", reply, 1)[0] for reply in replies)))
+        for reply in replies:
+            if reply[:1] == _TEXT:
+                return reply[1:].decode("utf-8")
+        return str(QueryResponse(make_postings()))
+
+
+if __name__ == "__main__":
+    import contextlib
+    import io
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shell = ShardedShell(3, index_path=os.path.join(tmp_dir, "index.seg"), wal_path=os.path.join(tmp_dir, "wal"))
+        assert shell.load() == "Started 3 shards: WARNING - Unable to load index file! Defaulting to empty index..."
+        commands = ["index 1 soup tomato cream salt", "index 2 cake sugar cream butter", "index 1 bread butter salt",
+                    "index 3 soup fish potato salt pepper", "index x soup", "query (butter | potato) & salt",
+                    "query cream", "query (a", "bulk-load x", "", "snapshot"]
+        assert shell.execute_lines(commands) == [
+            "index ok 1", "index ok 2", "index ok 1", "index ok 3", "index error SEARCH_INDEX_INVALID_DOC_ID(x)",
+            "query results 1 3", "query results 2", "index error SEARCH_QUERY_UNCLOSED_PAREN",
+            "error SHARDED_COMMAND_UNSUPPORTED(bulk-load)", None, "Snapshot started"]
+        assert shell.execute("exit") == "Bye!" and shell.done
+
+        shell = ShardedShell(3, index_path=os.path.join(tmp_dir, "index.seg"), wal_path=os.path.join(tmp_dir, "wal"))
+        assert shell.load() == "Started 3 shards: Loaded index.seg successfully"
+        assert shell.execute("query salt") == "query results 1 3"
+        assert shell.execute_lines(["query limit=1 offset=1 salt | soup", "query stream=on salt", "query limit= salt"]) \
+               == ["query results 3", "query results 1 3", "index error SEARCH_QUERY_INVALID_OPTION(limit=)"]
+        assert shell.execute("query top 1 salt") == "error SHARDED_COMMAND_UNSUPPORTED(query top)"
+        assert shell.execute("mquery salt ; (salt | soup) & potato ; (a") == \
+               "query results 1 3\nquery results 3\nindex error SEARCH_QUERY_UNCLOSED_PAREN"
+        assert shell.execute_lines(["count salt | soup", "count approx=on soup", "count (a"]) == \
+               ["count 2", "count 1", "index error SEARCH_QUERY_UNCLOSED_PAREN"]
+
+        # The interactive prompt goes through the shards too, rather than the parent's own (empty) index
+        stdin, sys.stdin = sys.stdin, io.StringIO("index 4 fennel soup\nquery fennel\ncount soup\n")
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            shell.run_interactive()
+        sys.stdin = stdin
+        assert out.getvalue().split("\n")[:3] == ["> index ok 4", "> query results 4", "> count 2"]
+        assert shell.execute("query fennel") == "query results 4" and len(shell.index) == 0
+        shell.execute("exit")
@@ -0,0 +1,534 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from typing import BinaryIO, Iterator
+
+from search import metrics
+from search.bulk import bulk_load
+from search.cache import PlanCache, QueryCache
+from search.exception import SearchException, SearchIndexException
+from search.handler import QueryResponse
+from search.main import main, register_handlers
+from search.saver import BackgroundSave
+from search.segmented_index import SegmentedIndex
+from search.term_index import TermIndex
+from search.wal import WriteAheadLog
+
+INDEX_PATH = "./index.seg"
+JSON_PATH = "./index.json"
+WAL_PATH = "./index.wal"
+
+
+def write_json(index: TermIndex, path: str):
+    """
+    Writes an index out in the layout of index.json, next to the destination, and renames it over the destination
+    once complete. Each first character's subtree is encoded on its own, so the whole file is never a single string
+    in memory.
+    :param index: The index to write.
+    :param path: The destination path.
+    :return: None
+    """
+    tree = index.json()
+    children = tree.pop("children", None)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as out_file:
+        # The same bytes json.dumps() would give for the whole tree, whose children come last
+        out_file.write(json.dumps(tree)[:-1])
+        if children is not None:
+            out_file.write(', "children": {')
+            for number, (char, child) in enumerate(children.items()):
+                out_file.write(f"{', ' if number > 0 else ''}{json.dumps(char)}: {json.dumps(child)}")
+            out_file.write("}")
+        out_file.write("}")
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class Shell:
+    """
+    Runs commands against the current index: the special commands (save, load, exit, etc.) are handled here, and
+    everything else goes through the registered handlers.
+    Used by main.py, either as an interactive prompt or as a batch processor reading commands from a pipe.
+    Index changes are recorded in a write-ahead log, and the index file is only rewritten as a periodic snapshot;
+    loading opens the latest snapshot and replays the log on top of it. Snapshots and exports are written in the
+    background by a forked child; while a snapshot is being written, the records it covers wait in a second log.
+    With segmented set, the index is a SegmentedIndex over the snapshot, keeping its segment files in a directory
+    next to the index file.
+    Read commands leave the background save alone: the server runs them alongside each other on several threads,
+    which mustn't wait for the same child, or fork.
+    """
+
+    # Commands which only read the index
+    READ_COMMANDS = frozenset({"query", "mquery", "count", "explain"})
+
+    def __init__(self, index_path: str = INDEX_PATH, json_path: str | None = JSON_PATH,
+                 wal_path: str | None = WAL_PATH, wal_sync_every: int = 1000, snapshot_every: int = 100000,
+                 segmented: bool = False):
+        self.index_path = index_path
+        self.json_path = json_path
+        self.wal_path = wal_path
+        self.wal_sync_every = wal_sync_every
+        self.snapshot_every = snapshot_every
+        self.segmented = segmented
+        self.wal = None
+        self.index = TermIndex()
+        self.saving = None
+        self.last_save = None
+        self.done = False
+        self.commands = {
+            "save": self.save,
+            "snapshot": self.snapshot,
+            "load": self.load,
+            "export": self.export_json,
+            "import": self.import_json,
+            "cache": self.cache,
+            "stats": self.stats,
+            "bulk-load": self.bulk_load,
+            "clear": self.clear,
+            "exit": self.exit,
+        }
+        register_handlers()
+
+    def execute(self, line: str) -> str | None:
+        """
+        Runs a single command.
+        :param line: The command line, without its trailing newline.
+        :return: The response to print, or None for a blank line.
+        """
+        response = self.respond(line)
+        return str(response) if response is not None else None
+
+    def respond(self, line: str) -> str | QueryResponse | None:
+        """
+        Runs a single command, like execute(), except that streamed query results are left unformatted, so they can
+        be written out a chunk at a time. Their doc IDs are only found as the chunks are read, so they must be
+        written before the next command runs.
+        :param line: The command line, without its trailing newline.
+        :return: The response to print, a streamed QueryResponse, or None for a blank line.
+        """
+        args = line.split(' ')
+        if len(args) == 1 and args[0] == "":
+            return None
+        writes = args[0] not in self.READ_COMMANDS
+        if writes and self.saving is not None:
+            self._poll_save()
+        started = time.perf_counter_ns() if metrics.enabled else 0
+        command = self.commands.get(args[0])
+        if command is not None:
+            response = command(args[1:])
+        else:
+            try:
+                response = main(args, self.index)
+            except SearchException as ex:
+                # Failed commands still count towards the stats
+                response = f"error {ex}"
+            if not (isinstance(response, QueryResponse) and response.stream):
+                response = str(response)
+            if writes and self.wal is not None and self.wal.records >= self.snapshot_every and self.saving is None:
+                self._start_snapshot()
+        if started:
+            metrics.record_command(args[0], time.perf_counter_ns() - started)
+        return response
+
+    def _set_index(self, index: TermIndex = None):
+        # Let go of the current index first: a segmented index owns its directory of segment files
+        if index is not self.index:
+            self.index.close()
+        if self.segmented:
+            index = SegmentedIndex(f"{self.index_path}.segments", base=index)
+        elif index is None:
+            index = TermIndex()
+        self.index = index
+        index.journal = self.wal
+
+    def _take_snapshot(self):
+        self._poll_save(block=True)
+        self.index.save(self.index_path)
+        if self.wal is not None:
+            # Everything in the logs is part of the snapshot now
+            self.wal.reset()
+            self._remove_old_log()
+
+    def _start_snapshot(self):
+        # The child writes the index as it is now, so the records logged so far move aside until it's done
+        self._poll_save(block=True)
+        if self.wal is not None:
+            self.wal.rotate(f"{self.wal_path}.old")
+        index, path = self.index, self.index_path
+        self._start_save(BackgroundSave("snapshot", path, lambda: index.save(path)))
+
+    def _start_save(self, save: BackgroundSave):
+        self.saving = save
+        # Without fork, the save has already finished
+        self._poll_save()
+
+    def wait(self):
+        """
+        Waits for the background save, if there is one, to finish.
+        :return: None
+        """
+        self._poll_save(block=True)
+
+    def _poll_save(self, block: bool = False):
+        if self.saving is None or not self.saving.poll(block):
+            return
+        # A snapshot which failed still needs the old log, and the next one will take it over
+        if self.saving.name == "snapshot" and self.saving.ok:
+            self._remove_old_log()
+        self.last_save = self.saving
+        self.saving = None
+
+    def _remove_old_log(self):
+        if self.wal_path is not None and os.path.exists(f"{self.wal_path}.old"):
+            os.remove(f"{self.wal_path}.old")
+
+    def sync(self):
+        """
+        Makes sure every logged index change is on disk.
+        :return: None
+        """
+        if self.wal is not None:
+            self.wal.sync()
+
+    def save(self, args: list[str]) -> str:
+        option = args[0] if len(args) > 0 else ""
+        if option == "":
+            # Every change is already in the write-ahead log, so saving only has to flush it
+            if self.wal is None:
+                self._start_snapshot()
+                return "Snapshot started"
+            self.wal.sync()
+            return "Index saved"
+        # Show how the latest background save is getting on, after waiting for it to finish if asked to
+        if option == "wait":
+            self._poll_save(block=True)
+        elif option != "status":
+            return f"save error SAVE_INVALID_OPTION({option})"
+        save = self.saving or self.last_save
+        return f"save {save.status() if save is not None else 'idle'}"
+
+    def snapshot(self, args: list[str]) -> str:
+        # Write the whole index out as a new snapshot in the background, and start a fresh log
+        self._start_snapshot()
+        return "Snapshot started"
+
+    def load(self, args: list[str] = None) -> str:
+        self._poll_save(block=True)
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+        message = self._load_snapshot()
+        replayed = self._replay_log()
+        if self.wal_path is not None:
+            self.wal = WriteAheadLog(self.wal_path, self.wal_sync_every)
+            self.wal.records = replayed
+        self.index.journal = self.wal
+        if replayed > 0:
+            message += f" (replayed {replayed} logged commands)"
+        return message
+
+    def _load_snapshot(self) -> str:
+        # Open the binary segment if there is one, otherwise fall back to importing the JSON file
+        try:
+            self._set_index(TermIndex.open(self.index_path))
+            return "Loaded index.seg successfully"
+        except SearchIndexException:
+            pass
+        try:
+            if self.json_path is None:
+                raise SearchIndexException("SEARCH_JSON_DISABLED")
+            self._set_index(self._read_json())
+            return "Loaded index.json successfully"
+        except (OSError, SearchIndexException):
+            # We weren't able to load the file, so just create a new index
+            self._set_index()
+            return "WARNING - Unable to load index file! Defaulting to empty index..."
+
+    def _replay_log(self) -> int:
+        # Re-apply the changes made since the snapshot was taken, starting with those of a snapshot which never
+        # completed. If it did complete but the old log wasn't removed yet, replaying its records again is harmless:
+        # each record replaces a whole document, or clears the index, so the end result is the same
+        if self.wal_path is None:
+            return 0
+        replayed = 0
+        for path in (f"{self.wal_path}.old", self.wal_path):
+            for record in WriteAheadLog.read(path):
+                args = record.split(' ')
+                if args[0] == "clear":
+                    self._set_index()
+                else:
+                    main(args, self.index)
+                replayed += 1
+        return replayed
+
+    def export_json(self, args: list[str]) -> str:
+        # Save the JSON file in the background
+        self._poll_save(block=True)
+        index, path = self.index, self.json_path
+        self._start_save(BackgroundSave("export", path, lambda: write_json(index, path)))
+        return "JSON file export started"
+
+    def import_json(self, args: list[str]) -> str:
+        # Load the JSON file
+        try:
+            self._set_index(self._read_json())
+        except (OSError, SearchIndexException):
+            return "WARNING - Unable to import index.json! Keeping the current index..."
+        # The log can't describe a wholesale replacement, so snapshot the imported index straight away
+        self._take_snapshot()
+        return "Loaded index.json successfully"
+
+    def _read_json(self) -> TermIndex:
+        with open(self.json_path, "r") as in_file:
+            return TermIndex.parse(json.loads(in_file.read()))
+
+    def cache(self, args: list[str]) -> str:
+        # Switch the query cache on or off, or show its counters
+        cache = QueryCache.instantiate()
+        option = args[0] if len(args) > 0 else ""
+        if option == "on":
+            cache.enabled = True
+        elif option == "off":
+            cache.enabled = False
+            cache.clear()
+        elif option == "clear":
+            cache.clear()
+        return f"cache {cache}"
+
+    def stats(self, args: list[str]) -> str:
+        # Switch the metrics on or off, or reset them, then show them along with the shape of the index
+        option = args[0] if len(args) > 0 else ""
+        if option in ("on", "off"):
+            metrics.use_metrics(option == "on")
+        elif option == "reset":
+            metrics.reset()
+        elif option != "":
+            return f"stats error STATS_INVALID_OPTION({option})"
+        return f"stats {json.dumps(self.collect_stats(index=True))}"
+
+    def collect_stats(self, index: bool = False) -> dict:
+        """
+        Gathers the recorded latencies and the cache counters.
+        :param index: Whether to describe the index as well, which reads every term; only safe while no other
+        command is running.
+        :return: A JSON-serializable dict
+        """
+        collected = metrics.snapshot()
+        collected["caches"] = {"query": QueryCache.instantiate().stats(), "plan": PlanCache.instantiate().stats()}
+        if index:
+            collected["index"] = metrics.index_stats(self.index)
+        return collected
+
+    def bulk_load(self, args: list[str]) -> str:
+        # Index a whole file of index commands at once, using a pool of worker processes
+        if len(args) < 1 or len(args) > 2:
+            return f"bulk-load error BULK_LOAD_INVALID_ARGS({args})"
+        try:
+            workers = int(args[1]) if len(args) > 1 else None
+        except ValueError:
+            return f"bulk-load error BULK_LOAD_INVALID_WORKERS({args[1]})"
+        try:
+            indexed, errors = bulk_load(self.index, args[0], workers)
+        except OSError as ex:
+            return f"bulk-load error BULK_LOAD_FAILED({ex})"
+        # Bulk loads bypass the log, so snapshot the result instead
+        self._take_snapshot()
+        return f"bulk-load ok {indexed} errors {errors}"
+
+    def clear(self, args: list[str]) -> str:
+        self._set_index()
+        if self.wal is not None:
+            self.wal.append("clear")
+        return "Index cleared"
+
+    def exit(self, args: list[str]) -> str:
+        self._poll_save(block=True)
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+            self.index.journal = None
+        self.index.close()
+        self.done = True
+        return "Bye!"
+
+    def run_interactive(self):
+        """
+        Reads commands one at a time from a prompt, printing each response straight away.
+        :return: None
+        """
+        while not self.done:
+            try:
+                line = input("> ")
+            except EOFError:
+                break
+            response = self.respond(line)
+            self.sync()
+            if isinstance(response, QueryResponse):
+                for chunk in response.chunks():
+                    print(chunk, end="", flush=True)
+                print()
+            elif response is not None:
+                print(response)
+
+    def execute_lines(self, lines: list[str]) -> list[str | None]:
+        """
+        Runs a batch of commands in order, stopping early after an exit.
+        :param lines: The command lines.
+        :return: The responses, as execute() would give them.
+        """
+        responses = []
+        for line in lines:
+            responses.append(self.execute(line))
+            if self.done:
+                break
+        return responses
+
+    def respond_lines(self, lines: list[str]) -> Iterator[str | QueryResponse | None]:
+        """
+        Runs a batch of commands in order, stopping early after an exit. Each command only runs once the response
+        to the one before it has been taken, so a streamed response can be written out in between.
+        :param lines: The command lines.
+        :return: The responses, as respond() would give them.
+        """
+        for line in lines:
+            yield self.respond(line)
+            if self.done:
+                break
+
+    def run_batch(self, in_stream: BinaryIO, out_stream: BinaryIO, chunk_size: int = 1 << 20):
+        """
+        Reads commands from a stream in large chunks, without prompting, and writes the responses for each chunk
+        in a single write. Streamed query results are written a chunk of doc IDs at a time, as they're found.
+        :param in_stream: The binary stream to read commands from.
+        :param out_stream: The binary stream to write responses to.
+        :param chunk_size: How many bytes to read at a time.
+        :return: None
+        """
+        def write(responses: list[str]):
+            # Only acknowledge index commands once they're safely in the log
+            self.sync()
+            if len(responses) > 0:
+                out_stream.write(("\n".join(responses) + "\n").encode("utf-8"))
+                out_stream.flush()
+
+        pending = b""
+        while not self.done:
+            chunk = in_stream.read(chunk_size)
+            if chunk:
+                # Only handle complete lines; anything after the last newline waits for the next chunk
+                complete, _, pending = (pending + chunk).rpartition(b"\n")
+            else:
+                complete, pending = pending, b""
+            lines = [line.rstrip("\r") for line in complete.decode("utf-8").split("\n")]
+            responses = []
+            for response in self.respond_lines(lines):
+                if isinstance(response, QueryResponse):
+                    # Its results are read from the index as they're written, so write them before anything changes
+                    write(responses)
+                    responses = []
+                    for piece in response.chunks():
+                        out_stream.write(piece.encode("utf-8"))
+                    out_stream.write(b"\n")
+                    out_stream.flush()
+                elif response is not None:
+                    responses.append(response)
+            write(responses)
+            if not chunk:
+                break
+
+
+if __name__ == "__main__":
+    import io
+
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {"index_path": os.path.join(tmp_dir, "index.seg"), "json_path": os.path.join(tmp_dir, "index.json"),
+                 "wal_path": os.path.join(tmp_dir, "index.wal")}
+        shell = Shell(**paths, snapshot_every=3)
+        assert shell.load() == "WARNING - Unable to load index file! Defaulting to empty index..."
+        commands = b"index 1 soup tomato\r\nindex x soup\n\nfoo bar\nquery soup\nexit\nquery soup\n"
+        out = io.BytesIO()
+        shell.run_batch(io.BytesIO(commands), out, chunk_size=7)
+        assert out.getvalue() == (b"index ok 1\nindex error SEARCH_INDEX_INVALID_DOC_ID(x)\n"
+                                  b"error COMMAND_NOT_FOUND(foo)\nquery results 1\nBye!\n")
+
+        # Changes since the last snapshot are replayed from the log
+        shell = Shell(**paths, snapshot_every=3)
+        assert shell.load() == "WARNING - Unable to load index file! Defaulting to empty index... " \
+                               "(replayed 1 logged commands)"
+        for command in ["index 2 soup", "clear", "index 3 soup"]:
+            shell.execute(command)
+        # The snapshot is written in the background, and the log starts afresh straight away
+        assert shell.wal.records == 0 and shell.execute("save status").startswith("save snapshot ")
+        # Reads don't poll the save, so they never reap its child
+        saving = shell.saving
+        assert shell.execute("query soup") == "query results 3" and shell.saving is saving
+        assert shell.execute("save wait").startswith("save snapshot done ") and os.path.exists(paths["index_path"])
+        assert not os.path.exists(paths["wal_path"] + ".old")
+        shell.execute("index 4 soup fish")
+
+        # Latencies are only recorded while the metrics are on; the shape of the index is always there
+        assert json.loads(shell.execute("stats")[6:])["commands"] == {}
+        shell.execute("stats on")
+        for command in ["query soup", "query soup & fish", "cache", "foo bar"]:
+            shell.execute(command)
+        stats = json.loads(shell.execute("stats off")[6:])
+        assert stats["commands"]["query"]["count"] == 2 and stats["commands"]["cache"]["count"] == 1
+        assert stats["commands"]["foo"]["count"] == 1
+        assert set(stats["phases"]) == {"parse", "evaluate", "format"} and stats["phases"]["parse"]["count"] == 2
+        assert stats["caches"]["query"]["hits"] >= 0 and stats["caches"]["plan"]["misses"] >= 1
+        assert stats["index"]["terms"] == 2 and stats["index"]["largest_terms"] == [["soup", 2], ["fish", 1]]
+        assert shell.execute("stats foo") == "stats error STATS_INVALID_OPTION(foo)"
+        metrics.reset()
+        shell.execute("save")
+        shell = Shell(**paths)
+        assert shell.load() == "Loaded index.seg successfully (replayed 1 logged commands)"
+        assert shell.execute("query soup") == "query results 3 4"
+        shell.execute("exit")
+
+        # A segmented index gives the same responses, and keeps its segment files next to the snapshot
+        shell = Shell(**paths, segmented=True)
+        assert shell.load() == "Loaded index.seg successfully (replayed 1 logged commands)"
+        assert os.path.isdir(paths["index_path"] + ".segments")
+        for command in ["index 3 fish", "index 5 soup"]:
+            shell.execute(command)
+        assert shell.execute("query soup") == "query results 4 5"
+        assert shell.execute("snapshot") == "Snapshot started"
+        shell.execute("exit")
+        assert not os.path.exists(paths["index_path"] + ".segments")
+        shell = Shell(**paths)
+        assert shell.load() == "Loaded index.seg successfully"
+        assert shell.execute("query (soup | fish)") == "query results 3 4 5"
+        # Prefix queries aren't answered from the query cache, so they see new terms straight away
+        assert shell.execute("query s*&(f*|soup)") == "query results 4 5"
+        shell.execute("index 6 salad fennel")
+        assert shell.execute("query s*&(f*|soup)") == "query results 4 5 6"
+        assert shell.execute("query s*x") == "index error SEARCH_QUERY_TOKEN_INVALID(s*x)"
+
+        # Streamed results are written out a chunk at a time, before the commands after them run
+        out = io.BytesIO()
+        shell.run_batch(io.BytesIO(b"query stream=on soup | s*\nindex 7 soup\nquery limit=2 offset=1 soup\n"), out)
+        assert out.getvalue() == b"query results 4 5 6\nindex ok 7\nquery results 5 7\n"
+        assert list(QueryResponse(iter([1, 2, 3]), stream=True).chunks(2)) == ["query results ", "1 2", " 3"]
+        assert shell.execute("query stream=on offset=9 soup") == "query results "
+
+        # Exports are written in the background too, as the same bytes json.dumps() would give
+        assert shell.execute("export") == "JSON file export started"
+        shell.execute("index 8 late")
+        assert shell.execute("save wait").startswith("save export done ") and shell.execute("save x") == \
+               "save error SAVE_INVALID_OPTION(x)"
+        shell.execute("index 8 soup")
+        with open(paths["json_path"]) as in_file:
+            exported = in_file.read()
+        shell.execute("clear")
+        assert shell.execute("import") == "Loaded index.json successfully"
+        assert json.loads(exported) == shell.index.json() and shell.execute("query late") == "query results "
+        write_json(shell.index, paths["json_path"])
+        with open(paths["json_path"]) as in_file:
+            assert in_file.read() == json.dumps(shell.index.json())
+        shell.execute("exit")
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import math
+from collections import Counter
+
+from search import vector
+from search.postings import Postings, SortedArrayPostings
+
+# 1024 registers: a 1KB sketch, with a standard error of 1.04 / sqrt(1024), about 3%
+PRECISION = 10
+REGISTERS = 1 << PRECISION
+
+_MASK = (1 << 64) - 1
+_LOW = (1 << (64 - PRECISION)) - 1
+_ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+_POWERS = [2.0 ** -rank for rank in range(65 - PRECISION + 1)]
+
+
+def _mix(doc_id: int) -> int:
+    # splitmix64's finalizer: doc IDs are often sequential, and every bit of the hash has to look random
+    z = (doc_id + 0x9E3779B97F4A7C15) & _MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+    return z ^ (z >> 31)
+
+
+class HyperLogLog:
+    """
+    Fixed-size sketch of a set of doc IDs, from which the size of the set can be estimated. Sketches of several sets
+    merge, register by register, into the sketch of their union, so unions can be counted without reading a single
+    posting list. Doc IDs can't be taken back out: removed counts how many have been removed from the set since, so
+    a sketch which has drifted too far can be rebuilt.
+    """
+    __slots__ = ("registers", "removed")
+
+    def __init__(self, registers: bytearray = None):
+        self.registers = registers if registers is not None else bytearray(REGISTERS)
+        self.removed = 0
+
+    def add(self, doc_id: int):
+        hashed = _mix(doc_id)
+        register = hashed >> (64 - PRECISION)
+        # The position of the first 1 bit in the rest of the hash
+        rank = (64 - PRECISION) - (hashed & _LOW).bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    @staticmethod
+    def of(doc_ids: Postings) -> HyperLogLog:
+        """
+        Sketches a posting list.
+        :param doc_ids: The doc IDs to sketch.
+        :return: The new sketch.
+        """
+        if isinstance(doc_ids, SortedArrayPostings) and vector.enabled and len(doc_ids) >= vector.MIN_LENGTH:
+            return HyperLogLog(vector.sketch(doc_ids.ids, PRECISION))
+        sketch = HyperLogLog()
+        for doc_id in doc_ids:
+            sketch.add(doc_id)
+        return sketch
+
+    @staticmethod
+    def union(sketches: list[HyperLogLog]) -> HyperLogLog:
+        """
+        Merges sketches into a sketch of the union of their sets.
+        :param sketches: The sketches to merge, which are left as they are.
+        :return: The merged sketch.
+        """
+        if len(sketches) == 0:
+            return HyperLogLog()
+        if len(sketches) == 1:
+            return sketches[0]
+        registers = [sketch.registers for sketch in sketches]
+        if vector.enabled:
+            return HyperLogLog(vector.merge_registers(registers))
+        return HyperLogLog(bytearray(map(max, *registers)))
+
+    def estimate(self) -> int:
+        """
+        Estimates the number of distinct doc IDs added.
+        :return: The estimate.
+        """
+        ranks = Counter(self.registers)
+        total = sum(count * _POWERS[rank] for rank, count in ranks.items())
+        estimate = _ALPHA * REGISTERS * REGISTERS / total
+        zeros = ranks.get(0, 0)
+        if estimate <= 2.5 * REGISTERS and zeros > 0:
+            # Small sets leave registers empty, and counting those is more accurate
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+        return round(estimate)
+
+
+if __name__ == "__main__":
+    import random
+
+    from search.postings import make_postings
+
+    assert HyperLogLog().estimate() == 0
+    generator = random.Random(1)
+    for size in [10, 1000, 100000]:
+        doc_ids = make_postings(generator.sample(range(10 * size), size))
+        for enable in [False, True]:
+            vector.use_numpy(enable)
+            sketch = HyperLogLog.of(doc_ids)
+            assert abs(sketch.estimate() - size) <= max(2, size * 0.1), (size, sketch.estimate())
+            # The NumPy and pure-Python versions hash and rank doc IDs identically
+            assert sketch.registers == HyperLogLog.of(list(doc_ids)).registers
+    vector.use_numpy(True)
+
+    left = make_postings(range(0, 60000))
+    right = make_postings(range(40000, 100000))
+    for enable in [False, True]:
+        vector.use_numpy(enable)
+        merged = HyperLogLog.union([HyperLogLog.of(left), HyperLogLog.of(right)])
+        assert abs(merged.estimate() - 100000) < 10000
+    vector.use_numpy(True)
@@ -0,0 +1,629 @@
+from __future__ import annotations
+
+import itertools
+import json
+import sys
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from typing import Iterable, Iterator
+
+from search.exception import SearchQueryException, SearchIndexException
+from search.postings import Postings, make_postings, union_all
+from search.radix import RadixNode
+from search.segment import SegmentReader, write_segment
+from search.sketch import HyperLogLog
+
+# Shared by every index, so a generation number is never reused, even across indexes.
+_generations = itertools.count(1)
+
+# The most terms a prefix query may expand to
+MAX_PREFIX_TERMS = 4096
+
+# A prefix's union is only worth keeping around if it saves unioning at least this many posting lists
+AGGREGATE_MIN_TERMS = 8
+
+# Terms with at least this many documents keep a HyperLogLog sketch of them once one has been asked for; smaller
+# terms are sketched on demand
+SKETCH_MIN_DOCS = 256
+
+
+class PrefixAggregate:
+    """
+    Union of the postings of every term starting with a prefix, and the number of those terms.
+    """
+    __slots__ = ("postings", "terms")
+
+    def __init__(self, postings: Postings, terms: int):
+        self.postings = postings
+        self.terms = terms
+
+
+class TermIndex:
+    """
+    Term dictionary for our search indexing system.
+    Every distinct token maps straight to its posting list in a hash map, so an exact lookup is a single dict probe
+    rather than a walk down one node per character. A forward index (doc_id -> tokens) lets us replace a document by
+    touching only the postings of its previous tokens. Prefix lookups can optionally be served by a compressed
+    radix tree over the vocabulary. The unions behind the most recently queried broad prefixes are kept, and updated
+    in place as documents are added and removed, so a query on a short prefix doesn't re-union thousands of posting
+    lists every time.
+    The index can be backed by an on-disk segment: postings and forward index entries are then decoded from the
+    segment the first time they're needed, and shadowed by the in-memory dicts from then on.
+    Each term also has a generation number which changes whenever its postings do, so cached query results can be
+    checked for staleness. Large terms keep a HyperLogLog sketch of their postings, for approximate counts.
+    The doc IDs of every live document are kept as a posting list of their own, which negated queries subtract from.
+    Postings also record how many times their term occurs in each document, for ranking; a document's length, for
+    the same purpose, is its number of distinct tokens.
+    """
+
+    def __init__(self, prefix_index: bool = True, segment: SegmentReader = None, prefix_aggregates: int = 32):
+        self.terms = dict[str, Postings]()
+        self.doc_tokens = dict[int, tuple[str, ...]]()
+        self.segment = segment
+        self.doc_count = segment.doc_count if segment is not None else 0
+        # The total length of every document, for their average
+        self.token_count = segment.token_count if segment is not None else 0
+        self.radix = RadixNode() if prefix_index else None
+        self.generations = dict[str, int]()
+        self.base_generation = next(_generations)
+        # Write-ahead log which index commands are recorded in once they've been applied, if any
+        self.journal = None
+        # Least recently used last; queries running side by side share them under the lock
+        self.max_aggregates = prefix_aggregates
+        self.aggregates = OrderedDict[str, PrefixAggregate]()
+        self.aggregate_lengths = Counter[int]()
+        self.aggregate_lock = threading.Lock()
+        self.sketches = dict[str, HyperLogLog]()
+        # Built from the segment the first time it's needed, like everything else read from it
+        self.live = make_postings() if segment is None else None
+
+    def __str__(self):
+        return json.dumps(self.json())
+
+    def __len__(self):
+        return self.doc_count
+
+    def get_doc_ids_containing_token(self, token: str) -> Postings:
+        """
+        Retrieves all doc_ids containing the given token.
+        :param token: The token to look up
+        :return: The set of doc_ids containing the given token
+        :raises: SearchQueryException if we weren't able to find the token in the index!
+        """
+        postings = self.postings(token)
+        if postings is None:
+            raise SearchQueryException(f"SEARCH_QUERY_TOKEN_NOT_FOUND({token})")
+        return postings
+
+    def postings(self, token: str) -> Postings | None:
+        """
+        Retrieves the posting list for the given token, if there is one.
+        :param token: The token to look up
+        :return: The Postings for the token, or None if it isn't in the index.
+        """
+        postings = self.terms.get(token)
+        if postings is None:
+            postings = self._load_postings(token)
+            if postings is None:
+                return None
+        return postings if len(postings) > 0 else None
+
+    def posting_length(self, token: str) -> int:
+        """
+        Counts the documents containing the given token, without decoding its postings from the segment.
+        :param token: The token to look up
+        :return: The number of documents, or 0 if the token isn't in the index.
+        """
+        postings = self.terms.get(token)
+        if postings is not None:
+            return len(postings)
+        if self.segment is None:
+            return 0
+        ordinal = self.segment.find_term(token)
+        return self.segment.postings_length(ordinal) if ordinal >= 0 else 0
+
+    def doc_length(self, doc_id: int) -> int:
+        """
+        Retrieves the length of a document, for ranking: its number of distinct tokens.
+        :param doc_id: The document ID
+        :return: The length, or 0 if the document isn't in the index.
+        """
+        tokens = self.doc_tokens.get(doc_id)
+        if tokens is None:
+            return self.segment.doc_length(doc_id) if self.segment is not None else 0
+        return len(tokens)
+
+    def average_doc_length(self) -> float:
+        return self.token_count / self.doc_count if self.doc_count > 0 else 0.0
+
+    def live_docs(self) -> Postings:
+        """
+        Retrieves the doc IDs of every document in the index. They're updated in place as documents come and go.
+        :return: The Postings of every live document.
+        """
+        if self.live is None:
+            in_memory = (doc_id for doc_id, tokens in self.doc_tokens.items() if len(tokens) > 0)
+            from_segment = (doc_id for doc_id in self.segment.doc_ids() if doc_id not in self.doc_tokens)
+            self.live = make_postings(itertools.chain(in_memory, from_segment))
+        return self.live
+
+    def generation(self, token: str) -> int:
+        """
+        Retrieves the generation number of the given token, which changes every time the token's postings do.
+        :param token: The token to look up
+        :return: The token's generation
+        """
+        return self.generations.get(token, self.base_generation)
+
+    def _load_postings(self, token: str) -> Postings | None:
+        if self.segment is None:
+            return None
+        ordinal = self.segment.find_term(token)
+        if ordinal < 0:
+            return None
+        postings = self.terms[sys.intern(token)] = self.segment.postings(ordinal)
+        return postings
+
+    def get_doc_tokens(self, doc_id: int) -> tuple[str, ...] | None:
+        """
+        Retrieves the tokens of an indexed document.
+        :param doc_id: The document ID
+        :return: The document's unique tokens, or None if it isn't in the index.
+        """
+        return self._load_doc_tokens(doc_id) or None
+
+    def _load_doc_tokens(self, doc_id: int) -> tuple[str, ...] | None:
+        tokens = self.doc_tokens.get(doc_id)
+        if tokens is None and self.segment is not None:
+            tokens = self.segment.doc_terms(doc_id)
+        return tokens
+
+    def terms_with_prefix(self, prefix: str) -> Iterator[str]:
+        """
+        Iterates over the indexed terms starting with the given prefix.
+        :param prefix: The prefix to look up
+        :return: An iterator of terms; sorted if the prefix index is enabled or the index is backed by a segment.
+        """
+        if self.radix is not None:
+            in_memory = self.radix.iter_prefix(prefix)
+        else:
+            in_memory = (term for term in self.terms if term.startswith(prefix) and len(self.terms[term]) > 0)
+        if self.segment is None:
+            return in_memory
+        candidates = set(in_memory)
+        candidates.update(self.segment.term(ordinal) for ordinal in self.segment.prefix_range(prefix))
+        return (term for term in sorted(candidates) if self.postings(term) is not None)
+
+    def prefix_postings(self, prefix: str, max_terms: int = MAX_PREFIX_TERMS) -> Postings | None:
+        """
+        Retrieves the union of the posting lists of every term starting with the given prefix.
+        :param prefix: The prefix to look up
+        :param max_terms: The most terms the prefix may expand to.
+        :return: The Postings of the prefix, or None if no indexed term starts with it.
+        :raises: SearchQueryException if more than max_terms terms start with the prefix.
+        """
+        with self.aggregate_lock:
+            aggregate = self.aggregates.get(prefix)
+            if aggregate is not None:
+                self.aggregates.move_to_end(prefix)
+        if aggregate is not None:
+            if aggregate.terms > max_terms:
+                raise SearchQueryException(f"SEARCH_QUERY_PREFIX_TOO_BROAD({prefix}*)")
+            return aggregate.postings if len(aggregate.postings) > 0 else None
+        if self.radix is not None and self.segment is None and self.radix.count_prefix(prefix) > max_terms:
+            # Rejected without walking a single term
+            raise SearchQueryException(f"SEARCH_QUERY_PREFIX_TOO_BROAD({prefix}*)")
+        terms = list(itertools.islice(self.terms_with_prefix(prefix), max_terms + 1))
+        if len(terms) > max_terms:
+            raise SearchQueryException(f"SEARCH_QUERY_PREFIX_TOO_BROAD({prefix}*)")
+        postings = union_all([self.postings(term) for term in terms])
+        if len(terms) >= AGGREGATE_MIN_TERMS and self.max_aggregates > 0:
+            with self.aggregate_lock:
+                if prefix not in self.aggregates:
+                    self.aggregate_lengths[len(prefix)] += 1
+                self.aggregates[prefix] = PrefixAggregate(postings, len(terms))
+                while len(self.aggregates) > self.max_aggregates:
+                    evicted, _ = self.aggregates.popitem(last=False)
+                    self.aggregate_lengths[len(evicted)] -= 1
+                    if self.aggregate_lengths[len(evicted)] == 0:
+                        del self.aggregate_lengths[len(evicted)]
+        return postings if len(postings) > 0 else None
+
+    def sketch(self, token: str) -> HyperLogLog | None:
+        """
+        Retrieves a HyperLogLog sketch of the given token's postings. Sketches of large terms are kept and updated as
+        documents are added; documents can't be taken back out of a sketch, so one is rebuilt once more than an
+        eighth of its term's documents have been removed since it was built.
+        :param token: The token to look up
+        :return: The sketch, or None if the token isn't in the index.
+        """
+        postings = self.postings(token)
+        if postings is None:
+            return None
+        if len(postings) < SKETCH_MIN_DOCS:
+            return HyperLogLog.of(postings)
+        sketch = self.sketches.get(token)
+        if sketch is None or sketch.removed * 8 > len(postings):
+            sketch = self.sketches[token] = HyperLogLog.of(postings)
+        return sketch
+
+    def _aggregates_of(self, token: str) -> Iterator[PrefixAggregate]:
+        # Only called by index updates, which never run alongside queries
+        for length in self.aggregate_lengths:
+            if length <= len(token):
+                aggregate = self.aggregates.get(token[:length])
+                if aggregate is not None:
+                    yield aggregate
+
+    def iter_postings(self) -> Iterator[tuple[str, Postings]]:
+        """
+        Iterates over every (term, postings) pair in the index, without caching anything decoded from the segment.
+        :return: An iterator of (term, postings) pairs
+        """
+        for term, postings in self.terms.items():
+            if len(postings) > 0:
+                yield term, postings
+        if self.segment is not None:
+            for ordinal in range(self.segment.term_count):
+                term = self.segment.term(ordinal)
+                if term not in self.terms:
+                    yield term, self.segment.postings(ordinal)
+
+    def posting_lengths(self) -> Iterator[tuple[str, int]]:
+        """
+        Iterates over the length of every term's postings, without decoding anything from the segment.
+        :return: An iterator of (term, number of documents) pairs
+        """
+        for term, postings in self.terms.items():
+            if len(postings) > 0:
+                yield term, len(postings)
+        if self.segment is not None:
+            for ordinal in range(self.segment.term_count):
+                term = self.segment.term(ordinal)
+                if term not in self.terms:
+                    yield term, self.segment.postings_length(ordinal)
+
+    def stats(self) -> dict:
+        """
+        Counts the in-memory structures of the index.
+        :return: A JSON-serializable dict
+        """
+        return {
+            "docs": self.doc_count,
+            "terms_in_memory": len(self.terms),
+            "segment_terms": self.segment.term_count if self.segment is not None else 0,
+            "radix_nodes": self.radix.node_count() if self.radix is not None else 0,
+            "prefix_aggregates": len(self.aggregates),
+        }
+
+    def iter_doc_tokens(self) -> Iterator[tuple[int, tuple[str, ...]]]:
+        """
+        Iterates over every (doc_id, tokens) pair in the forward index.
+        :return: An iterator of (doc_id, tokens) pairs
+        """
+        for doc_id, tokens in self.doc_tokens.items():
+            if len(tokens) > 0:
+                yield doc_id, tokens
+        if self.segment is not None:
+            for doc_id in self.segment.doc_ids():
+                if doc_id not in self.doc_tokens:
+                    yield doc_id, self.segment.doc_terms(doc_id)
+
+    def remove_doc(self, doc_id: int):
+        """
+        Removes a document from the index, dropping any terms left without documents.
+        :param doc_id: The document ID
+        :return: None
+        """
+        old_tokens = self._load_doc_tokens(doc_id)
+        if not old_tokens:
+            return
+        if self.segment is None:
+            del self.doc_tokens[doc_id]
+        else:
+            # Leave an empty entry behind, so the segment's copy of the document stays hidden
+            self.doc_tokens[doc_id] = ()
+        self.doc_count -= 1
+        self.token_count -= len(old_tokens)
+        if self.live is not None:
+            self.live.remove(doc_id)
+        for token in old_tokens:
+            postings = self.terms.get(token)
+            if postings is None:
+                postings = self._load_postings(token)
+                if postings is None:
+                    continue
+            postings.remove(doc_id)
+            self.generations[token] = next(_generations)
+            for aggregate in self._aggregates_of(token) if self.aggregates else ():
+                # The whole document is going, so none of its other terms can keep it in the union
+                aggregate.postings.remove(doc_id)
+                aggregate.terms -= len(postings) == 0
+            sketch = self.sketches.get(token) if self.sketches else None
+            if sketch is not None:
+                sketch.removed += 1
+            if len(postings) == 0:
+                if self.radix is not None:
+                    self.radix.remove(token)
+                # As above, empty postings are kept while they would otherwise expose the segment's copy
+                if self.segment is None or self.segment.find_term(token) < 0:
+                    del self.terms[token]
+                    del self.generations[token]
+                if sketch is not None:
+                    del self.sketches[token]
+
+    def add_doc(self, doc_id: int, tokens: list[str]):
+        """
+        Public method to add a document.
+        :param doc_id: The document ID
+        :param tokens: The list of string tokens.
+        :return: None
+        """
+        # Remove the doc id and all of its existing tokens, if any!
+        self.remove_doc(doc_id)
+        # Interning means the forward index and the term dictionary share a single copy of each token.
+        frequencies = Counter(sys.intern(token) for token in tokens)
+        unique_tokens = tuple(frequencies)
+        for token in unique_tokens:
+            postings = self.terms.get(token)
+            if postings is None:
+                postings = self._load_postings(token)
+                if postings is None:
+                    postings = self.terms[token] = make_postings()
+            new_term = len(postings) == 0
+            if new_term and self.radix is not None:
+                self.radix.insert(token)
+            postings.add(doc_id, frequencies[token])
+            self.generations[token] = next(_generations)
+            for aggregate in self._aggregates_of(token) if self.aggregates else ():
+                aggregate.postings.add(doc_id)
+                aggregate.terms += new_term
+            sketch = self.sketches.get(token) if self.sketches else None
+            if sketch is not None:
+                sketch.add(doc_id)
+        self.doc_tokens[doc_id] = unique_tokens
+        self.doc_count += 1
+        self.token_count += len(unique_tokens)
+        if self.live is not None:
+            self.live.add(doc_id)
+
+    def merge(self, doc_tokens: dict[int, tuple[str, ...]], term_doc_ids: dict[str, Iterable[int]],
+              term_frequencies: dict[str, Iterable[int]] = None):
+        """
+        Adds a batch of documents at once, from a partial index built elsewhere (see search.bulk).
+        Documents already in the index are replaced, as they would be by add_doc.
+        :param doc_tokens: The forward index of the batch: doc_id -> unique tokens.
+        :param term_doc_ids: The postings of the batch: token -> ascending doc IDs.
+        :param term_frequencies: The term frequencies of the batch, parallel to term_doc_ids, for the tokens which
+        occur more than once in any of its documents.
+        :return: None
+        """
+        for doc_id in doc_tokens:
+            self.remove_doc(doc_id)
+        # A batch touches too many terms to update the prefix unions (or sketches) one document at a time
+        self.aggregates.clear()
+        self.aggregate_lengths.clear()
+        self.sketches.clear()
+        for token, doc_ids in term_doc_ids.items():
+            batch = make_postings(doc_ids, presorted=True)
+            frequencies = term_frequencies.get(token) if term_frequencies else None
+            if frequencies is not None:
+                batch.tfs = array('H', frequencies)
+                batch.max_tf = None
+            token = sys.intern(token)
+            postings = self.terms.get(token)
+            if postings is None:
+                postings = self._load_postings(token)
+            if postings is None or len(postings) == 0:
+                if self.radix is not None:
+                    self.radix.insert(token)
+                self.terms[token] = batch
+            else:
+                # The batch's documents were removed above, so none of them are left in the postings
+                self.terms[token] = union_all([postings, batch], disjoint=True)
+            self.generations[token] = next(_generations)
+        for doc_id, tokens in doc_tokens.items():
+            self.doc_tokens[doc_id] = tuple(sys.intern(token) for token in tokens)
+        self.doc_count += len(doc_tokens)
+        self.token_count += sum(len(tokens) for tokens in doc_tokens.values())
+        if self.live is not None:
+            self.live = self.live.union(make_postings(doc_tokens))
+
+    def save(self, path: str):
+        """
+        Writes the index out as a binary segment file.
+        :param path: The path to write to.
+        :return: None
+        """
+        write_segment(path, self.iter_postings(), self.iter_doc_tokens())
+
+    def close(self):
+        """
+        Releases the segment file backing the index, if any. Postings already handed out stay valid.
+        :return: None
+        """
+        if self.segment is not None:
+            self.segment.close()
+
+    @staticmethod
+    def open(path: str, prefix_index: bool = True) -> TermIndex:
+        """
+        Opens an index backed by a binary segment file. Nothing beyond the segment header is read until it's needed.
+        :param path: The path of the segment file.
+        :param prefix_index: Whether to keep a radix tree of terms added after opening, for prefix lookups.
+        :return: The opened TermIndex
+        :raises: SearchIndexException if the segment can't be opened.
+        """
+        return TermIndex(prefix_index=prefix_index, segment=SegmentReader(path))
+
+    def json(self):
+        """
+        Exports the index in the per-character tree layout of index.json, so older builds can still read it.
+        :return: A JSON-serializable dict
+        """
+        return json_tree(self.iter_postings())
+
+    @staticmethod
+    def parse(raw: dict, prefix_index: bool = True) -> TermIndex:
+        """
+        Imports an index from the per-character tree layout of index.json.
+        :param raw: The decoded JSON payload
+        :param prefix_index: Whether to build the radix tree for prefix lookups.
+        :return: The parsed TermIndex
+        """
+        try:
+            doc_tokens = dict[int, list[str]]()
+            # Walk the tree with an explicit stack, so deep trees can't hit the recursion limit
+            stack = [(raw, "")]
+            while stack:
+                node, token = stack.pop()
+                if len(node['doc_ids']) > 0:
+                    token = sys.intern(token)
+                    for doc_id in node['doc_ids']:
+                        doc_tokens.setdefault(doc_id, []).append(token)
+                for char, child in node.get('children', {}).items():
+                    stack.append((child, token + char))
+            index = TermIndex(prefix_index=prefix_index)
+            for doc_id in sorted(doc_tokens):
+                index.add_doc(doc_id, doc_tokens[doc_id])
+            return index
+        except Exception as ex:
+            raise SearchIndexException("SEARCH_PARSE_FAILED") from ex
+
+
+def json_tree(postings: Iterable[tuple[str, Postings]]) -> dict:
+    """
+    Builds the per-character tree layout of index.json.
+    :param postings: (term, postings) pairs for every term.
+    :return: A JSON-serializable dict
+    """
+    root = {'char': None, 'doc_ids': []}
+    for token, doc_ids in postings:
+        node = root
+        for char in token:
+            children = node.setdefault('children', {})
+            child = children.get(char)
+            if child is None:
+                child = children[char] = {'char': char, 'doc_ids': []}
+            node = child
+        node['doc_ids'] = list(doc_ids)
+    return root
+
+
+if __name__ == "__main__":
+    # Quick test!
+    root = TermIndex(prefix_index=True)
+
+    root.add_doc(1, ["soup", "tomato", "cream", "salt"])
+    assert list(root.get_doc_ids_containing_token("soup")) == [1]
+    assert list(root.get_doc_ids_containing_token("tomato")) == [1]
+    assert list(root.get_doc_ids_containing_token("cream")) == [1]
+    assert list(root.get_doc_ids_containing_token("salt")) == [1]
+
+    root.add_doc(2, ["cake", "sugar", "eggs", "flour", "sugar", "cocoa", "cream", "butter"])
+    assert list(root.get_doc_ids_containing_token("cake")) == [2]
+    assert list(root.get_doc_ids_containing_token("sugar")) == [2]
+    assert list(root.get_doc_ids_containing_token("eggs")) == [2]
+    assert list(root.get_doc_ids_containing_token("flour")) == [2]
+    assert list(root.get_doc_ids_containing_token("cocoa")) == [2]
+    assert list(root.get_doc_ids_containing_token("cream")) == [1, 2]
+    assert list(root.get_doc_ids_containing_token("butter")) == [2]
+    # Repeated tokens are only indexed once, but counted
+    assert root.postings("sugar").frequency(2) == 2 and root.postings("cream").frequency(1) == 1
+    assert root.doc_length(2) == 7 and root.average_doc_length() == 5.5
+
+    root.add_doc(1, ["bread", "butter", "salt"])
+    assert root.postings("soup") is None
+    assert root.postings("tomato") is None
+    assert list(root.get_doc_ids_containing_token("cream")) == [2]
+    assert list(root.get_doc_ids_containing_token("salt")) == [1]
+    assert list(root.get_doc_ids_containing_token("butter")) == [1, 2]
+
+    root.add_doc(3, ["soup", "fish", "potato", "salt", "pepper"])
+    assert list(root.get_doc_ids_containing_token("soup")) == [3]
+    assert list(root.get_doc_ids_containing_token("salt")) == [1, 3]
+    assert list(root.get_doc_ids_containing_token("fish")) == [3]
+    assert list(root.get_doc_ids_containing_token("pepper")) == [3]
+    assert list(root.terms_with_prefix("s")) == ["salt", "soup", "sugar"]
+    salt_generation = root.generation("salt")
+    soup_generation = root.generation("soup")
+
+    # Replaced tokens should be dropped from the dictionary entirely
+    root.add_doc(2, ["cake"])
+    assert root.postings("sugar") is None
+    assert list(root.terms_with_prefix("s")) == ["salt", "soup"]
+    assert root.generation("salt") == salt_generation and root.generation("soup") == soup_generation
+    assert root.generation("sugar") == root.base_generation
+    assert root.generation("cake") != root.base_generation
+    assert root.doc_tokens == {1: ("bread", "butter", "salt"), 2: ("cake",),
+                               3: ("soup", "fish", "potato", "salt", "pepper")}
+
+    # Prefix unions are kept for broad prefixes, and follow documents as they come and go
+    for doc_id, word in enumerate(["sage", "salmon", "sardine", "sauce", "savory", "scallop", "seed", "sesame"], 10):
+        root.add_doc(doc_id, [word, "herb"])
+    assert list(root.prefix_postings("s")) == [1, 3, 10, 11, 12, 13, 14, 15, 16, 17]
+    assert root.aggregates["s"].terms == 10 and "sa" not in root.aggregates
+    assert list(root.prefix_postings("sa")) == [1, 3, 10, 11, 12, 13, 14]
+    root.add_doc(18, ["sorrel"])
+    root.add_doc(10, ["herb"])
+    assert list(root.prefix_postings("s")) == [1, 3, 11, 12, 13, 14, 15, 16, 17, 18]
+    assert root.aggregates["s"].terms == 10
+    assert root.prefix_postings("x") is None
+    try:
+        root.prefix_postings("s", max_terms=9)
+        assert False
+    except SearchQueryException as error:
+        assert str(error) == "SEARCH_QUERY_PREFIX_TOO_BROAD(s*)"
+    try:
+        root.prefix_postings("", max_terms=9)
+        assert False
+    except SearchQueryException as error:
+        assert str(error) == "SEARCH_QUERY_PREFIX_TOO_BROAD(*)"
+    for doc_id in range(11, 19):
+        root.remove_doc(doc_id)
+    assert list(root.prefix_postings("s")) == [1, 3] and root.aggregates["s"].terms == 2
+    root.remove_doc(10)
+    assert list(root.live_docs()) == [1, 2, 3]
+
+    assert dict(root.posting_lengths()) == {"bread": 1, "butter": 1, "salt": 2, "cake": 1, "soup": 1, "fish": 1,
+                                            "potato": 1, "pepper": 1}
+    assert root.stats() == {"docs": 3, "terms_in_memory": 8, "segment_terms": 0, "radix_nodes": 12,
+                            "prefix_aggregates": 1}
+
+    # The JSON export round-trips through the index.json layout
+    parsed = TermIndex.parse(json.loads(str(root)))
+    assert {doc_id: set(tokens) for doc_id, tokens in parsed.doc_tokens.items()} == \
+           {doc_id: set(tokens) for doc_id, tokens in root.doc_tokens.items()}
+    assert list(parsed.get_doc_ids_containing_token("salt")) == [1, 3]
+
+    # ...and so does the binary segment format, with lazily decoded postings
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root.save(os.path.join(tmp_dir, "index.seg"))
+        opened = TermIndex.open(os.path.join(tmp_dir, "index.seg"))
+        assert len(opened) == 3 and len(opened.terms) == 0
+        assert list(opened.get_doc_ids_containing_token("salt")) == [1, 3]
+        assert list(opened.terms) == ["salt"]
+        assert list(opened.terms_with_prefix("s")) == ["salt", "soup"]
+        opened.add_doc(3, ["sugar"])
+        opened.add_doc(4, ["salt", "bread"])
+        assert len(opened) == 4
+        assert opened.postings("soup") is None
+        assert list(opened.get_doc_ids_containing_token("salt")) == [1, 4]
+        assert list(opened.terms_with_prefix("s")) == ["salt", "sugar"]
+        assert opened.live is None and list(opened.live_docs()) == [1, 2, 3, 4]
+        opened.remove_doc(2)
+        assert list(opened.live_docs()) == [1, 3, 4]
+        opened.add_doc(2, ["cake", "cake"])
+        assert opened.doc_length(1) == 3 and opened.doc_length(2) == 1 and opened.token_count == 7
+        opened.save(os.path.join(tmp_dir, "index.seg"))
+        reopened = TermIndex.open(os.path.join(tmp_dir, "index.seg"))
+        assert dict(reopened.iter_doc_tokens()) == {1: ("bread", "butter", "salt"), 2: ("cake",), 3: ("sugar",),
+                                                    4: ("salt", "bread")}
+        assert list(reopened.get_doc_ids_containing_token("bread")) == [1, 4]
+        assert reopened.postings("cake").frequency(2) == 2 and reopened.postings("bread").tfs is None
+        assert reopened.doc_length(4) == 2 and reopened.token_count == 7
+        reopened.segment.close()
+        opened.segment.close()
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # Without NumPy, posting lists fall back to their pure-Python algorithms
+    numpy = None
+
+# Below this many doc IDs, the overhead of calling into NumPy outweighs what it saves
+MIN_LENGTH = 256
+
+# A posting list holding more than this fraction of the doc IDs up to its largest is dense: combining it through a
+# bitmap over that range is cheaper than searching or sorting the sorted arrays
+DENSE = 1 / 32
+
+enabled = numpy is not None
+
+
+def use_numpy(enable: bool):
+    """
+    Switches the NumPy implementations on or off. They can only be switched on when NumPy is installed.
+    :param enable: Whether to use NumPy.
+    :return: None
+    """
+    global enabled
+    enabled = enable and numpy is not None
+
+
+def _view(ids: array):
+    # Zero-copy: array('I') and uint32 share the same layout
+    return numpy.frombuffer(ids, dtype=numpy.uint32)
+
+
+def _to_array(values) -> array:
+    # Always copies, so the result never keeps a view of (and so locks the size of) an input array
+    ids = array('I')
+    ids.frombytes(values.astype(numpy.uint32, copy=False).tobytes())
+    return ids
+
+
+def intersection(a: array, b: array) -> array:
+    """
+    Intersects two sorted arrays of doc IDs.
+    :return: A new sorted array of the doc IDs in both.
+    """
+    small, big = (_view(a), _view(b)) if len(a) <= len(b) else (_view(b), _view(a))
+    if len(small) == 0:
+        return array('I')
+    universe = int(max(small[-1], big[-1])) + 1
+    if len(small) > universe * DENSE:
+        # Both are dense: look the small list up in a bitmap of the big one
+        bitmap = numpy.zeros(universe, dtype=bool)
+        bitmap[big] = True
+        return _to_array(small[bitmap[small]])
+    # Otherwise binary search the big list for every doc ID of the small one at once
+    positions = numpy.searchsorted(big, small)
+    numpy.minimum(positions, len(big) - 1, out=positions)
+    return _to_array(small[big[positions] == small])
+
+
+def difference(a: array, b: array) -> array:
+    """
+    Removes the doc IDs of one sorted array from another.
+    :return: A new sorted array of the doc IDs in a but not in b.
+    """
+    keep, removed = _view(a), _view(b)
+    if len(keep) == 0 or len(removed) == 0:
+        return array('I', a)
+    if len(removed) < len(keep):
+        # Binary search for each doc ID to remove, then copy everything else
+        positions = numpy.searchsorted(keep, removed)
+        numpy.minimum(positions, len(keep) - 1, out=positions)
+        return _to_array(numpy.delete(keep, positions[keep[positions] == removed]))
+    positions = numpy.searchsorted(removed, keep)
+    numpy.minimum(positions, len(removed) - 1, out=positions)
+    return _to_array(keep[removed[positions] != keep])
+
+
+def union(postings: list[array], disjoint: bool = False) -> array:
+    """
+    Unions any number of sorted arrays of doc IDs.
+    :param disjoint: Whether the arrays are known not to share any doc IDs.
+    :return: A new sorted array of the doc IDs in any of them.
+    """
+    views = [_view(ids) for ids in postings if len(ids) > 0]
+    if len(views) == 0:
+        return array('I')
+    universe = max(int(view[-1]) for view in views) + 1
+    if sum(len(view) for view in views) > universe * DENSE:
+        # Dense: mark every doc ID in a bitmap, which comes out sorted and without duplicates
+        bitmap = numpy.zeros(universe, dtype=bool)
+        for view in views:
+            bitmap[view] = True
+        return _to_array(numpy.flatnonzero(bitmap))
+    merged = numpy.concatenate(views)
+    # A stable sort merges the already sorted runs
+    merged.sort(kind="stable")
+    if not disjoint and len(merged) > 1:
+        keep = numpy.empty(len(merged), dtype=bool)
+        keep[0] = True
+        numpy.not_equal(merged[1:], merged[:-1], out=keep[1:])
+        merged = merged[keep]
+    return _to_array(merged)
+
+
+def union_frequencies(postings: list[array], frequencies: list[array]) -> tuple[array, array]:
+    """
+    Unions sorted arrays of doc IDs which don't share any, along with their term frequencies.
+    :param postings: The arrays of doc IDs.
+    :param frequencies: The arrays('H') of term frequencies, parallel to them.
+    :return: A new sorted array of every doc ID, and a new array of their frequencies.
+    """
+    ids = numpy.concatenate([_view(doc_ids) for doc_ids in postings])
+    tfs = numpy.concatenate([numpy.frombuffer(part, dtype=numpy.uint16) for part in frequencies])
+    # A stable sort merges the already sorted runs
+    order = numpy.argsort(ids, kind="stable")
+    merged = array('H')
+    merged.frombytes(tfs[order].tobytes())
+    return _to_array(ids[order]), merged
+
+
+def sketch(ids: array, precision: int) -> bytearray:
+    """
+    Builds the registers of a HyperLogLog sketch of a sorted array of doc IDs, hashing them as search.sketch does.
+    :param precision: The number of hash bits which pick a register.
+    :return: The registers, one byte each.
+    """
+    with numpy.errstate(over="ignore"):
+        # splitmix64's finalizer, wrapping around like the pure-Python version's masking
+        z = _view(ids).astype(numpy.uint64) + numpy.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+        z ^= z >> numpy.uint64(31)
+    width = 64 - precision
+    registers = (z >> numpy.uint64(width)).astype(numpy.intp)
+    low = z & numpy.uint64((1 << width) - 1)
+    # The bit length of each low part: from its logarithm, then corrected where rounding to a double overshot
+    with numpy.errstate(divide="ignore"):
+        bits = numpy.floor(numpy.log2(low.astype(numpy.float64))).astype(numpy.int64) + 1
+    bits[low == 0] = 0
+    over = (bits > 0) & ((numpy.uint64(1) << numpy.maximum(bits - 1, 0).astype(numpy.uint64)) > low)
+    bits[over] -= 1
+    ranks = (width - bits + 1).astype(numpy.uint8)
+    out = numpy.zeros(1 << precision, dtype=numpy.uint8)
+    numpy.maximum.at(out, registers, ranks)
+    return bytearray(out.tobytes())
+
+
+def merge_registers(registers: list[bytes]) -> bytearray:
+    """
+    Merges the registers of several HyperLogLog sketches of the same precision, into those of their union.
+    :return: The largest value of each register.
+    """
+    views = [numpy.frombuffer(register, dtype=numpy.uint8) for register in registers]
+    return bytearray(numpy.maximum.reduce(views).tobytes())
+
+
+# Powers of ten, for counting the digits of a uint32
+_POWERS = None
+
+
+def format_doc_ids(ids: array) -> str:
+    """
+    Formats a sorted array of doc IDs as decimal numbers separated by spaces, as ' '.join(map(str, ids)) would.
+    :return: The formatted doc IDs.
+    """
+    global _POWERS
+    if len(ids) == 0:
+        return ""
+    if _POWERS is None:
+        _POWERS = numpy.array([10 ** power for power in range(1, 10)], dtype=numpy.uint32)
+    values = _view(ids)
+    # One row per doc ID: up to 10 digits, right-aligned, then a separator
+    chars = numpy.empty((len(values), 11), dtype=numpy.uint8)
+    chars[:, 10] = ord(' ')
+    remaining = values.copy()
+    for column in range(9, -1, -1):
+        chars[:, column] = remaining % 10 + ord('0')
+        remaining //= 10
+    # Keep each row's significant digits: a row has as many digits as powers of ten it reaches, plus one
+    digits = numpy.searchsorted(_POWERS, values, side="right") + 1
+    keep = numpy.arange(11) >= (10 - digits)[:, None]
+    return chars[keep][:-1].tobytes().decode("ascii")
+
+
+if __name__ == "__main__":
+    import random
+
+    if numpy is None:
+        print("NumPy isn't installed; nothing to check")
+    else:
+        generator = random.Random(1)
+        for size, spread in [(300, 10 ** 9), (5000, 20000), (1000, 2000), (257, 4 * 10 ** 9)]:
+            left = sorted(set(generator.randrange(spread) for _ in range(size)))
+            right = sorted(set(generator.randrange(spread) for _ in range(size * 3)))
+            a, b = array('I', left), array('I', right)
+            assert list(intersection(a, b)) == sorted(set(left) & set(right))
+            assert list(union([a, b])) == sorted(set(left) | set(right))
+            assert list(difference(a, b)) == sorted(set(left) - set(right))
+            assert list(difference(b, a)) == sorted(set(right) - set(left))
+            only_right = sorted(set(right) - set(left))
+            assert list(union([a, array('I', only_right)], disjoint=True)) == sorted(set(left) | set(right))
+            assert format_doc_ids(b) == ' '.join(map(str, right))
+        # The inputs are still resizable afterwards
+        a.append(4 * 10 ** 9 + 1)
+        assert format_doc_ids(array('I', [0, 9, 10, 4294967295])) == "0 9 10 4294967295"
+        assert list(intersection(array('I'), array('I', [1]))) == [] and list(union([array('I')])) == []
+        assert list(difference(array('I', [1, 2]), array('I'))) == [1, 2]
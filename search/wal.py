@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import os
+import shutil
+from typing import Iterator
+
+
+class WriteAheadLog:
+    """
+    Append-only log of the commands which changed the index since the last snapshot, one command per line.
+    Records are buffered and only written out and fsync'd every sync_every records, or when sync() is called, so the
+    cost of durability can be spread over a batch of commands.
+    """
+
+    def __init__(self, path: str, sync_every: int = 1000):
+        self.path = path
+        self.sync_every = max(sync_every, 1)
+        self.records = 0
+        self.unsynced = 0
+        self._file = open(path, "ab")
+        self._drop_torn_record()
+
+    def _drop_torn_record(self):
+        # A record cut short by a crash would otherwise be glued onto the next record we append
+        size = self._file.seek(0, os.SEEK_END)
+        end = size
+        with open(self.path, "rb") as in_file:
+            while end > 0:
+                start = max(end - 4096, 0)
+                in_file.seek(start)
+                newline = in_file.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+        if end < size:
+            self._file.truncate(end)
+
+    def append(self, record: str):
+        """
+        Adds a command to the log.
+        :param record: The command, without a trailing newline.
+        :return: None
+        """
+        self._file.write(record.encode("utf-8") + b"\n")
+        self.records += 1
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Makes sure every record appended so far is on disk.
+        :return: None
+        """
+        if self.unsynced == 0:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.unsynced = 0
+
+    def reset(self):
+        """
+        Empties the log, once a snapshot has made its records redundant.
+        :return: None
+        """
+        self._file.truncate(0)
+        self._file.seek(0)
+        self.records = 0
+        self.unsynced = 0
+        os.fsync(self._file.fileno())
+
+    def rotate(self, old_path: str):
+        """
+        Moves the records logged so far to old_path, after any records already there, and empties the log. While a
+        snapshot is written in the background, the records it covers are kept in old_path until it's complete, and
+        the records which come after it go into the log.
+        :param old_path: The path to move the records to.
+        :return: None
+        """
+        self.sync()
+        if os.path.exists(old_path):
+            # An earlier snapshot never completed, so its records are still needed too
+            with open(self.path, "rb") as in_file, open(old_path, "ab") as out_file:
+                shutil.copyfileobj(in_file, out_file)
+                out_file.flush()
+                os.fsync(out_file.fileno())
+            self.reset()
+            return
+        self._file.close()
+        os.replace(self.path, old_path)
+        self._file = open(self.path, "ab")
+        self.records = 0
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    @staticmethod
+    def read(path: str) -> Iterator[str]:
+        """
+        Reads back the records of a log. A last record without its newline was cut short by a crash, and is skipped.
+        :param path: The path of the log.
+        :return: An iterator of records, oldest first.
+        """
+        try:
+            in_file = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with in_file:
+            for line in in_file:
+                if not line.endswith(b"\n"):
+                    break
+                yield line[:-1].decode("utf-8")
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_path = os.path.join(tmp_dir, "index.wal")
+        assert list(WriteAheadLog.read(log_path)) == []
+        log = WriteAheadLog(log_path, sync_every=2)
+        log.append("index 1 soup")
+        assert list(WriteAheadLog.read(log_path)) == []
+        log.append("index 2 cake")
+        assert list(WriteAheadLog.read(log_path)) == ["index 1 soup", "index 2 cake"]
+        log.append("clear")
+        log.close()
+        with open(log_path, "ab") as torn_file:
+            torn_file.write(b"index 3 fi")
+        assert list(WriteAheadLog.read(log_path)) == ["index 1 soup", "index 2 cake", "clear"]
+        log = WriteAheadLog(log_path)
+        log.append("index 4 fish")
+        log.sync()
+        assert list(WriteAheadLog.read(log_path)) == ["index 1 soup", "index 2 cake", "clear", "index 4 fish"]
+        log.reset()
+        assert list(WriteAheadLog.read(log_path)) == []
+
+        # Rotated records pile up in the old log until it's removed
+        old_path = os.path.join(tmp_dir, "index.wal.old")
+        log.append("index 5 soup")
+        log.rotate(old_path)
+        log.append("index 6 cake")
+        log.rotate(old_path)
+        log.append("index 7 fish")
+        log.sync()
+        assert list(WriteAheadLog.read(old_path)) == ["index 5 soup", "index 6 cake"] and log.records == 1
+        assert list(WriteAheadLog.read(log_path)) == ["index 7 fish"]
+        log.close()